@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self):
+        # Подключаем обработчики сигналов (инвалидация кэша)
+        from . import signals  # noqa: F401
+        # Буферизованная запись журнала аудита в рамках запроса
+        from .audit import connect_audit_buffer
+        connect_audit_buffer()
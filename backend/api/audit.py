@@ -0,0 +1,199 @@
+"""
+Буферизованная запись журнала аудита (django-auditlog).
+
+В рамках запроса стандартные обработчики auditlog отключены (disable_auditlog),
+а записи LogEntry собираются в буфер запроса. Запись попадает в буфер только после
+фиксации транзакции, в которой произошло изменение (transaction.on_commit),
+поэтому изменения из откатившихся транзакций и точек сохранения в журнал не попадают.
+В конце запроса буфер записывается одним bulk_create - сразу или фоновым потоком
+(AUDIT_BACKGROUND_WRITER), если он включен.
+
+Вне запросов (команды управления, shell) журнал пишется auditlog как обычно.
+"""
+
+import atexit
+import contextlib
+import logging
+import queue
+import threading
+from contextvars import ContextVar
+from functools import partial
+
+from auditlog.cid import get_cid
+from auditlog.context import auditlog_value, disable_auditlog
+from auditlog.diff import model_instance_diff
+from auditlog.models import LogEntry
+from auditlog.registry import auditlog
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import close_old_connections, connection, transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.utils.encoding import smart_str
+
+logger = logging.getLogger('django')
+
+_buffer = ContextVar('audit_buffer', default=None)
+
+
+class AuditBuffer:
+    """Записи журнала одного запроса, готовые к сохранению"""
+
+    def __init__(self):
+        self.entries = []
+
+    def record(self, entry):
+        # Вне atomic-блока on_commit выполняется сразу
+        transaction.on_commit(partial(self.entries.append, entry))
+
+    def flush(self, actor_email=None):
+        entries, self.entries = self.entries, []
+        if not entries:
+            return
+        if actor_email:
+            for entry in entries:
+                entry.actor_email = actor_email
+        get_writer().submit(entries)
+
+
+@contextlib.contextmanager
+def buffer_changes():
+    """Собирает записи журнала в буфер на время блока"""
+    buffer = AuditBuffer()
+    token = _buffer.set(buffer)
+    try:
+        with disable_auditlog():
+            yield buffer
+    finally:
+        _buffer.reset(token)
+
+
+# --- Построение записей ---
+
+def _build_entry(instance, action, changes):
+    context = {}
+    with contextlib.suppress(LookupError):
+        context = auditlog_value.get()
+    try:
+        object_repr = smart_str(instance)
+    except Exception:
+        object_repr = ''
+    pk = instance.pk
+    return LogEntry(
+        content_type=ContentType.objects.get_for_model(instance),
+        object_pk=pk,
+        object_id=pk if isinstance(pk, int) else None,
+        object_repr=object_repr,
+        action=action,
+        changes=changes,
+        cid=get_cid(),
+        remote_addr=context.get('remote_addr'),
+        remote_port=context.get('remote_port'),
+    )
+
+
+def _record(instance, action, old, new, fields_to_check=None):
+    changes = model_instance_diff(old, new, fields_to_check=fields_to_check)
+    if changes:
+        _buffer.get().record(_build_entry(instance, action, changes))
+
+
+def _active(kwargs):
+    if _buffer.get() is None:
+        return False
+    return not (kwargs.get('raw') and settings.AUDITLOG_DISABLE_ON_RAW_SAVE)
+
+
+def buffer_create(sender, instance, created, **kwargs):
+    if created and _active(kwargs):
+        _record(instance, LogEntry.Action.CREATE, None, instance)
+
+
+def buffer_update(sender, instance, **kwargs):
+    if not _active(kwargs) or instance._state.adding or instance.pk is None:
+        return
+    old = sender._default_manager.filter(pk=instance.pk).first()
+    _record(instance, LogEntry.Action.UPDATE, old, instance, fields_to_check=kwargs.get('update_fields'))
+
+
+def buffer_delete(sender, instance, **kwargs):
+    if _active(kwargs) and instance.pk is not None:
+        _record(instance, LogEntry.Action.DELETE, instance, None)
+
+
+def connect_audit_buffer():
+    """Подключает буферизующие обработчики ко всем моделям, зарегистрированным в auditlog"""
+    for model in auditlog.get_models():
+        post_save.connect(buffer_create, sender=model, dispatch_uid=f'audit_buffer_create_{model.__name__}')
+        pre_save.connect(buffer_update, sender=model, dispatch_uid=f'audit_buffer_update_{model.__name__}')
+        post_delete.connect(buffer_delete, sender=model, dispatch_uid=f'audit_buffer_delete_{model.__name__}')
+
+
+# --- Запись ---
+
+def write_entries(entries):
+    LogEntry.objects.bulk_create(entries)
+
+
+class SyncAuditWriter:
+    """Запись журнала в потоке запроса (после ответа view)"""
+
+    def submit(self, entries):
+        write_entries(entries)
+
+    def stop(self):
+        pass
+
+
+class BackgroundAuditWriter:
+    """
+    Фоновый поток записи журнала с ограниченной очередью. Если очередь
+    заполнена, пачка пишется в потоке запроса - записи не теряются.
+    При завершении процесса очередь дописывается до конца.
+    """
+    _STOP = object()
+
+    def __init__(self, max_size):
+        self.queue = queue.Queue(maxsize=max_size)
+        self.thread = threading.Thread(target=self.run, name='audit-writer', daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def submit(self, entries):
+        try:
+            self.queue.put_nowait(entries)
+        except queue.Full:
+            logger.warning(f"AUDIT: очередь журнала заполнена, запись {len(entries)} событий в потоке запроса")
+            write_entries(entries)
+
+    def run(self):
+        while True:
+            entries = self.queue.get()
+            if entries is self._STOP:
+                break
+            try:
+                close_old_connections()
+                write_entries(entries)
+            except Exception:
+                logger.exception(f"AUDIT: не удалось записать {len(entries)} событий журнала")
+        connection.close()
+
+    def stop(self):
+        if self.thread.is_alive():
+            self.queue.put(self._STOP)
+            self.thread.join()
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                if getattr(settings, 'AUDIT_BACKGROUND_WRITER', False):
+                    _writer = BackgroundAuditWriter(getattr(settings, 'AUDIT_QUEUE_SIZE', 1000))
+                else:
+                    _writer = SyncAuditWriter()
+    return _writer
@@ -2,6 +2,8 @@
 from rest_framework.authentication import BaseAuthentication
 from rest_framework.exceptions import AuthenticationFailed
 from .models import AuthToken, User
+from .registry import attach_role
+from .timing import timed_phase
 
 class CustomTokenAuthentication(BaseAuthentication):
     def authenticate(self, request):
@@ -10,15 +12,17 @@ class CustomTokenAuthentication(BaseAuthentication):
             return None
 
         token = auth_header.split(' ')[1]
-        try:
-            auth_token = AuthToken.objects.select_related('user', 'user__role').get(token=token)
-        except (AuthToken.DoesNotExist, ValueError):
-            # ValueError can be raised if token is not a valid UUID format
-            raise AuthenticationFailed('Invalid token')
+        with timed_phase(request, 'auth'):
+            try:
+                auth_token = AuthToken.objects.select_related('user').get(token=token)
+            except (AuthToken.DoesNotExist, ValueError):
+                # ValueError can be raised if token is not a valid UUID format
+                raise AuthenticationFailed('Invalid token')
 
         # В Django User модель для DRF должна быть django.contrib.auth.models.User
         # Мы симулируем это, но для реального проекта нужна интеграция
         # Для целей этого прототипа, мы просто возвращаем нашего кастомного юзера
         # Убедимся, что у юзера есть необходимые атрибуты для DRF
-        user = auth_token.user
+        # Роль берется из справочника процесса, без JOIN с таблицей ролей
+        user = attach_role(auth_token.user)
         return (user, None)
@@ -0,0 +1,400 @@
+"""
+Нагрузочный замер API сценариями работы прорабов и менеджеров.
+
+Виртуальные пользователи (потоки) входят в систему и по кругу выполняют
+сценарии: прораб открывает приложение, смотрит свои сметы, добавляет работы
+и сохраняет смету; менеджер просматривает сметы, выгружает их в Excel,
+смотрит финансовую сводку и импортирует прайс работ. Запросы идут через
+тестовый клиент Django (в процессе, со всеми middleware) или на запущенный
+сервер по HTTP. Результат - пропускная способность и перцентили времени
+ответа по каждому шагу; его можно сохранить в JSON и сравнить с базовым.
+"""
+
+import dataclasses
+import io
+import json
+import random
+import re
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+import openpyxl
+from django.conf import settings
+from django.db import connections
+from django.test import Client
+
+from .models import Estimate, ProjectAssignment, User, WorkPrice
+from .registry import ROLE_FOREMAN, ROLE_MANAGER
+
+API_PREFIX = '/api/v1/'
+PERCENTILES = (50, 95, 99)
+# Строк в файле импорта прайса
+IMPORT_ROWS = 20
+
+_QUERIES_RE = re.compile(r'db;dur=[\d.]+;desc="(\d+) queries"')
+
+
+@dataclasses.dataclass
+class BenchmarkOptions:
+    users: int = 10
+    # Доля прорабов среди виртуальных пользователей
+    foreman_share: float = 0.8
+    duration: float = 30.0
+    # Если задано - число сценариев на пользователя вместо длительности
+    iterations: int = None
+    # Пауза между шагами сценария (время "на раздумья"), секунды
+    think_time: float = 0.0
+    email_domain: str = 'dataset.local'
+    password: str = 'password123'
+    base_url: str = None
+    seed: int = 1
+
+
+@dataclasses.dataclass
+class Response:
+    status: int
+    body: bytes
+    server_timing: str = ''
+
+    def json(self):
+        return json.loads(self.body) if self.body else None
+
+
+# --- Транспорт ---
+
+class ClientTransport:
+    """Запросы через тестовый клиент Django в текущем процессе"""
+
+    def __init__(self):
+        host = next((host for host in settings.ALLOWED_HOSTS if host not in ('*', '') and not host.startswith('.')),
+                    'localhost')
+        self.client = Client(raise_request_exception=False, HTTP_HOST=host)
+
+    def request(self, method, path, token=None, data=None, files=None):
+        headers = {'HTTP_AUTHORIZATION': f'Bearer {token}'} if token else {}
+        if files:
+            response = self.client.post(path, files, **headers)
+        elif data is not None:
+            response = self.client.generic(method, path, json.dumps(data), 'application/json', **headers)
+        else:
+            response = self.client.generic(method, path, **headers)
+        # Потоковые ответы (экспорт) дочитываются, как это сделал бы клиент
+        body = b''.join(response.streaming_content) if response.streaming else response.content
+        return Response(response.status_code, body, response.get('Server-Timing', ''))
+
+    def close(self):
+        connections.close_all()
+
+
+class HttpTransport:
+    """Запросы к запущенному серверу (python manage.py runserver, gunicorn)"""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+
+    def request(self, method, path, token=None, data=None, files=None):
+        headers = {'Authorization': f'Bearer {token}'} if token else {}
+        body = None
+        if files:
+            boundary = uuid.uuid4().hex
+            body = self.encode_multipart(boundary, files)
+            headers['Content-Type'] = f'multipart/form-data; boundary={boundary}'
+        elif data is not None:
+            body = json.dumps(data).encode()
+            headers['Content-Type'] = 'application/json'
+        request = urllib.request.Request(self.base_url + path, data=body, headers=headers, method=method)
+        try:
+            with urllib.request.urlopen(request, timeout=60) as response:
+                return Response(response.status, response.read(), response.headers.get('Server-Timing', ''))
+        except urllib.error.HTTPError as error:
+            return Response(error.code, error.read(), error.headers.get('Server-Timing', ''))
+
+    @staticmethod
+    def encode_multipart(boundary, files):
+        parts = []
+        for name, file_obj in files.items():
+            parts.append(
+                f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{file_obj.name}"\r\n'
+                f'Content-Type: application/octet-stream\r\n\r\n'.encode()
+            )
+            parts.append(file_obj.read())
+            parts.append(b'\r\n')
+        parts.append(f'--{boundary}--\r\n'.encode())
+        return b''.join(parts)
+
+    def close(self):
+        pass
+
+
+# --- Замеры ---
+
+class Recorder:
+    """Время ответа по шагам сценариев (общий для всех потоков)"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+
+    def record(self, step, duration, ok, queries=None, error=None):
+        with self.lock:
+            sample = self.samples.setdefault(step, {'durations': [], 'errors': 0, 'queries': [], 'error': None})
+            sample['durations'].append(duration)
+            if not ok:
+                sample['errors'] += 1
+                # Для разбора достаточно первой ошибки шага
+                sample['error'] = sample['error'] or error
+            if queries is not None:
+                sample['queries'].append(queries)
+
+
+def percentile(sorted_values, percent):
+    """Перцентиль методом ближайшего ранга"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, -(-len(sorted_values) * percent // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def summarize(recorder, elapsed):
+    endpoints = {}
+    total = 0
+    errors = 0
+    for step, sample in sorted(recorder.samples.items()):
+        durations = sorted(sample['durations'])
+        total += len(durations)
+        errors += sample['errors']
+        stats = {
+            'count': len(durations),
+            'errors': sample['errors'],
+            'throughput': round(len(durations) / elapsed, 2),
+            'mean_ms': round(sum(durations) / len(durations) * 1000, 2),
+            'max_ms': round(durations[-1] * 1000, 2),
+        }
+        for percent in PERCENTILES:
+            stats[f'p{percent}_ms'] = round(percentile(durations, percent) * 1000, 2)
+        if sample['queries']:
+            stats['db_queries'] = round(sum(sample['queries']) / len(sample['queries']), 1)
+        if sample['error']:
+            stats['first_error'] = sample['error']
+        endpoints[step] = stats
+    return {
+        'elapsed': round(elapsed, 2),
+        'requests': total,
+        'errors': errors,
+        'throughput': round(total / elapsed, 2) if elapsed else 0.0,
+        'endpoints': endpoints,
+    }
+
+
+def compare(result, baseline, threshold=20.0):
+    """
+    Сравнение с базовым результатом: изменение p95 и пропускной способности в процентах.
+    Возвращает (строки сравнения, есть ли ухудшение больше threshold процентов).
+    """
+    def change(new, old):
+        return (new - old) / old * 100 if old else 0.0
+
+    rows = []
+    regressed = False
+    throughput_change = change(result['throughput'], baseline['throughput'])
+    if throughput_change < -threshold:
+        regressed = True
+    rows.append(('всего, запросов/с', baseline['throughput'], result['throughput'], throughput_change))
+    for step, stats in result['endpoints'].items():
+        old = baseline['endpoints'].get(step)
+        if old is None:
+            continue
+        p95_change = change(stats['p95_ms'], old['p95_ms'])
+        if p95_change > threshold:
+            regressed = True
+        rows.append((f'{step}, p95 мс', old['p95_ms'], stats['p95_ms'], p95_change))
+    return rows, regressed
+
+
+# --- Сценарии ---
+
+class VirtualUser:
+    """Виртуальный пользователь: вход и сценарии его роли"""
+
+    def __init__(self, runner, user):
+        self.runner = runner
+        self.user = user
+        self.transport = runner.make_transport()
+        self.rng = random.Random(f'{runner.options.seed}-{user.user_id}')
+        self.token = None
+
+    def call(self, step, method, path, data=None, files=None, expected=(200, 201)):
+        started = time.perf_counter()
+        try:
+            response = self.transport.request(method, API_PREFIX + path, self.token, data, files)
+        except Exception as e:
+            # Ошибка транспорта (сервер недоступен, блокировка БД) считается ошибкой шага
+            self.runner.recorder.record(step, time.perf_counter() - started, False, error=repr(e))
+            return None
+        duration = time.perf_counter() - started
+        ok = response.status in expected
+        match = _QUERIES_RE.search(response.server_timing)
+        self.runner.recorder.record(
+            step, duration, ok, int(match.group(1)) if match else None,
+            error=None if ok else f'{response.status}: {response.body[:300].decode(errors="replace")}',
+        )
+        if self.runner.options.think_time:
+            time.sleep(self.rng.uniform(0, self.runner.options.think_time * 2))
+        return response if response.status in expected else None
+
+    @staticmethod
+    def results(response):
+        data = response.json() if response else None
+        if isinstance(data, dict):
+            return data.get('results', [])
+        return data or []
+
+    def login(self):
+        response = self.call('login', 'POST', 'auth/login/', {
+            'email': self.user.email, 'password': self.runner.options.password,
+        })
+        self.token = response.json()['token'] if response else None
+        return self.token is not None
+
+    def run_scenario(self):
+        if self.user.role.role_name == ROLE_FOREMAN:
+            self.foreman_scenario()
+        else:
+            self.manager_scenario()
+
+    def foreman_scenario(self):
+        """Прораб открывает приложение, выбирает смету, добавляет работы и сохраняет"""
+        self.call('me', 'GET', 'auth/me/')
+        self.call('bootstrap', 'GET', 'bootstrap/')
+        project_ids = self.runner.foreman_projects.get(self.user.user_id)
+        if not project_ids:
+            return
+        estimates = self.results(self.call('estimate_list', 'GET', f'estimates/?project={self.rng.choice(project_ids)}'))
+        if not estimates:
+            return
+        estimate_id = self.rng.choice(estimates)['estimate_id']
+        self.call('estimate_detail', 'GET', f'estimates/{estimate_id}/')
+        self.call('work_types', 'GET', 'work-types/')
+        for work_type_id in self.rng.sample(self.runner.work_type_ids, min(3, len(self.runner.work_type_ids))):
+            self.call('item_add', 'POST', 'estimate-items/', {
+                'estimate': estimate_id, 'work_type': work_type_id, 'quantity': self.rng.randint(1, 50),
+            })
+        self.call('estimate_items', 'GET', f'estimate-items/?estimate={estimate_id}')
+        # Сохранение сметы с мобильного: работы уже добавлены, меняются поля сметы
+        self.call('estimate_save', 'PATCH', f'estimates/{estimate_id}/', {'name': f'Смета {estimate_id}'})
+
+    def manager_scenario(self):
+        """Менеджер просматривает сметы, выгружает их, смотрит сводку и импортирует прайс"""
+        self.call('me', 'GET', 'auth/me/')
+        estimates = self.results(self.call('estimate_list', 'GET', 'estimates/'))
+        if estimates:
+            estimate_id = self.rng.choice(estimates)['estimate_id']
+            self.call('estimate_detail', 'GET', f'estimates/{estimate_id}/')
+            self.call('export_client', 'GET', f'estimates/{estimate_id}/export/client/')
+            self.call('export_internal', 'GET', f'estimates/{estimate_id}/export/internal/')
+        self.call('finance_summary', 'GET', 'finance/summary/')
+        if self.runner.import_file:
+            import_file = io.BytesIO(self.runner.import_file)
+            import_file.name = 'works.xlsx'
+            self.call('work_type_import', 'POST', 'work-types/import/', files={'file': import_file})
+
+    def run(self, deadline, iterations):
+        try:
+            if not self.login():
+                return
+            done = 0
+            while (iterations is None and time.monotonic() < deadline) or (iterations is not None and done < iterations):
+                self.run_scenario()
+                done += 1
+        finally:
+            self.transport.close()
+
+
+class BenchmarkRunner:
+    """Запуск виртуальных пользователей и сбор результатов"""
+
+    def __init__(self, options):
+        self.options = options
+        self.recorder = Recorder()
+        self.foreman_projects = {}
+        self.work_type_ids = []
+        self.import_file = None
+
+    def make_transport(self):
+        if self.options.base_url:
+            return HttpTransport(self.options.base_url)
+        return ClientTransport()
+
+    def select_users(self):
+        """Пользователи набора данных (generate_dataset) в нужной пропорции ролей"""
+        options = self.options
+        users = User.objects.filter(email__endswith=f'@{options.email_domain}').select_related('role')
+        foremen = [user for user in users if user.role.role_name == ROLE_FOREMAN]
+        managers = [user for user in users if user.role.role_name == ROLE_MANAGER]
+        foreman_count = round(options.users * options.foreman_share) if managers else options.users
+        if not foremen:
+            foreman_count = 0
+        selected = [foremen[index % len(foremen)] for index in range(foreman_count)]
+        selected += [managers[index % len(managers)] for index in range(options.users - foreman_count) if managers]
+        return selected
+
+    def prepare(self):
+        """Данные для сценариев загружаются заранее, чтобы не влиять на замеры"""
+        for user_id, project_id in ProjectAssignment.objects.values_list('user_id', 'project_id'):
+            self.foreman_projects.setdefault(user_id, []).append(project_id)
+        prices = list(WorkPrice.objects.select_related('work_type__category').order_by('work_type_id'))
+        self.work_type_ids = [price.work_type_id for price in prices]
+        if prices:
+            self.import_file = build_import_file(random.Random(self.options.seed).sample(
+                prices, min(IMPORT_ROWS, len(prices))
+            ))
+
+    def run(self):
+        users = self.select_users()
+        if not users:
+            raise ValueError(
+                f'Нет пользователей @{self.options.email_domain}: сначала выполните generate_dataset'
+            )
+        self.prepare()
+        # Соединение основного потока не нужно потокам пользователей (SQLite блокирует запись)
+        connections.close_all()
+
+        deadline = time.monotonic() + self.options.duration
+        virtual_users = [VirtualUser(self, user) for user in users]
+        threads = [
+            threading.Thread(target=virtual_user.run, args=(deadline, self.options.iterations), daemon=True)
+            for virtual_user in virtual_users
+        ]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        result = summarize(self.recorder, time.perf_counter() - started)
+        result['options'] = dataclasses.asdict(self.options)
+        result['options'].pop('password')
+        result['estimates'] = Estimate.objects.count()
+        return result
+
+
+def build_import_file(prices):
+    """Файл импорта прайса с текущими ценами (импорт не меняет каталог)"""
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    sheet.append(['Наименование', 'Категория', 'Ед. изм.', 'Себестоимость', 'Цена клиента'])
+    for price in prices:
+        work_type = price.work_type
+        sheet.append([
+            work_type.work_name, work_type.category.category_name, work_type.unit_of_measurement,
+            float(price.cost_price), float(price.client_price),
+        ])
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    return buffer.getvalue()
+
+
+def run_benchmark(options):
+    return BenchmarkRunner(options).run()
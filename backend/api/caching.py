@@ -0,0 +1,69 @@
+"""
+Версионированный кэш для производных данных.
+
+Каждый раздел данных (сметы, проекты, справочники) имеет номер версии в общем кэше.
+Ключи кэшированных ответов включают версии разделов, от которых они зависят,
+поэтому при изменении данных достаточно увеличить версию - старые записи
+перестают читаться и со временем вытесняются по TTL.
+"""
+
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+
+VERSION_KEY_PREFIX = 'data_version'
+
+# Разделы данных
+SECTION_ESTIMATES = 'estimates'
+SECTION_PROJECTS = 'projects'
+SECTION_STATUSES = 'statuses'
+SECTION_CATALOG = 'catalog'
+SECTION_USERS = 'users'
+SECTION_ROLES = 'roles'
+
+
+def _version_key(section):
+    return f'{VERSION_KEY_PREFIX}:{section}'
+
+
+def get_version(section):
+    """Текущая версия раздела"""
+    key = _version_key(section)
+    version = cache.get(key)
+    if version is None:
+        # Начальная версия от времени: после вытеснения ключа из кэша
+        # новая версия не совпадет со старыми записями
+        cache.add(key, int(time.time() * 1000), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def bump_version(*sections):
+    """Увеличивает версии разделов (инвалидирует зависящие от них записи)"""
+    for section in sections:
+        try:
+            cache.incr(_version_key(section))
+        except ValueError:
+            # Ключа нет в кэше - следующий get_version создаст новую версию
+            get_version(section)
+
+
+def invalidate(*sections):
+    """
+    Инвалидирует разделы сразу и повторно после фиксации транзакции,
+    чтобы данные, прочитанные и закэшированные до коммита, тоже устарели.
+    """
+    bump_version(*sections)
+    transaction.on_commit(lambda: bump_version(*sections))
+
+
+def combined_version(*sections):
+    """Общая версия значения, зависящего от нескольких разделов"""
+    return '.'.join(str(get_version(section)) for section in sections)
+
+
+def versioned_key(name, *parts, sections=()):
+    """Ключ кэша, включающий версии разделов, от которых зависит значение"""
+    versions = combined_version(*sections)
+    return ':'.join([name, versions, *[str(part) for part in parts]])
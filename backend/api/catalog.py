@@ -0,0 +1,63 @@
+"""
+Каталог работ в памяти процесса.
+
+Цены {work_type_id: (cost_price, client_price)} и данные работ
+{work_type_id: (work_name, unit_of_measurement, category_name)} загружаются
+двумя запросами и живут до смены версии раздела каталога в общем кэше,
+поэтому заполнение цен и снимка работы в новых позициях смет не обращается к БД.
+"""
+
+import threading
+
+from .caching import SECTION_CATALOG, get_version
+from .metrics import record_cache
+from .models import WorkPrice, WorkType
+
+_lock = threading.Lock()
+_catalog = {'version': None, 'prices': {}, 'work_types': {}}
+
+
+def _load_catalog():
+    """Текущий каталог; перечитывается только после изменения каталога"""
+    version = get_version(SECTION_CATALOG)
+    hit = _catalog['version'] == version
+    record_cache('catalog', hit)
+    if hit:
+        return _catalog
+
+    with _lock:
+        if _catalog['version'] != version:
+            prices = {
+                work_type_id: (cost_price, client_price)
+                for work_type_id, cost_price, client_price
+                in WorkPrice.objects.values_list('work_type_id', 'cost_price', 'client_price')
+            }
+            work_types = {
+                work_type_id: (work_name, unit, category_name or '')
+                for work_type_id, work_name, unit, category_name
+                in WorkType.objects.values_list(
+                    'work_type_id', 'work_name', 'unit_of_measurement', 'category__category_name'
+                )
+            }
+            _catalog.update(version=version, prices=prices, work_types=work_types)
+    return _catalog
+
+
+def catalog_prices():
+    return _load_catalog()['prices']
+
+
+def work_type_prices(work_type_id):
+    """(cost_price, client_price) работы или None, если цена не задана"""
+    return catalog_prices().get(work_type_id)
+
+
+def work_type_snapshot(work_type_id):
+    """(work_name, unit_of_measurement, category_name) работы или None"""
+    return _load_catalog()['work_types'].get(work_type_id)
+
+
+def clear_catalog_prices():
+    """Сбрасывает каталог процесса (для тестов и команд управления)"""
+    with _lock:
+        _catalog.update(version=None, prices={}, work_types={})
@@ -0,0 +1,393 @@
+"""
+Генератор синтетических данных для нагрузочных замеров.
+
+Пользователи, проекты, каталог работ с ценами, сметы и позиции создаются
+через bulk_create пачками, поэтому база на миллион позиций строится за минуты.
+Случайные значения берутся из random.Random(seed): при одинаковых параметрах
+получается одинаковый набор данных. Сигналы моделей при bulk_create
+не срабатывают - журнал изменений не заполняется, кэши инвалидируются
+один раз в конце.
+"""
+
+import bisect
+import dataclasses
+import itertools
+import random
+from datetime import timedelta
+from decimal import Decimal
+
+from django.contrib.auth.hashers import make_password
+from django.db import transaction
+from django.utils import timezone
+
+from .caching import (
+    SECTION_CATALOG, SECTION_ESTIMATES, SECTION_PROJECTS, SECTION_ROLES, SECTION_STATUSES, SECTION_USERS,
+    invalidate,
+)
+from .models import (
+    Client, Estimate, EstimateItem, Project, ProjectAssignment, Role, Status, User, WorkCategory, WorkPrice,
+    WorkPriceHistory, WorkType,
+)
+from .registry import ROLE_FOREMAN, ROLE_MANAGER, STATUS_DRAFT
+
+DEFAULT_PASSWORD = 'password123'
+
+# Статусы и их доля среди смет
+STATUS_WEIGHTS = {
+    STATUS_DRAFT: 35,
+    'На согласовании': 20,
+    'В работе': 30,
+    'Завершена': 10,
+    'Отклонена': 5,
+}
+
+FIRST_NAMES = (
+    'Александр', 'Алексей', 'Андрей', 'Артем', 'Владимир', 'Дмитрий', 'Евгений', 'Иван', 'Игорь', 'Кирилл',
+    'Максим', 'Михаил', 'Николай', 'Олег', 'Павел', 'Роман', 'Сергей', 'Юрий', 'Виктор', 'Денис',
+)
+LAST_NAMES = (
+    'Иванов', 'Петров', 'Сидоров', 'Смирнов', 'Кузнецов', 'Попов', 'Васильев', 'Соколов', 'Михайлов', 'Новиков',
+    'Федоров', 'Морозов', 'Волков', 'Алексеев', 'Лебедев', 'Семенов', 'Егоров', 'Павлов', 'Козлов', 'Степанов',
+)
+CITIES = ('Москва', 'Санкт-Петербург', 'Казань', 'Екатеринбург', 'Новосибирск', 'Краснодар', 'Тула', 'Самара')
+STREETS = (
+    'ул. Ленина', 'ул. Гагарина', 'ул. Садовая', 'пр. Мира', 'ул. Советская', 'ул. Лесная', 'ул. Набережная',
+    'ул. Молодежная', 'ул. Школьная', 'ул. Строителей',
+)
+PROJECT_KINDS = ('ЖК «{}»', 'Коттедж в пос. {}', 'Офис «{}»', 'Квартира на {}', 'Магазин «{}»', 'Таунхаус «{}»')
+PROJECT_NAMES = (
+    'Северный', 'Солнечный', 'Березки', 'Лесная поляна', 'Кристалл', 'Парус', 'Изумруд', 'Олимп', 'Заречье',
+    'Садовый', 'Гранит', 'Меридиан',
+)
+CLIENT_KINDS = ('ООО «{}»', 'АО «{}»', 'ИП {}')
+ESTIMATE_TITLES = ('Смета', 'Смета на отделку', 'Доп. смета', 'Смета на черновые работы', 'Смета на инженерные сети')
+
+# Категории каталога: (название, [(работа, единица), ...])
+CATALOG = (
+    ('Демонтажные работы', [
+        ('Демонтаж перегородок', 'м²'), ('Демонтаж напольного покрытия', 'м²'), ('Демонтаж плитки', 'м²'),
+        ('Демонтаж дверных блоков', 'шт'), ('Вывоз строительного мусора', 'т'),
+    ]),
+    ('Земляные работы', [
+        ('Разработка грунта вручную', 'м³'), ('Разработка грунта экскаватором', 'м³'), ('Обратная засыпка', 'м³'),
+        ('Устройство песчаной подушки', 'м³'),
+    ]),
+    ('Фундаментные работы', [
+        ('Устройство ленточного фундамента', 'м³'), ('Армирование фундамента', 'т'), ('Гидроизоляция фундамента', 'м²'),
+        ('Устройство опалубки', 'м²'),
+    ]),
+    ('Каменные работы', [
+        ('Кладка стен из газобетона', 'м³'), ('Кладка перегородок из кирпича', 'м²'), ('Устройство перемычек', 'шт'),
+    ]),
+    ('Штукатурные работы', [
+        ('Штукатурка стен', 'м²'), ('Штукатурка откосов', 'м.п.'), ('Установка маяков', 'м.п.'),
+    ]),
+    ('Малярные работы', [
+        ('Шпаклевка стен', 'м²'), ('Шпаклевка потолков', 'м²'), ('Окраска стен', 'м²'), ('Окраска потолков', 'м²'),
+        ('Грунтовка поверхностей', 'м²'),
+    ]),
+    ('Плиточные работы', [
+        ('Укладка плитки на пол', 'м²'), ('Облицовка стен плиткой', 'м²'), ('Затирка швов', 'м²'),
+        ('Запил плитки под 45°', 'м.п.'),
+    ]),
+    ('Напольные покрытия', [
+        ('Устройство стяжки пола', 'м²'), ('Укладка ламината', 'м²'), ('Укладка паркетной доски', 'м²'),
+        ('Монтаж плинтуса', 'м.п.'),
+    ]),
+    ('Потолки', [
+        ('Монтаж потолка из гипсокартона', 'м²'), ('Монтаж натяжного потолка', 'м²'), ('Монтаж карниза', 'м.п.'),
+    ]),
+    ('Электромонтажные работы', [
+        ('Прокладка кабеля', 'м.п.'), ('Установка розеток', 'шт'), ('Установка выключателей', 'шт'),
+        ('Монтаж светильника', 'шт'), ('Сборка электрощита', 'компл'),
+    ]),
+    ('Сантехнические работы', [
+        ('Прокладка труб водоснабжения', 'м.п.'), ('Установка унитаза', 'шт'), ('Установка смесителя', 'шт'),
+        ('Монтаж радиатора отопления', 'шт'), ('Монтаж инсталляции', 'компл'),
+    ]),
+    ('Кровельные работы', [
+        ('Монтаж стропильной системы', 'м²'), ('Укладка металлочерепицы', 'м²'), ('Утепление кровли', 'м²'),
+        ('Монтаж водосточной системы', 'м.п.'),
+    ]),
+)
+# Уточнения для каталога больше базового списка
+WORK_QUALIFIERS = (
+    'в санузле', 'на кухне', 'в жилых комнатах', 'на балконе', 'на фасаде', 'в подвале', 'на высоте до 3 м',
+    'на высоте более 3 м', 'по бетону', 'по дереву', 'по кирпичу', 'повышенной сложности',
+)
+
+# Диапазоны себестоимости за единицу и количества по единицам измерения
+UNIT_PRICES = {'м²': (150, 2500), 'м³': (800, 6000), 'м.п.': (100, 1500), 'шт': (200, 8000), 'т': (1500, 9000),
+               'компл': (3000, 40000)}
+UNIT_QUANTITIES = {'м²': (5, 250), 'м³': (1, 60), 'м.п.': (5, 200), 'шт': (1, 40), 'т': (0.5, 20), 'компл': (1, 3)}
+
+CENTS = Decimal('0.01')
+
+
+@dataclasses.dataclass
+class DatasetOptions:
+    managers: int = 3
+    foremen: int = 20
+    projects: int = 50
+    # Проектов на прораба
+    assignments: int = 3
+    categories: int = 12
+    work_types: int = 300
+    estimates_per_project: int = 10
+    # Среднее число позиций в смете (фактическое - от половины до полутора средних)
+    items_per_estimate: int = 30
+    seed: int = 1
+    batch_size: int = 5000
+    email_domain: str = 'dataset.local'
+    password: str = DEFAULT_PASSWORD
+
+
+def _money(value):
+    return Decimal(value).quantize(CENTS)
+
+
+def _person(rng):
+    return f'{rng.choice(LAST_NAMES)} {rng.choice(FIRST_NAMES)}'
+
+
+def _batches(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+class DatasetGenerator:
+    """Создает набор данных по DatasetOptions; log - функция для вывода прогресса"""
+
+    def __init__(self, options, log=None):
+        self.options = options
+        self.rng = random.Random(options.seed)
+        self.log = log or (lambda message: None)
+        self.counts = {}
+
+    def generate(self):
+        with transaction.atomic():
+            roles = self.create_roles()
+            statuses = self.create_statuses()
+            managers, foremen = self.create_users(roles)
+            projects = self.create_projects()
+            project_foremen = self.create_assignments(projects, foremen)
+            work_types = self.create_catalog()
+            self.create_estimates(projects, project_foremen, managers, statuses, work_types)
+            # bulk_create не отправляет сигналы: кэши сбрасываются один раз
+            invalidate(
+                SECTION_ESTIMATES, SECTION_PROJECTS, SECTION_STATUSES, SECTION_CATALOG, SECTION_USERS, SECTION_ROLES,
+            )
+        return self.counts
+
+    def bulk_create(self, model, objects, keep=True):
+        """
+        bulk_create пачками. Возвращает созданные объекты с первичными ключами;
+        при keep=False объекты не накапливаются (позиции смет не держатся в памяти).
+        """
+        created = []
+        count = 0
+        for number, batch in enumerate(_batches(objects, self.options.batch_size), start=1):
+            model.objects.bulk_create(batch)
+            count += len(batch)
+            if keep:
+                created.extend(batch)
+            if number % 20 == 0:
+                self.log(f'{model.__name__}: {count}')
+        self.counts[model.__name__] = self.counts.get(model.__name__, 0) + count
+        return created
+
+    def create_roles(self):
+        return {name: Role.objects.get_or_create(role_name=name)[0] for name in (ROLE_MANAGER, ROLE_FOREMAN)}
+
+    def create_statuses(self):
+        return {name: Status.objects.get_or_create(status_name=name)[0] for name in STATUS_WEIGHTS}
+
+    def create_users(self, roles):
+        options = self.options
+        # Хеш пароля считается один раз: make_password намеренно медленный
+        password_hash = make_password(options.password)
+        users = [
+            User(email=f'manager{index}@{options.email_domain}', full_name=_person(self.rng),
+                 password_hash=password_hash, role=roles[ROLE_MANAGER])
+            for index in range(1, options.managers + 1)
+        ] + [
+            User(email=f'foreman{index}@{options.email_domain}', full_name=_person(self.rng),
+                 password_hash=password_hash, role=roles[ROLE_FOREMAN])
+            for index in range(1, options.foremen + 1)
+        ]
+        users = self.bulk_create(User, users)
+        return users[:options.managers], users[options.managers:]
+
+    def create_projects(self):
+        rng = self.rng
+        clients = self.bulk_create(Client, [
+            Client(
+                client_name=rng.choice(CLIENT_KINDS).format(rng.choice(PROJECT_NAMES + LAST_NAMES)),
+                client_phone=f'+7 9{rng.randint(10, 99)} {rng.randint(100, 999)}-{rng.randint(10, 99)}-{rng.randint(10, 99)}',
+            )
+            for _ in range(max(1, self.options.projects // 3))
+        ])
+        return self.bulk_create(Project, [
+            Project(
+                project_name=f'{rng.choice(PROJECT_KINDS).format(rng.choice(PROJECT_NAMES))} №{index}',
+                address=f'г. {rng.choice(CITIES)}, {rng.choice(STREETS)}, д. {rng.randint(1, 150)}',
+                client=rng.choice(clients),
+            )
+            for index in range(1, self.options.projects + 1)
+        ])
+
+    def create_assignments(self, projects, foremen):
+        """Назначения прорабов; у каждого проекта есть хотя бы один прораб"""
+        if not foremen:
+            return {}
+        pairs = set()
+        for index, project in enumerate(projects):
+            pairs.add((foremen[index % len(foremen)].user_id, project.project_id))
+        per_foreman = min(self.options.assignments, len(projects))
+        for foreman in foremen:
+            for project in self.rng.sample(projects, per_foreman):
+                pairs.add((foreman.user_id, project.project_id))
+
+        pairs = sorted(pairs)
+        self.bulk_create(ProjectAssignment, [
+            ProjectAssignment(user_id=user_id, project_id=project_id) for user_id, project_id in pairs
+        ])
+        project_foremen = {}
+        for user_id, project_id in pairs:
+            project_foremen.setdefault(project_id, []).append(user_id)
+        return project_foremen
+
+    def catalog_names(self):
+        """Названия категорий и работ нужного размера: базовый список, затем уточнения"""
+        categories = [name for name, _ in CATALOG][:self.options.categories]
+        categories += [f'Прочие работы {index}' for index in range(1, self.options.categories - len(categories) + 1)]
+        base_works = [
+            (categories[index % len(categories)], work_name, unit)
+            for index, (_, works) in enumerate(CATALOG)
+            for work_name, unit in works
+        ]
+        works = []
+        for qualifier in itertools.chain([None], WORK_QUALIFIERS, itertools.count(1)):
+            for category, work_name, unit in base_works:
+                if len(works) >= self.options.work_types:
+                    return categories, works
+                if qualifier is None:
+                    name = work_name
+                elif isinstance(qualifier, int):
+                    name = f'{work_name} (вариант {qualifier})'
+                else:
+                    name = f'{work_name} {qualifier}'
+                works.append((category, name, unit))
+        return categories, works
+
+    def create_catalog(self):
+        """
+        Категории, работы, цены и начальная история цен. Существующие работы не
+        создаются заново, но вместе с ценами входят в каталог для позиций смет.
+        """
+        rng = self.rng
+        categories, works = self.catalog_names()
+        category_objects = WorkCategory.objects.in_bulk(categories, field_name='category_name')
+        category_objects.update(
+            (category.category_name, category) for category in self.bulk_create(WorkCategory, [
+                WorkCategory(category_name=name) for name in categories if name not in category_objects
+            ])
+        )
+        existing = set(WorkType.objects.filter(work_name__in=[name for _, name, _ in works])
+                       .values_list('work_name', flat=True))
+        work_types = self.bulk_create(WorkType, [
+            WorkType(category=category_objects[category], work_name=name, unit_of_measurement=unit)
+            for category, name, unit in works if name not in existing
+        ])
+
+        prices = []
+        for work_type in work_types:
+            low, high = UNIT_PRICES[work_type.unit_of_measurement]
+            cost = _money(rng.uniform(low, high))
+            prices.append(WorkPrice(
+                work_type=work_type, cost_price=cost, client_price=_money(cost * Decimal(rng.uniform(1.15, 1.6))),
+            ))
+        prices = self.bulk_create(WorkPrice, prices)
+        valid_from = timezone.now() - timedelta(days=365)
+        self.bulk_create(WorkPriceHistory, [
+            WorkPriceHistory(work_type=price.work_type, valid_from=valid_from,
+                             cost_price=price.cost_price, client_price=price.client_price)
+            for price in prices
+        ])
+        catalog = {
+            price.work_type.work_name: (price.work_type, price)
+            for price in WorkPrice.objects.select_related('work_type__category').filter(
+                work_type__work_name__in=existing, work_type__unit_of_measurement__in=UNIT_QUANTITIES,
+            )
+        }
+        catalog.update((work_type.work_name, (work_type, price)) for work_type, price in zip(work_types, prices))
+        # Порядок названий каталога - набор воспроизводим при одинаковом seed
+        return [catalog[name] for _, name, _ in works if name in catalog]
+
+    def create_estimates(self, projects, project_foremen, managers, statuses, work_types):
+        options = self.options
+        rng = self.rng
+        if not work_types or not project_foremen:
+            return
+        status_names = list(STATUS_WEIGHTS)
+        status_weights = list(itertools.accumulate(STATUS_WEIGHTS.values()))
+
+        estimates = []
+        for project in projects:
+            foreman_ids = project_foremen[project.project_id]
+            for number in range(1, options.estimates_per_project + 1):
+                foreman_id = rng.choice(foreman_ids)
+                # Большую часть смет прорабы создают сами
+                creator_id = foreman_id if not managers or rng.random() < 0.7 else rng.choice(managers).user_id
+                estimates.append(Estimate(
+                    estimate_number=f'{rng.choice(ESTIMATE_TITLES)} №{project.project_id}-{number}',
+                    status=statuses[rng.choices(status_names, cum_weights=status_weights)[0]],
+                    project=project, creator_id=creator_id, foreman_id=foreman_id, client_id=project.client_id,
+                ))
+        estimates = self.bulk_create(Estimate, estimates)
+
+        # Популярность работ по закону Ципфа: небольшая часть каталога встречается в большинстве смет
+        popularity = list(range(len(work_types)))
+        rng.shuffle(popularity)
+        cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in popularity))
+        self.bulk_create(EstimateItem, self.iter_items(estimates, managers, work_types, cum_weights), keep=False)
+
+    def iter_items(self, estimates, managers, work_types, cum_weights):
+        options = self.options
+        rng = self.rng
+        if options.items_per_estimate == 0:
+            # Пустые сметы (нижняя граница low ниже - не меньше одной позиции)
+            return
+        total_weight = cum_weights[-1]
+        low = max(1, options.items_per_estimate // 2)
+        high = min(len(work_types), max(low, options.items_per_estimate * 3 // 2))
+        for estimate in estimates:
+            count = min(rng.randint(low, high), len(work_types))
+            if count > len(work_types) // 2:
+                # Смета почти на весь каталог: выбор по популярности слишком долго добирал бы редкие работы
+                chosen = set(rng.sample(range(len(work_types)), count))
+            else:
+                chosen = set()
+                while len(chosen) < count:
+                    chosen.add(min(bisect.bisect(cum_weights, rng.random() * total_weight), len(work_types) - 1))
+            for index in sorted(chosen):
+                work_type, price = work_types[index]
+                unit = work_type.unit_of_measurement
+                quantity = rng.uniform(*UNIT_QUANTITIES[unit])
+                added_by_id = estimate.foreman_id
+                if managers and rng.random() < 0.1:
+                    added_by_id = rng.choice(managers).user_id
+                yield EstimateItem(
+                    estimate=estimate, work_type=work_type,
+                    quantity=_money(quantity if unit in ('т', 'м³') else round(quantity)),
+                    cost_price_per_unit=price.cost_price, client_price_per_unit=price.client_price,
+                    added_by_id=added_by_id,
+                    work_name=work_type.work_name, unit_of_measurement=unit,
+                    category_name=work_type.category.category_name,
+                )
+
+
+def generate_dataset(options, log=None):
+    """Создает набор данных; возвращает число созданных объектов по моделям"""
+    return DatasetGenerator(options, log).generate()
@@ -0,0 +1,287 @@
+"""
+Поток изменений (Server-Sent Events) для клиентов.
+
+Изменения смет, позиций и каталога записываются в журнал ChangeEvent одной
+пачкой на транзакцию: в ней же, если изменения сделаны в changes_atomic, иначе
+сразу после фиксации. ASGI-приложение /api/v1/events/ отдает новые записи
+журнала с учетом роли пользователя; при переподключении клиент передает
+Last-Event-ID и получает пропущенные события.
+"""
+
+import asyncio
+from datetime import timedelta
+import json
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+
+from .caching import SECTION_CATALOG, get_version
+from .models import AuthToken, ChangeEvent, Estimate, EstimateItem
+
+EVENTS_PATH = '/api/v1/events/'
+# Интервал опроса журнала потоком
+POLL_INTERVAL = 1.0
+# Комментарий-пинг, чтобы прокси не закрывали неактивное соединение
+HEARTBEAT_INTERVAL = 15.0
+# Максимум событий за одно чтение журнала
+EVENTS_BATCH_SIZE = 200
+# Сколько хранится журнал (старые события удаляются prune_events)
+EVENTS_RETENTION = timedelta(days=1)
+# Сколько id перед курсором перечитывается: транзакции фиксируются не в порядке
+# выдачи id, и событие с меньшим id может появиться позже уже отправленного
+EVENTS_REREAD_WINDOW = 100
+
+
+# --- Запись событий ---
+
+def record_event(kind, estimate_id=None, foreman_id=None):
+    ChangeEvent.objects.create(kind=kind, estimate_id=estimate_id, foreman_id=foreman_id)
+
+
+def record_estimate_changes(updated_ids=(), items_changed_ids=()):
+    """
+    События изменения смет и их позиций одним SELECT и одним INSERT.
+    Возвращает текущие версии смет; удаленные сметы пропускаются.
+    """
+    updated_ids, items_changed_ids = set(updated_ids), set(items_changed_ids)
+    rows = Estimate.objects.filter(pk__in=updated_ids | items_changed_ids).values_list(
+        'estimate_id', 'foreman_id', 'version'
+    )
+    versions = {}
+    events = []
+    for estimate_id, foreman_id, version in rows:
+        versions[estimate_id] = version
+        if estimate_id in updated_ids:
+            events.append(ChangeEvent(
+                kind=ChangeEvent.KIND_ESTIMATE_UPDATED, estimate_id=estimate_id, foreman_id=foreman_id
+            ))
+        if estimate_id in items_changed_ids:
+            events.append(ChangeEvent(
+                kind=ChangeEvent.KIND_ITEMS_CHANGED, estimate_id=estimate_id, foreman_id=foreman_id
+            ))
+    ChangeEvent.objects.bulk_create(events)
+    return versions
+
+
+def record_items_changed(estimate_ids):
+    """События изменения позиций для набора смет (массовые UPDATE без сигналов)"""
+    record_estimate_changes(items_changed_ids=estimate_ids)
+
+
+def prune_events(retention=EVENTS_RETENTION):
+    """Удаляет события старше срока хранения"""
+    return ChangeEvent.objects.filter(created_at__lt=timezone.now() - retention).delete()[0]
+
+
+# --- Чтение событий ---
+
+class EventCursor:
+    """
+    Позиция потока: наибольший отправленный id и уже отправленные (или
+    предшествовавшие подключению) id в окне перечитывания перед ним.
+    """
+
+    def __init__(self, after_id, seen=()):
+        self.after_id = after_id
+        self.seen = set(seen)
+
+    @property
+    def window_start(self):
+        return max(self.after_id - EVENTS_REREAD_WINDOW, 0)
+
+    def advance(self, event_ids):
+        event_ids = list(event_ids)
+        self.seen.update(event_ids)
+        self.after_id = max([self.after_id, *event_ids])
+        self.seen = {event_id for event_id in self.seen if event_id > self.window_start}
+
+
+def open_cursor(after_id):
+    """Курсор с позиции after_id: события окна перед ней считаются уже полученными"""
+    cursor = EventCursor(after_id)
+    cursor.seen.update(
+        ChangeEvent.objects.filter(event_id__gt=cursor.window_start, event_id__lte=after_id)
+        .values_list('event_id', flat=True)
+    )
+    return cursor
+
+
+def events_for_user(user, after_id, limit=EVENTS_BATCH_SIZE, exclude_ids=()):
+    """Новые события, видимые пользователю: менеджеру все, прорабу - по его сметам и каталогу"""
+    events = ChangeEvent.objects.filter(event_id__gt=after_id)
+    if exclude_ids:
+        events = events.exclude(event_id__in=exclude_ids)
+    if not user.is_manager:
+        events = events.filter(Q(foreman_id=user.user_id) | Q(kind=ChangeEvent.KIND_CATALOG_CHANGED))
+    return list(events.order_by('event_id')[:limit])
+
+
+def coalesce_events(events):
+    """
+    Сворачивает повторы внутри пачки: клиенту достаточно последнего события
+    каждого вида по каждой смете (импорт каталога дает сотни одинаковых событий).
+    """
+    latest = {}
+    for event in events:
+        latest[(event.kind, event.estimate_id)] = event
+    return sorted(latest.values(), key=lambda event: event.event_id)
+
+
+def event_payload(event):
+    payload = {'type': event.kind, 'created_at': event.created_at.isoformat()}
+    if event.estimate_id is not None:
+        payload['estimate_id'] = event.estimate_id
+    if event.kind == ChangeEvent.KIND_CATALOG_CHANGED:
+        payload['version'] = get_version(SECTION_CATALOG)
+    return payload
+
+
+def format_event(event):
+    data = json.dumps(event_payload(event), ensure_ascii=False)
+    return f'id: {event.event_id}\nevent: {event.kind}\ndata: {data}\n\n'
+
+
+def read_events(user, cursor):
+    """
+    Очередная порция потока: текст SSE и позиция курсора. Окно перед курсором
+    перечитывается, так что события поздно зафиксированных транзакций не теряются.
+    """
+    events = events_for_user(user, cursor.window_start, exclude_ids=cursor.seen)
+    if not events:
+        return '', cursor.after_id
+    chunk = ''.join(format_event(event) for event in coalesce_events(events))
+    cursor.advance(event.event_id for event in events)
+    return chunk, cursor.after_id
+
+
+def last_event_id():
+    return ChangeEvent.objects.order_by('-event_id').values_list('event_id', flat=True).first() or 0
+
+
+def authenticate_token(token):
+    """Пользователь по токену (EventSource не умеет передавать заголовки - токен может прийти в ?token=)"""
+    try:
+        auth_token = AuthToken.objects.select_related('user', 'user__role').get(token=token)
+    except (AuthToken.DoesNotExist, ValueError, ValidationError):
+        return None
+    return auth_token.user
+
+
+# --- ASGI-приложение ---
+
+def _request_params(scope):
+    headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope.get('headers', [])}
+    query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+
+    token = None
+    authorization = headers.get('authorization', '')
+    if authorization.startswith('Bearer '):
+        token = authorization.split(' ', 1)[1]
+    elif query.get('token'):
+        token = query['token'][0]
+
+    last_id = headers.get('last-event-id') or (query.get('last_event_id') or [None])[0]
+    try:
+        last_id = int(last_id) if last_id else None
+    except ValueError:
+        last_id = None
+    return token, last_id, headers.get('origin')
+
+
+def _cors_headers(origin):
+    # Поток обслуживается в обход middleware, поэтому CORS проверяем здесь
+    if origin and origin in getattr(settings, 'CORS_ALLOWED_ORIGINS', []):
+        return [
+            (b'access-control-allow-origin', origin.encode('latin-1')),
+            (b'access-control-allow-credentials', b'true'),
+        ]
+    return []
+
+
+async def _send_error(send, status, message, origin=None):
+    body = json.dumps({'error': message}, ensure_ascii=False).encode()
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json; charset=utf-8'), *_cors_headers(origin)],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def _call_and_close(func, *args):
+    try:
+        return func(*args)
+    finally:
+        # Потоки пула переиспользуются - соединение не должно оставаться открытым
+        connection.close()
+
+
+async def _read(func, *args):
+    """
+    Чтение журнала в пуле потоков (thread_sensitive=False): открытые
+    SSE-соединения не выстраиваются в очередь к общему потоку синхронного кода.
+    """
+    return await sync_to_async(_call_and_close, thread_sensitive=False)(func, *args)
+
+
+async def events_application(scope, receive, send):
+    """
+    SSE-поток: text/event-stream с событиями журнала.
+    Без Last-Event-ID поток начинается с текущего конца журнала.
+    """
+    token, after_id, origin = _request_params(scope)
+    user = await _read(authenticate_token, token) if token else None
+    if user is None:
+        await _send_error(send, 401, 'Учетные данные не предоставлены или неверны', origin)
+        return
+
+    if after_id is None:
+        after_id = await _read(last_event_id)
+    cursor = await _read(open_cursor, after_id)
+
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [
+            (b'content-type', b'text/event-stream; charset=utf-8'),
+            (b'cache-control', b'no-cache'),
+            # Отключаем буферизацию ответа в nginx
+            (b'x-accel-buffering', b'no'),
+            *_cors_headers(origin),
+        ],
+    })
+    # Клиент переподключается через 3 секунды после обрыва
+    await send({'type': 'http.response.body', 'body': b'retry: 3000\n\n', 'more_body': True})
+
+    disconnected = asyncio.Event()
+
+    async def wait_disconnect():
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                disconnected.set()
+                return
+
+    watcher = asyncio.ensure_future(wait_disconnect())
+    idle = 0.0
+    try:
+        while not disconnected.is_set():
+            chunk, _ = await _read(read_events, user, cursor)
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk.encode(), 'more_body': True})
+                idle = 0.0
+            elif idle >= HEARTBEAT_INTERVAL:
+                await send({'type': 'http.response.body', 'body': b': ping\n\n', 'more_body': True})
+                idle = 0.0
+
+            try:
+                await asyncio.wait_for(disconnected.wait(), timeout=POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                idle += POLL_INTERVAL
+    finally:
+        watcher.cancel()
@@ -0,0 +1,133 @@
+"""
+Финансовые агрегаты по сметам, рассчитываемые на стороне БД.
+"""
+
+from decimal import Decimal
+
+from django.core.cache import cache
+from django.db.models import Count, DecimalField, ExpressionWrapper, F, Q, Sum, Value
+from django.db.models.functions import Coalesce
+
+from .caching import SECTION_ESTIMATES, SECTION_PROJECTS, SECTION_STATUSES, versioned_key
+from .models import Estimate
+
+# Время жизни закэшированной сводки (при изменениях смет кэш инвалидируется раньше)
+FINANCE_SUMMARY_TIMEOUT = 300
+
+MONEY_FIELD = DecimalField(max_digits=14, decimal_places=2)
+CENT = Decimal('0.01')
+
+
+def _money(value):
+    return str(Decimal(value or 0).quantize(CENT))
+
+
+def _items_sum(price_field, item_filter):
+    return Coalesce(
+        Sum(
+            ExpressionWrapper(F('items__quantity') * F(f'items__{price_field}'), output_field=MONEY_FIELD),
+            filter=item_filter,
+        ),
+        Value(Decimal('0')),
+        output_field=MONEY_FIELD,
+    )
+
+
+def calculate_finance_summary(user):
+    """
+    Итоги по проектам и статусам одним GROUP BY запросом.
+    Прораб видит только свои сметы и только добавленные им работы.
+    """
+    estimates = Estimate.objects.all()
+    item_filter = None
+    if not user.is_manager:
+        estimates = estimates.filter(foreman=user)
+        item_filter = Q(items__added_by=user)
+
+    rows = estimates.values(
+        'project_id', 'project__project_name', 'status_id', 'status__status_name'
+    ).annotate(
+        estimates_count=Count('estimate_id', distinct=True),
+        total_cost=_items_sum('cost_price_per_unit', item_filter),
+        total_client=_items_sum('client_price_per_unit', item_filter),
+    ).order_by('project__project_name', 'project_id', 'status__status_name')
+
+    groups = []
+    totals = {'estimates_count': 0, 'total_cost': Decimal(0), 'total_client': Decimal(0)}
+    for row in rows:
+        cost = Decimal(row['total_cost'] or 0)
+        client = Decimal(row['total_client'] or 0)
+        groups.append({
+            'project_id': row['project_id'],
+            'project_name': row['project__project_name'],
+            'status_id': row['status_id'],
+            'status': row['status__status_name'],
+            'estimates_count': row['estimates_count'],
+            'total_cost': _money(cost),
+            'total_client': _money(client),
+            'total_profit': _money(client - cost),
+        })
+        totals['estimates_count'] += row['estimates_count']
+        totals['total_cost'] += cost
+        totals['total_client'] += client
+
+    return {
+        'groups': groups,
+        'totals': {
+            'estimates_count': totals['estimates_count'],
+            'total_cost': _money(totals['total_cost']),
+            'total_client': _money(totals['total_client']),
+            'total_profit': _money(totals['total_client'] - totals['total_cost']),
+        },
+    }
+
+
+def get_finance_summary(user):
+    """Сводка из кэша пользователя; кэш инвалидируется при изменении смет, проектов и статусов"""
+    key = versioned_key(
+        'finance_summary', user.user_id,
+        sections=(SECTION_ESTIMATES, SECTION_PROJECTS, SECTION_STATUSES),
+    )
+    summary = cache.get(key)
+    if summary is None:
+        summary = calculate_finance_summary(user)
+        cache.set(key, summary, FINANCE_SUMMARY_TIMEOUT)
+    return summary
+
+
+def category_breakdown(items):
+    """
+    Подытоги по категориям работ для набора позиций сметы одним GROUP BY.
+    Возвращает список словарей с Decimal-суммами в порядке названий категорий.
+    """
+    # Группировка только по снимку категории в позиции: без JOIN работ и категорий
+    rows = items.values('category_name').annotate(
+        items_count=Count('item_id'),
+        total_cost=Sum(ExpressionWrapper(F('quantity') * F('cost_price_per_unit'), output_field=MONEY_FIELD)),
+        total_client=Sum(ExpressionWrapper(F('quantity') * F('client_price_per_unit'), output_field=MONEY_FIELD)),
+    ).order_by('category_name')
+
+    breakdown = []
+    for row in rows:
+        cost = Decimal(row['total_cost'] or 0)
+        client = Decimal(row['total_client'] or 0)
+        breakdown.append({
+            'category_name': row['category_name'],
+            'items_count': row['items_count'],
+            'total_cost': cost,
+            'total_client': client,
+            'total_profit': client - cost,
+        })
+    return breakdown
+
+
+def serialize_breakdown(breakdown):
+    """Представление подытогов для API: суммы строками, как в остальных ответах"""
+    money_fields = ('total_cost', 'total_client', 'total_profit')
+    categories = [
+        {key: _money(value) if key in money_fields else value for key, value in row.items()}
+        for row in breakdown
+    ]
+    totals = {field: _money(sum((row[field] for row in breakdown), Decimal(0))) for field in money_fields}
+    totals['items_count'] = sum(row['items_count'] for row in breakdown)
+    return {'categories': categories, 'totals': totals}
@@ -0,0 +1,57 @@
+import dataclasses
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.dataset import DatasetOptions, generate_dataset
+from api.models import User
+
+
+class Command(BaseCommand):
+    help = (
+        'Создает синтетический набор данных для нагрузочных замеров: пользователи, проекты, '
+        'каталог работ, сметы и позиции (bulk_create, воспроизводимо при одинаковом --seed)'
+    )
+
+    def add_arguments(self, parser):
+        defaults = DatasetOptions()
+        parser.add_argument('--managers', type=int, default=defaults.managers, help='Число менеджеров')
+        parser.add_argument('--foremen', type=int, default=defaults.foremen, help='Число прорабов')
+        parser.add_argument('--projects', type=int, default=defaults.projects, help='Число проектов')
+        parser.add_argument('--assignments', type=int, default=defaults.assignments, help='Проектов на прораба')
+        parser.add_argument('--categories', type=int, default=defaults.categories, help='Число категорий работ')
+        parser.add_argument('--work-types', type=int, default=defaults.work_types, help='Число работ в каталоге')
+        parser.add_argument(
+            '--estimates-per-project', type=int, default=defaults.estimates_per_project, help='Смет на проект',
+        )
+        parser.add_argument(
+            '--items-per-estimate', type=int, default=defaults.items_per_estimate,
+            help='Среднее число позиций в смете',
+        )
+        parser.add_argument('--seed', type=int, default=defaults.seed, help='Начальное значение генератора')
+        parser.add_argument('--batch-size', type=int, default=defaults.batch_size, help='Размер пачки bulk_create')
+        parser.add_argument(
+            '--email-domain', default=defaults.email_domain, help='Домен адресов созданных пользователей',
+        )
+        parser.add_argument('--password', default=defaults.password, help='Пароль всех созданных пользователей')
+
+    def handle(self, *args, **options):
+        dataset_options = DatasetOptions(**{
+            field.name: options[field.name] for field in dataclasses.fields(DatasetOptions)
+        })
+        for name in ('managers', 'foremen', 'projects', 'categories', 'work_types', 'batch_size'):
+            if getattr(dataset_options, name) < 1:
+                raise CommandError(f'--{name.replace("_", "-")} должен быть больше 0')
+        for name in ('assignments', 'estimates_per_project', 'items_per_estimate'):
+            if getattr(dataset_options, name) < 0:
+                raise CommandError(f'--{name.replace("_", "-")} не может быть отрицательным')
+        if User.objects.filter(email__endswith=f'@{dataset_options.email_domain}').exists():
+            raise CommandError(
+                f'Пользователи @{dataset_options.email_domain} уже есть: укажите другой --email-domain или пустую базу'
+            )
+
+        started = time.monotonic()
+        counts = generate_dataset(dataset_options, log=self.stdout.write)
+        for model_name, count in counts.items():
+            self.stdout.write(f'{model_name}: {count}')
+        self.stdout.write(self.style.SUCCESS(f'Набор данных создан за {time.monotonic() - started:.1f} с'))
@@ -0,0 +1,19 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from api.events import EVENTS_RETENTION, prune_events
+
+
+class Command(BaseCommand):
+    help = 'Удаляет старые записи журнала изменений (поток /events/)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--hours', type=int, default=int(EVENTS_RETENTION.total_seconds() // 3600),
+            help='Срок хранения событий в часах',
+        )
+
+    def handle(self, *args, **options):
+        deleted = prune_events(timedelta(hours=options['hours']))
+        self.stdout.write(f'Удалено событий: {deleted}')
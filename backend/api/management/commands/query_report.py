@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand
+
+from api import querystats
+
+
+class Command(BaseCommand):
+    help = 'Отчет по SQL-запросам воркеров: самые затратные отпечатки и медленные запросы с планами'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=20, help='Число отпечатков в отчете')
+        parser.add_argument(
+            '--order', choices=('total', 'count', 'max'), default='total',
+            help='Сортировка: суммарное время, число выполнений или максимальное время',
+        )
+        parser.add_argument('--slow', action='store_true', help='Вывести медленные запросы с планами EXPLAIN')
+
+    def handle(self, *args, **options):
+        stats, slow = querystats.collect()
+        if not stats:
+            self.stdout.write('Нет данных: включите QUERY_STATS_ENABLED и выполните запросы к API')
+            return
+
+        sort_key = {'total': 'total_ms', 'count': 'count', 'max': 'max_ms'}[options['order']]
+        top = sorted(stats.items(), key=lambda item: item[1][sort_key], reverse=True)[:options['top']]
+        self.stdout.write(f'Отпечатков: {len(stats)}, выполнений: {sum(item["count"] for item in stats.values())}')
+        for key, item in top:
+            self.stdout.write('')
+            self.stdout.write(
+                f'[{key}] выполнений {item["count"]}, всего {item["total_ms"]:.1f} мс, '
+                f'среднее {item["total_ms"] / item["count"]:.2f} мс, макс. {item["max_ms"]:.1f} мс'
+            )
+            views = sorted(item['views'].items(), key=lambda view: view[1], reverse=True)[:3]
+            if views:
+                self.stdout.write('  view: ' + ', '.join(f'{view} ({count})' for view, count in views))
+            self.stdout.write(f'  {item["fingerprint"]}')
+
+        if options['slow']:
+            self.stdout.write('')
+            self.stdout.write(f'Медленные запросы: {len(slow)}')
+            for query in sorted(slow, key=lambda query: query['duration_ms'], reverse=True):
+                self.stdout.write('')
+                self.stdout.write(f'[{query["fingerprint_id"]}] {query["duration_ms"]} мс, view: {query["view"]}')
+                self.stdout.write(f'  {query["sql"]}')
+                self.stdout.write(f'  параметры: {query["params"]}')
+                for line in (query['plan'] or 'план недоступен').splitlines():
+                    self.stdout.write(f'    {line}')
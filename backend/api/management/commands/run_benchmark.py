@@ -0,0 +1,95 @@
+import dataclasses
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.benchmark import PERCENTILES, BenchmarkOptions, compare, run_benchmark
+
+
+class Command(BaseCommand):
+    help = (
+        'Нагрузочный замер сценариями прорабов и менеджеров на данных generate_dataset: '
+        'пропускная способность и перцентили времени ответа по шагам'
+    )
+
+    def add_arguments(self, parser):
+        defaults = BenchmarkOptions()
+        parser.add_argument('--users', type=int, default=defaults.users, help='Число виртуальных пользователей')
+        parser.add_argument(
+            '--foreman-share', type=float, default=defaults.foreman_share, help='Доля прорабов (0..1)',
+        )
+        parser.add_argument('--duration', type=float, default=defaults.duration, help='Длительность замера, секунды')
+        parser.add_argument('--iterations', type=int, help='Сценариев на пользователя (вместо --duration)')
+        parser.add_argument(
+            '--think-time', type=float, default=defaults.think_time, help='Средняя пауза между шагами, секунды',
+        )
+        parser.add_argument('--email-domain', default=defaults.email_domain, help='Домен пользователей набора данных')
+        parser.add_argument('--password', default=defaults.password, help='Пароль пользователей набора данных')
+        parser.add_argument(
+            '--base-url', help='Адрес запущенного сервера (например, http://127.0.0.1:8000); '
+                               'по умолчанию запросы выполняются в процессе',
+        )
+        parser.add_argument('--seed', type=int, default=defaults.seed, help='Начальное значение генератора')
+        parser.add_argument('--output', help='Сохранить результат в JSON')
+        parser.add_argument('--baseline', help='JSON предыдущего замера для сравнения')
+        parser.add_argument(
+            '--threshold', type=float, default=20.0, help='Допустимое ухудшение относительно базового, %%',
+        )
+        parser.add_argument(
+            '--fail-on-regression', action='store_true', help='Завершиться с ошибкой при ухудшении больше --threshold',
+        )
+
+    def handle(self, *args, **options):
+        benchmark_options = BenchmarkOptions(**{
+            field.name: options[field.name] for field in dataclasses.fields(BenchmarkOptions)
+        })
+        if benchmark_options.users < 1:
+            raise CommandError('--users должен быть больше 0')
+        if not 0 <= benchmark_options.foreman_share <= 1:
+            raise CommandError('--foreman-share должен быть от 0 до 1')
+
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline'], encoding='utf-8') as baseline_file:
+                baseline = json.load(baseline_file)
+
+        try:
+            result = run_benchmark(benchmark_options)
+        except ValueError as e:
+            raise CommandError(str(e))
+        self.print_result(result)
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as output_file:
+                json.dump(result, output_file, ensure_ascii=False, indent=2)
+            self.stdout.write(f'Результат сохранен в {options["output"]}')
+
+        if baseline is not None:
+            rows, regressed = compare(result, baseline, options['threshold'])
+            self.stdout.write('')
+            self.stdout.write(f'Сравнение с {options["baseline"]}:')
+            if baseline.get('options') != result['options']:
+                self.stdout.write(self.style.WARNING('  Параметры замеров различаются - сравнение приблизительное'))
+            for name, old, new, change in rows:
+                self.stdout.write(f'  {name:<40} {old:>10} -> {new:>10} ({change:+.1f}%)')
+            if regressed:
+                message = f'Ухудшение больше {options["threshold"]}% относительно базового замера'
+                if options['fail_on_regression']:
+                    raise CommandError(message)
+                self.stdout.write(self.style.WARNING(message))
+
+    def print_result(self, result):
+        columns = ['count', 'errors', 'mean_ms'] + [f'p{percent}_ms' for percent in PERCENTILES] + ['max_ms']
+        self.stdout.write(
+            f'Запросов: {result["requests"]}, ошибок: {result["errors"]}, '
+            f'{result["throughput"]} запросов/с за {result["elapsed"]} с'
+        )
+        self.stdout.write(f'{"шаг":<20}' + ''.join(f'{column:>10}' for column in columns) + f'{"SQL":>8}')
+        for step, stats in result['endpoints'].items():
+            self.stdout.write(
+                f'{step:<20}' + ''.join(f'{stats[column]:>10}' for column in columns)
+                + f'{stats.get("db_queries", "-"):>8}'
+            )
+        for step, stats in result['endpoints'].items():
+            if 'first_error' in stats:
+                self.stdout.write(self.style.WARNING(f'{step}: {stats["first_error"]}'))
@@ -0,0 +1,212 @@
+"""
+Метрики приложения в памяти процесса.
+
+Счетчики и гистограммы накапливаются в каждом процессе (воркере gunicorn)
+и периодически сохраняются в общий каталог METRICS_DIR - по файлу на процесс.
+/metrics/ суммирует файлы всех живых воркеров и отдает их в текстовом
+формате Prometheus.
+"""
+
+import contextlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+
+# Границы гистограмм
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+# Описания метрик для # HELP
+METRIC_HELP = {
+    'http_requests_total': 'Число запросов по view, методу и коду ответа',
+    'http_request_duration_seconds': 'Время обработки запроса',
+    'http_request_db_queries': 'Число SQL-запросов на HTTP-запрос',
+    'cache_requests_total': 'Обращения к кэшам приложения (result: hit/miss)',
+    'operation_duration_seconds': 'Время экспорта и импорта файлов',
+}
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_last_flush = [0.0]
+
+
+def _key(name, labels):
+    return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+
+def inc(name, value=1, **labels):
+    """Увеличивает счетчик"""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, value, buckets=DURATION_BUCKETS, **labels):
+    """Добавляет значение в гистограмму"""
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {
+                'buckets': list(buckets), 'counts': [0] * len(buckets), 'sum': 0.0, 'count': 0,
+            }
+        for index, bound in enumerate(histogram['buckets']):
+            if value <= bound:
+                histogram['counts'][index] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+
+def record_cache(cache_name, hit):
+    inc('cache_requests_total', cache=cache_name, result='hit' if hit else 'miss')
+
+
+class timed(contextlib.ContextDecorator):
+    """Замер длительности операции в гистограмму (контекстный менеджер или декоратор)"""
+
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        observe(self.name, time.perf_counter() - self.started, **self.labels)
+        return False
+
+
+def reset():
+    """Сбрасывает метрики процесса (для тестов)"""
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+        _last_flush[0] = 0.0
+
+
+# --- Общий каталог воркеров ---
+
+def metrics_dir():
+    return getattr(settings, 'METRICS_DIR', None) or os.path.join(tempfile.gettempdir(), 'estimate-metrics')
+
+
+def snapshot():
+    with _lock:
+        return {
+            'counters': [[name, list(labels), value] for (name, labels), value in _counters.items()],
+            'histograms': [
+                [name, list(labels), {**histogram, 'counts': list(histogram['counts'])}]
+                for (name, labels), histogram in _histograms.items()
+            ],
+        }
+
+
+def write_worker_file(prefix, data):
+    """Атомарно сохраняет данные текущего процесса в METRICS_DIR/<prefix>-<pid>.json"""
+    directory = metrics_dir()
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'{prefix}-{os.getpid()}.json')
+    with tempfile.NamedTemporaryFile('w', dir=directory, suffix='.tmp', delete=False) as tmp:
+        json.dump(data, tmp)
+    os.replace(tmp.name, path)
+
+
+def read_worker_files(prefix):
+    """Данные всех процессов, обновлявшихся за последние METRICS_STALE_SECONDS"""
+    directory = metrics_dir()
+    if not os.path.isdir(directory):
+        return []
+    stale_before = time.time() - getattr(settings, 'METRICS_STALE_SECONDS', 600)
+    result = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if not (name.startswith(f'{prefix}-') and name.endswith('.json')):
+            continue
+        if os.path.getmtime(path) < stale_before:
+            # Воркер давно завершился
+            with contextlib.suppress(OSError):
+                os.remove(path)
+            continue
+        try:
+            with open(path) as worker_file:
+                result.append(json.load(worker_file))
+        except (OSError, ValueError):
+            continue
+    return result
+
+
+def flush(force=False):
+    """Сохраняет метрики процесса не чаще METRICS_FLUSH_INTERVAL секунд"""
+    now = time.monotonic()
+    if not force and now - _last_flush[0] < getattr(settings, 'METRICS_FLUSH_INTERVAL', 5):
+        return
+    _last_flush[0] = now
+    write_worker_file('worker', snapshot())
+
+
+def collect():
+    """Сумма метрик всех живых воркеров"""
+    flush(force=True)
+    counters = {}
+    histograms = {}
+
+    for data in read_worker_files('worker'):
+        for metric, labels, value in data['counters']:
+            key = (metric, tuple(tuple(label) for label in labels))
+            counters[key] = counters.get(key, 0) + value
+        for metric, labels, histogram in data['histograms']:
+            key = (metric, tuple(tuple(label) for label in labels))
+            total = histograms.get(key)
+            if total is None or total['buckets'] != histogram['buckets']:
+                histograms[key] = {**histogram, 'counts': list(histogram['counts'])}
+                continue
+            total['counts'] = [a + b for a, b in zip(total['counts'], histogram['counts'])]
+            total['sum'] += histogram['sum']
+            total['count'] += histogram['count']
+
+    return counters, histograms
+
+
+# --- Текстовый формат Prometheus ---
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    formatted = []
+    for label, value in pairs:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        formatted.append(f'{label}="{value}"')
+    return '{' + ','.join(formatted) + '}'
+
+
+def render(counters, histograms):
+    lines = []
+    described = set()
+
+    def describe(metric, metric_type):
+        if metric not in described:
+            described.add(metric)
+            if metric in METRIC_HELP:
+                lines.append(f'# HELP {metric} {METRIC_HELP[metric]}')
+            lines.append(f'# TYPE {metric} {metric_type}')
+
+    for (metric, labels), value in sorted(counters.items()):
+        describe(metric, 'counter')
+        lines.append(f'{metric}{_format_labels(labels)} {value}')
+
+    for (metric, labels), histogram in sorted(histograms.items()):
+        describe(metric, 'histogram')
+        for bound, count in zip(histogram['buckets'], histogram['counts']):
+            lines.append(f'{metric}_bucket{_format_labels(labels, [("le", bound)])} {count}')
+        lines.append(f'{metric}_bucket{_format_labels(labels, [("le", "+Inf")])} {histogram["count"]}')
+        lines.append(f'{metric}_sum{_format_labels(labels)} {histogram["sum"]}')
+        lines.append(f'{metric}_count{_format_labels(labels)} {histogram["count"]}')
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,251 @@
+"""
+Middleware API.
+"""
+
+import hashlib
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+from django.http import HttpResponse, JsonResponse
+
+from . import metrics, querystats
+from .audit import buffer_changes
+from .timing import RequestTimings, ViewTimingStats, timing_logger
+
+security_logger = logging.getLogger('security')
+
+IDEMPOTENCY_HEADER = 'HTTP_IDEMPOTENCY_KEY'
+IDEMPOTENT_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+
+
+class IdempotencyKeyMiddleware:
+    """
+    Повторы изменяющих запросов с заголовком Idempotency-Key.
+
+    Первый ответ сохраняется в кэше на IDEMPOTENCY_KEY_TTL секунд и
+    возвращается на повторы с тем же ключом (заголовок Idempotency-Replayed).
+    Ключ действует в пределах пользователя (токена), метода и пути.
+    Одновременные повторы сериализуются блокировкой в кэше: работу выполняет
+    только первый запрос, остальные ждут его ответ.
+    """
+    PATH_PREFIX = '/api/v1/'
+    MAX_KEY_LENGTH = 255
+    # Сколько повтор ждет завершения первого запроса
+    WAIT_TIMEOUT = 10
+    WAIT_INTERVAL = 0.1
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.ttl = getattr(settings, 'IDEMPOTENCY_KEY_TTL', 24 * 60 * 60)
+        self.lock_timeout = getattr(settings, 'IDEMPOTENCY_LOCK_TIMEOUT', 120)
+
+    def __call__(self, request):
+        key = request.META.get(IDEMPOTENCY_HEADER)
+        if not key or request.method not in IDEMPOTENT_METHODS or not request.path.startswith(self.PATH_PREFIX):
+            return self.get_response(request)
+        if len(key) > self.MAX_KEY_LENGTH:
+            return JsonResponse({'error': 'Слишком длинный Idempotency-Key'}, status=400)
+
+        scope = hashlib.sha256('\n'.join([
+            request.META.get('HTTP_AUTHORIZATION', ''), request.method, request.path, key,
+        ]).encode()).hexdigest()
+        fingerprint = hashlib.sha256(request.body).hexdigest()
+        result_key = f'idempotency:{scope}'
+        lock_key = f'idempotency_lock:{scope}'
+
+        stored = cache.get(result_key)
+        if stored is None:
+            if not cache.add(lock_key, 1, self.lock_timeout):
+                stored = self.wait_for_result(result_key, lock_key)
+                if stored is None:
+                    return JsonResponse(
+                        {'error': 'Запрос с этим Idempotency-Key еще выполняется'}, status=409
+                    )
+            else:
+                try:
+                    # Первый запрос мог сохранить ответ и снять блокировку между get и add
+                    stored = cache.get(result_key)
+                    if stored is None:
+                        response = self.get_response(request)
+                        self.store(result_key, fingerprint, response)
+                        return response
+                finally:
+                    cache.delete(lock_key)
+
+        if stored['fingerprint'] != fingerprint:
+            security_logger.warning(
+                f"IDEMPOTENCY: ключ повторно использован с другим телом запроса {request.method} {request.path}"
+            )
+            return JsonResponse(
+                {'error': 'Idempotency-Key уже использован для другого запроса'}, status=422
+            )
+        return self.replay(stored)
+
+    def wait_for_result(self, result_key, lock_key):
+        deadline = time.monotonic() + self.WAIT_TIMEOUT
+        while time.monotonic() < deadline:
+            stored = cache.get(result_key)
+            if stored is not None:
+                return stored
+            if cache.get(lock_key) is None:
+                # Первый запрос завершился ошибкой сервера - результат не сохранен
+                return cache.get(result_key)
+            time.sleep(self.WAIT_INTERVAL)
+        return None
+
+    def store(self, result_key, fingerprint, response):
+        # Ошибки сервера не сохраняем: повтор должен выполнить запрос заново
+        if response.status_code >= 500 or response.streaming:
+            return
+        cache.set(result_key, {
+            'fingerprint': fingerprint,
+            'status': response.status_code,
+            'content': response.content,
+            'content_type': response.get('Content-Type'),
+        }, self.ttl)
+
+    @staticmethod
+    def replay(stored):
+        response = HttpResponse(stored['content'], status=stored['status'], content_type=stored['content_type'])
+        response['Idempotency-Replayed'] = 'true'
+        return response
+
+
+class AuditBufferMiddleware:
+    """
+    Журнал аудита запроса пишется одним bulk_create после ответа view
+    (или передается фоновому потоку, см. api.audit).
+    Должен стоять после auditlog.middleware.AuditlogMiddleware: адрес клиента
+    и correlation id берутся из его контекста.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with buffer_changes() as buffer:
+            try:
+                response = self.get_response(request)
+            finally:
+                # DRF сохраняет аутентифицированного пользователя в исходном запросе
+                buffer.flush(actor_email=getattr(getattr(request, 'user', None), 'email', None))
+        return response
+
+
+class RequestTimingMiddleware:
+    """
+    Замеры запроса (REQUEST_TIMING_ENABLED): число SQL-запросов и время БД через
+    connection.execute_wrapper, время view и рендеринга ответа DRF, аутентификация
+    (см. CustomTokenAuthentication). Результат - заголовок Server-Timing
+    (виден во вкладке Network инструментов браузера) и сводка по view в журнале api.timing.
+    """
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'REQUEST_TIMING_ENABLED', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.stats = ViewTimingStats(getattr(settings, 'REQUEST_TIMING_LOG_EVERY', 100))
+        self.slow_ms = getattr(settings, 'REQUEST_TIMING_SLOW_MS', 1000)
+
+    def __call__(self, request):
+        timings = request.timings = RequestTimings()
+        with connection.execute_wrapper(timings.track_query):
+            response = self.get_response(request)
+        timings.finish()
+
+        response['Server-Timing'] = timings.server_timing()
+        origin = request.headers.get('Origin')
+        if origin and origin in getattr(settings, 'CORS_ALLOWED_ORIGINS', ()):
+            # Без этого заголовка браузер скрывает Server-Timing от фронтенда на другом origin
+            response['Timing-Allow-Origin'] = origin
+
+        view = self.view_name(request)
+        self.stats.record(view, timings)
+        if timings.total >= self.slow_ms:
+            timing_logger.warning(
+                "МЕДЛЕННЫЙ ЗАПРОС %s: %.1f мс, БД %.1f мс, SQL-запросов %d",
+                view, timings.total, timings.db_time, timings.queries,
+            )
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.timings.start('view')
+
+    def process_template_response(self, request, response):
+        # Ответы DRF рендерятся после view: отдельная фаза render
+        request.timings.stop('view')
+        request.timings.start('render')
+        response.add_post_render_callback(lambda rendered: request.timings.stop('render'))
+        return response
+
+    @staticmethod
+    def view_name(request):
+        match = getattr(request, 'resolver_match', None)
+        name = match.view_name if match else 'unresolved'
+        return f'{request.method} {name}'
+
+
+class MetricsMiddleware:
+    """
+    Метрики запросов (METRICS_ENABLED): число запросов, гистограммы времени
+    ответа и числа SQL-запросов по имени URL и методу (см. api.metrics).
+    """
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'METRICS_ENABLED', True):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        queries = [0]
+
+        def count_query(execute, sql, params, many, context):
+            queries[0] += 1
+            return execute(sql, params, many, context)
+
+        started = time.perf_counter()
+        with connection.execute_wrapper(count_query):
+            response = self.get_response(request)
+        duration = time.perf_counter() - started
+
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match else 'unresolved'
+        metrics.inc('http_requests_total', view=view, method=request.method, status=response.status_code)
+        metrics.observe('http_request_duration_seconds', duration, view=view, method=request.method)
+        metrics.observe(
+            'http_request_db_queries', queries[0], buckets=metrics.QUERY_COUNT_BUCKETS,
+            view=view, method=request.method,
+        )
+        metrics.flush()
+        return response
+
+
+class QueryStatsMiddleware:
+    """
+    Статистика SQL-запросов по отпечаткам (QUERY_STATS_ENABLED): число, суммарное
+    и максимальное время; запросы дольше QUERY_STATS_SLOW_MS сохраняются с планом
+    EXPLAIN и view. Отчет - команда query_report (см. api.querystats).
+    """
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'QUERY_STATS_ENABLED', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.recorder = querystats.QueryRecorder(connection.alias)
+
+    def __call__(self, request):
+        token = querystats.current_view.set(None)
+        try:
+            with connection.execute_wrapper(self.recorder):
+                response = self.get_response(request)
+        finally:
+            querystats.current_view.reset(token)
+        querystats.flush()
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        querystats.current_view.set(f'{request.method} {request.resolver_match.view_name}')
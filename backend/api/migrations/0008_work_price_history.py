@@ -0,0 +1,56 @@
+# Generated by Django 5.2.5 on 2026-10-19 13:07
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def populate_price_history(apps, schema_editor):
+    """
+    Заполняет историю текущими ценами: одна запись на работу,
+    действующая с момента последнего обновления цены.
+    """
+    WorkPrice = apps.get_model('api', 'WorkPrice')
+    WorkPriceHistory = apps.get_model('api', 'WorkPriceHistory')
+
+    batch = []
+    for price in WorkPrice.objects.all().iterator(chunk_size=1000):
+        batch.append(WorkPriceHistory(
+            work_type_id=price.work_type_id,
+            valid_from=price.updated_at,
+            cost_price=price.cost_price,
+            client_price=price.client_price,
+        ))
+        if len(batch) >= 1000:
+            WorkPriceHistory.objects.bulk_create(batch)
+            batch = []
+    if batch:
+        WorkPriceHistory.objects.bulk_create(batch)
+
+
+def clear_price_history(apps, schema_editor):
+    apps.get_model('api', 'WorkPriceHistory').objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_populate_added_by_field'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WorkPriceHistory',
+            fields=[
+                ('history_id', models.AutoField(primary_key=True, serialize=False)),
+                ('valid_from', models.DateTimeField(default=django.utils.timezone.now)),
+                ('cost_price', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('client_price', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('work_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='price_history', to='api.worktype')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['work_type', 'valid_from'], name='api_price_history_wt_from'), models.Index(fields=['valid_from'], name='api_price_history_from')],
+            },
+        ),
+        migrations.RunPython(populate_price_history, clear_price_history),
+    ]
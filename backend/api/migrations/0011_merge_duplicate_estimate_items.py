@@ -0,0 +1,73 @@
+# Generated by Django 5.2.5 on 2026-10-19 13:28
+
+from decimal import Decimal
+import logging
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def merge_duplicate_items(apps, schema_editor):
+    """
+    Объединяет позиции с одинаковыми сметой, работой и автором перед созданием
+    уникального ограничения. Количество суммируется, цены становятся
+    средневзвешенными, запросы на изменение цены и материалы переносятся на
+    оставшуюся позицию. При одинаковых ценах итог не меняется; при разных
+    средневзвешенная цена округляется до копейки, и итог может сдвинуться
+    (1 × 10.00 + 2 × 10.01 = 30.02, а 3 × 10.01 = 30.03) - такие группы
+    записываются в журнал с прежним и новым итогом.
+    """
+    logger = logging.getLogger('audit')
+    EstimateItem = apps.get_model('api', 'EstimateItem')
+    PriceChangeRequest = apps.get_model('api', 'PriceChangeRequest')
+    EstimateMaterialItem = apps.get_model('api', 'EstimateMaterialItem')
+    cent = Decimal('0.01')
+
+    duplicates = EstimateItem.objects.filter(added_by__isnull=False).values(
+        'estimate_id', 'work_type_id', 'added_by_id'
+    ).annotate(items_count=Count('item_id')).filter(items_count__gt=1)
+
+    for group in duplicates.iterator():
+        items = list(EstimateItem.objects.filter(
+            estimate_id=group['estimate_id'],
+            work_type_id=group['work_type_id'],
+            added_by_id=group['added_by_id'],
+        ).order_by('item_id'))
+        kept, merged = items[0], items[1:]
+        merged_ids = [item.item_id for item in merged]
+
+        quantity = sum((item.quantity for item in items), Decimal(0))
+        old_totals = (
+            sum((item.quantity * item.cost_price_per_unit for item in items), Decimal(0)),
+            sum((item.quantity * item.client_price_per_unit for item in items), Decimal(0)),
+        )
+        if quantity:
+            kept.cost_price_per_unit = (old_totals[0] / quantity).quantize(cent)
+            kept.client_price_per_unit = (old_totals[1] / quantity).quantize(cent)
+        kept.quantity = quantity
+        kept.save(update_fields=['quantity', 'cost_price_per_unit', 'client_price_per_unit'])
+        new_totals = (quantity * kept.cost_price_per_unit, quantity * kept.client_price_per_unit)
+        if new_totals != old_totals:
+            logger.warning(
+                'Объединение позиций %s сметы %s: итоги (себестоимость, клиент) %s -> %s из-за округления цены',
+                [item.item_id for item in items], group['estimate_id'], old_totals, new_totals,
+            )
+
+        PriceChangeRequest.objects.filter(estimate_item_id__in=merged_ids).update(estimate_item_id=kept.item_id)
+        EstimateMaterialItem.objects.filter(estimate_item_id__in=merged_ids).update(estimate_item_id=kept.item_id)
+        EstimateItem.objects.filter(item_id__in=merged_ids).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_estimate_version_sync_mutation'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_items, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='estimateitem',
+            constraint=models.UniqueConstraint(fields=('estimate', 'work_type', 'added_by'), name='api_estimate_item_unique_work'),
+        ),
+    ]
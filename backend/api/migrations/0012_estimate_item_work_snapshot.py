@@ -0,0 +1,58 @@
+# Generated by Django 5.2.5 on 2026-10-19 13:34
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+BATCH_SIZE = 1000
+
+
+def backfill_work_snapshot(apps, schema_editor):
+    """
+    Заполняет снимок работы в существующих позициях пакетами по диапазону item_id,
+    одним UPDATE с подзапросами на пакет.
+    """
+    EstimateItem = apps.get_model('api', 'EstimateItem')
+    WorkType = apps.get_model('api', 'WorkType')
+    work_type = WorkType.objects.filter(pk=OuterRef('work_type_id'))
+
+    last_id = 0
+    while True:
+        batch = list(
+            EstimateItem.objects.filter(item_id__gt=last_id).order_by('item_id').values_list('item_id', flat=True)[:BATCH_SIZE]
+        )
+        if not batch:
+            break
+        EstimateItem.objects.filter(item_id__gte=batch[0], item_id__lte=batch[-1]).update(
+            work_name=Subquery(work_type.values('work_name')[:1]),
+            unit_of_measurement=Subquery(work_type.values('unit_of_measurement')[:1]),
+            category_name=Subquery(work_type.values('category__category_name')[:1]),
+        )
+        last_id = batch[-1]
+
+
+class Migration(migrations.Migration):
+    # Пакеты фиксируются по отдельности, без одной длинной транзакции на всю таблицу
+    atomic = False
+
+    dependencies = [
+        ('api', '0011_merge_duplicate_estimate_items'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='estimateitem',
+            name='category_name',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='estimateitem',
+            name='unit_of_measurement',
+            field=models.CharField(blank=True, default='', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='estimateitem',
+            name='work_name',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.RunPython(backfill_work_snapshot, migrations.RunPython.noop),
+    ]
@@ -1,5 +1,7 @@
 
 from django.db import models
+from django.utils import timezone
+from django.utils.functional import cached_property
 import uuid
 
 # Модели, основанные на BD.MD
@@ -30,6 +32,17 @@ class User(models.Model):
     def is_authenticated(self):
         return True
 
+    # Права по роли вычисляются один раз для объекта пользователя (на запрос)
+    @cached_property
+    def is_manager(self):
+        from .registry import ROLE_MANAGER
+        return self.role.role_name == ROLE_MANAGER
+
+    @cached_property
+    def is_foreman(self):
+        from .registry import ROLE_FOREMAN
+        return self.role.role_name == ROLE_FOREMAN
+
 class Client(models.Model):
     client_id = models.AutoField(primary_key=True)
     client_name = models.CharField(max_length=255)
@@ -66,6 +79,26 @@ class WorkPrice(models.Model):
     client_price = models.DecimalField(max_digits=10, decimal_places=2)
     updated_at = models.DateTimeField(auto_now=True)
 
+class WorkPriceHistory(models.Model):
+    """
+    История цен работ (только добавление записей).
+    Запись создается при каждом изменении WorkPrice и действует с valid_from
+    до следующей записи этой же работы.
+    """
+    history_id = models.AutoField(primary_key=True)
+    work_type = models.ForeignKey(WorkType, on_delete=models.CASCADE, related_name='price_history')
+    valid_from = models.DateTimeField(default=timezone.now)
+    cost_price = models.DecimalField(max_digits=10, decimal_places=2)
+    client_price = models.DecimalField(max_digits=10, decimal_places=2)
+
+    class Meta:
+        indexes = [
+            # Поиск цены работы на дату и ряды цен по работе
+            models.Index(fields=['work_type', 'valid_from'], name='api_price_history_wt_from'),
+            # Диапазонные выборки для отчетов
+            models.Index(fields=['valid_from'], name='api_price_history_from'),
+        ]
+
 # НОВАЯ СУЩНОСТЬ ДЛЯ СТАТУСОВ
 class Status(models.Model):
     status_id = models.AutoField(primary_key=True)
@@ -84,6 +117,8 @@ class Estimate(models.Model):
     foreman = models.ForeignKey(User, related_name='managed_estimates', on_delete=models.SET_NULL, blank=True, null=True)
     client = models.ForeignKey(Client, on_delete=models.SET_NULL, blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Увеличивается при каждом изменении сметы или ее работ (обнаружение конфликтов офлайн-синхронизации)
+    version = models.PositiveIntegerField(default=1)
 
 class EstimateItem(models.Model):
     item_id = models.AutoField(primary_key=True)
@@ -93,6 +128,52 @@ class EstimateItem(models.Model):
     cost_price_per_unit = models.DecimalField(max_digits=10, decimal_places=2)
     client_price_per_unit = models.DecimalField(max_digits=10, decimal_places=2)
     added_by = models.ForeignKey(User, on_delete=models.RESTRICT, null=True, blank=True, related_name='added_estimate_items')  # Кто добавил работу
+    # Снимок работы на момент добавления: чтение позиций без JOIN, переименование работы не меняет старые сметы
+    work_name = models.CharField(max_length=255, blank=True, default='')
+    unit_of_measurement = models.CharField(max_length=20, blank=True, default='')
+    category_name = models.CharField(max_length=255, blank=True, default='')
+
+    class Meta:
+        constraints = [
+            # Повторное добавление работы тем же автором увеличивает количество существующей позиции
+            models.UniqueConstraint(fields=['estimate', 'work_type', 'added_by'], name='api_estimate_item_unique_work'),
+        ]
+
+class SyncMutation(models.Model):
+    """
+    Результаты примененных офлайн-изменений (/sync/).
+    Повторная отправка изменения с тем же client_id возвращает сохраненный результат.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sync_mutations')
+    client_id = models.CharField(max_length=100)
+    result = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('user', 'client_id')
+
+class ChangeEvent(models.Model):
+    """
+    Журнал изменений для потока событий (/events/).
+    Клиенты читают записи с event_id больше последнего полученного.
+    """
+    KIND_ESTIMATE_UPDATED = 'estimate_updated'
+    KIND_ESTIMATE_DELETED = 'estimate_deleted'
+    KIND_ITEMS_CHANGED = 'items_changed'
+    KIND_CATALOG_CHANGED = 'catalog_changed'
+
+    event_id = models.BigAutoField(primary_key=True)
+    kind = models.CharField(max_length=30)
+    # Без внешних ключей: событие об удаленной смете должно остаться в журнале
+    estimate_id = models.IntegerField(blank=True, null=True)
+    foreman_id = models.IntegerField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # Очистка старых событий
+            models.Index(fields=['created_at'], name='api_change_event_created'),
+        ]
 
 class PriceChangeRequest(models.Model):
     request_id = models.AutoField(primary_key=True)
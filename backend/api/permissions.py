@@ -31,7 +31,7 @@ class IsManager(BasePermission):
             request.user and
             request.user.is_authenticated and
             hasattr(request.user, 'role') and
-            request.user.role.role_name == 'менеджер'
+            request.user.is_manager
         )
         
         if not has_manager_role and request.user and request.user.is_authenticated:
@@ -49,16 +49,17 @@ class CanAccessEstimate(BasePermission):
     """
     def has_object_permission(self, request, view, obj):
         # Менеджеры имеют доступ ко всем сметам
-        if request.user.role.role_name == 'менеджер':
+        if request.user.is_manager:
             return True
             
-        # Прорабы имеют доступ только к сметам, где они назначены прорабом
-        has_access = obj.foreman == request.user
+        # Прорабы имеют доступ только к сметам, где они назначены прорабом.
+        # Сравниваем id, чтобы не загружать прораба сметы отдельным запросом
+        has_access = obj.foreman_id == request.user.user_id
         
         if not has_access:
             security_logger.warning(
                 f"КРИТИЧНО: Попытка несанкционированного доступа к смете {obj.estimate_id} "
-                f"пользователем {request.user.email}. Владелец сметы: {obj.foreman.email}"
+                f"пользователем {request.user.email}. Прораб сметы: {obj.foreman_id}"
             )
         
         return has_access
@@ -74,7 +75,7 @@ class CanCreatePriceRequest(BasePermission):
             request.user and 
             request.user.is_authenticated and 
             hasattr(request.user, 'role') and
-            request.user.role.role_name == 'прораб'
+            request.user.is_foreman
         )
         
         if not has_permission and request.user and request.user.is_authenticated:
@@ -97,12 +98,12 @@ class CanCreatePriceRequest(BasePermission):
             security_logger.error(f"Неожиданный тип объекта в CanCreatePriceRequest: {type(obj)}")
             return False
         
-        has_access = estimate.foreman == request.user
+        has_access = estimate.foreman_id == request.user.user_id
         
         if not has_access:
             security_logger.warning(
                 f"КРИТИЧНО: Попытка создания запроса на изменение цены для чужой сметы {estimate.estimate_id} "
-                f"пользователем {request.user.email}. Владелец сметы: {estimate.foreman.email}"
+                f"пользователем {request.user.email}. Прораб сметы: {estimate.foreman_id}"
             )
         
         return has_access
@@ -116,7 +117,7 @@ class CanProcessPriceRequest(BasePermission):
             request.user and 
             request.user.is_authenticated and 
             hasattr(request.user, 'role') and
-            request.user.role.role_name == 'менеджер'
+            request.user.is_manager
         )
         
         if not has_permission and request.user and request.user.is_authenticated:
@@ -176,7 +177,7 @@ class CanEditEstimateItem(BasePermission):
         user = request.user
         
         # Менеджер может редактировать любые работы
-        if user.role.role_name == 'менеджер':
+        if user.is_manager:
             return True
             
         # Прораб может редактировать только свои работы
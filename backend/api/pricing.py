@@ -0,0 +1,291 @@
+"""
+Пересчёт цен в позициях смет, правила ценообразования и история цен каталога.
+
+Все операции выполняются на стороне БД одним UPDATE на пакет смет,
+без загрузки и сохранения позиций по одной через ORM.
+"""
+
+from decimal import Decimal
+import logging
+
+from django.db import transaction
+from django.db.models import Case, DecimalField, ExpressionWrapper, F, OuterRef, Subquery, Sum, Count, When
+from django.db.models.functions import Round
+from django.utils import timezone
+
+from .caching import SECTION_ESTIMATES, invalidate
+from .events import record_items_changed
+from .sync import bump_estimate_versions
+from .models import Estimate, EstimateItem, WorkPrice, WorkPriceHistory, WorkType
+
+audit_logger = logging.getLogger('audit')
+
+# Количество смет, обрабатываемых одним UPDATE
+REPRICE_BATCH_SIZE = 500
+# Размер пакета при записи истории цен
+PRICE_HISTORY_BATCH_SIZE = 500
+
+MONEY_FIELD = DecimalField(max_digits=14, decimal_places=2)
+CENT = Decimal('0.01')
+
+
+def _chunks(values, size):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def _money(value):
+    return str(Decimal(value or 0).quantize(CENT))
+
+
+def _catalog_prices():
+    """Новые цены позиции - текущие цены каталога (WorkPrice)"""
+    new_cost = Subquery(
+        WorkPrice.objects.filter(work_type_id=OuterRef('work_type_id')).values('cost_price')[:1]
+    )
+    new_client = Subquery(
+        WorkPrice.objects.filter(work_type_id=OuterRef('work_type_id')).values('client_price')[:1]
+    )
+    return new_cost, new_client
+
+
+def _percent_prices(category_percents):
+    """Новые цены позиции - старые цены, измененные на процент своей категории"""
+    def expression(field_name):
+        # Категорию проверяем подзапросом: UPDATE не допускает JOIN в SET
+        return Case(
+            *[
+                When(
+                    work_type_id__in=WorkType.objects.filter(category_id=category_id).values('pk'),
+                    then=Round(F(field_name) * (1 + Decimal(percent) / 100), 2),
+                )
+                for category_id, percent in category_percents.items()
+            ],
+            default=F(field_name),
+            output_field=MONEY_FIELD,
+        )
+    return expression('cost_price_per_unit'), expression('client_price_per_unit')
+
+
+def reprice_estimates(status_ids, category_percents=None, dry_run=False, batch_size=REPRICE_BATCH_SIZE):
+    """
+    Переносит цены в позиции смет с указанными статусами.
+
+    Без category_percents позиции получают текущие цены каталога, иначе цены
+    позиций изменяются на процент, заданный для категории работы
+    ({category_id: percent}). В режиме dry_run ничего не изменяется,
+    возвращается только отчёт о затронутых сметах и суммарных изменениях.
+    """
+    items = EstimateItem.objects.filter(estimate__status_id__in=status_ids)
+
+    if category_percents:
+        items = items.filter(work_type__category_id__in=list(category_percents))
+        report_cost, report_client = _percent_prices(category_percents)
+        update_cost, update_client = report_cost, report_client
+    else:
+        # Позиции, цены которых уже совпадают с каталогом, не трогаем
+        items = items.filter(work_type__workprice__isnull=False).exclude(
+            cost_price_per_unit=F('work_type__workprice__cost_price'),
+            client_price_per_unit=F('work_type__workprice__client_price'),
+        )
+        report_cost = F('work_type__workprice__cost_price')
+        report_client = F('work_type__workprice__client_price')
+        update_cost, update_client = _catalog_prices()
+
+    estimate_ids = list(
+        Estimate.objects.filter(status_id__in=status_ids).order_by('pk').values_list('pk', flat=True)
+    )
+
+    estimates = []
+    with transaction.atomic():
+        for batch in _chunks(estimate_ids, batch_size):
+            batch_items = items.filter(estimate_id__in=batch)
+
+            rows = batch_items.values('estimate_id').annotate(
+                items_count=Count('item_id'),
+                cost_delta=Sum(
+                    ExpressionWrapper((report_cost - F('cost_price_per_unit')) * F('quantity'), output_field=MONEY_FIELD)
+                ),
+                client_delta=Sum(
+                    ExpressionWrapper((report_client - F('client_price_per_unit')) * F('quantity'), output_field=MONEY_FIELD)
+                ),
+            ).order_by('estimate_id')
+            batch_report = [row for row in rows if row['cost_delta'] or row['client_delta']]
+
+            if batch_report and not dry_run:
+                batch_items.update(
+                    cost_price_per_unit=update_cost,
+                    client_price_per_unit=update_client,
+                )
+            estimates.extend(batch_report)
+
+        # Массовый UPDATE не отправляет сигналы - инвалидируем кэш, версии смет и пишем события явно
+        if estimates and not dry_run:
+            changed_ids = [row['estimate_id'] for row in estimates]
+            invalidate(SECTION_ESTIMATES)
+            bump_estimate_versions(changed_ids)
+            record_items_changed(changed_ids)
+
+    if estimates and not dry_run:
+        audit_logger.info(
+            "ПЕРЕСЧЕТ ЦЕН: обновлено позиций %s в сметах %s",
+            sum(row['items_count'] for row in estimates),
+            [row['estimate_id'] for row in estimates],
+        )
+
+    total_cost_delta = sum((Decimal(row['cost_delta'] or 0) for row in estimates), Decimal(0))
+    total_client_delta = sum((Decimal(row['client_delta'] or 0) for row in estimates), Decimal(0))
+
+    return {
+        'dry_run': dry_run,
+        'estimates_count': len(estimates),
+        'items_count': sum(row['items_count'] for row in estimates),
+        'total_cost_delta': _money(total_cost_delta),
+        'total_client_delta': _money(total_client_delta),
+        'estimates': [
+            {
+                'estimate_id': row['estimate_id'],
+                'items_count': row['items_count'],
+                'cost_delta': _money(row['cost_delta']),
+                'client_delta': _money(row['client_delta']),
+            }
+            for row in estimates
+        ],
+    }
+
+
+# --- Правила ценообразования для одной сметы ---
+
+PRICING_RULE_MARKUP = 'markup'
+PRICING_RULE_ROUND = 'round'
+PRICING_RULE_CATEGORY_MARGIN = 'category_margin'
+PRICING_RULES = (PRICING_RULE_MARKUP, PRICING_RULE_ROUND, PRICING_RULE_CATEGORY_MARGIN)
+
+
+def _client_price_expression(rule, value=None, category_margins=None):
+    """Выражение новой цены клиента для правила"""
+    if rule == PRICING_RULE_CATEGORY_MARGIN:
+        # Цена клиента = себестоимость + маржа своей категории в процентах.
+        # Категорию проверяем подзапросом: UPDATE не допускает JOIN в SET
+        return Case(
+            *[
+                When(
+                    work_type_id__in=WorkType.objects.filter(category_id=category_id).values('pk'),
+                    then=Round(F('cost_price_per_unit') * (1 + Decimal(margin) / 100), 2),
+                )
+                for category_id, margin in category_margins.items()
+            ],
+            default=F('client_price_per_unit'),
+            output_field=MONEY_FIELD,
+        )
+    value = Decimal(value)
+    if rule == PRICING_RULE_MARKUP:
+        # Цена клиента = себестоимость * k
+        return Round(F('cost_price_per_unit') * value, 2)
+    if rule == PRICING_RULE_ROUND:
+        # Цена клиента округляется до шага (например, до 5 грн)
+        return Round(F('client_price_per_unit') / value) * value
+    raise ValueError(f'Неизвестное правило ценообразования: {rule}')
+
+
+def estimate_totals(estimate_id):
+    """Итоги сметы одним агрегирующим запросом"""
+    totals = EstimateItem.objects.filter(estimate_id=estimate_id).aggregate(
+        items_count=Count('item_id'),
+        total_cost=Sum(
+            ExpressionWrapper(F('quantity') * F('cost_price_per_unit'), output_field=MONEY_FIELD)
+        ),
+        total_client=Sum(
+            ExpressionWrapper(F('quantity') * F('client_price_per_unit'), output_field=MONEY_FIELD)
+        ),
+    )
+    total_cost = Decimal(totals['total_cost'] or 0)
+    total_client = Decimal(totals['total_client'] or 0)
+    return {
+        'items_count': totals['items_count'],
+        'total_cost': _money(total_cost),
+        'total_client': _money(total_client),
+        'total_profit': _money(total_client - total_cost),
+    }
+
+
+def apply_pricing_rule(estimate_id, rule, value=None, category_ids=None, item_ids=None, category_margins=None):
+    """
+    Применяет правило к ценам клиента всех (или отфильтрованных) позиций сметы
+    одним UPDATE и возвращает новые итоги сметы. Для category_margin маржа
+    задается по категориям ({category_id: процент}); без category_margins
+    value применяется ко всем категориям из category_ids.
+    """
+    if rule == PRICING_RULE_CATEGORY_MARGIN and not category_margins:
+        category_margins = {category_id: value for category_id in category_ids or ()}
+    if rule == PRICING_RULE_CATEGORY_MARGIN:
+        category_ids = list(category_margins)
+
+    items = EstimateItem.objects.filter(estimate_id=estimate_id)
+    if category_ids:
+        items = items.filter(work_type__category_id__in=category_ids)
+    if item_ids:
+        items = items.filter(item_id__in=item_ids)
+
+    with transaction.atomic():
+        updated = items.update(
+            client_price_per_unit=_client_price_expression(rule, value, category_margins)
+        )
+        if updated:
+            invalidate(SECTION_ESTIMATES)
+            bump_estimate_versions([estimate_id])
+            record_items_changed([estimate_id])
+
+    result = estimate_totals(estimate_id)
+    result['items_updated'] = updated
+    return result
+
+
+# --- История цен каталога ---
+
+def record_price_history(work_prices, valid_from=None):
+    """
+    Записывает текущие цены работ в историю пакетами.
+    Принимает объекты WorkPrice после сохранения.
+    """
+    valid_from = valid_from or timezone.now()
+    WorkPriceHistory.objects.bulk_create(
+        [
+            WorkPriceHistory(
+                work_type_id=price.work_type_id,
+                valid_from=valid_from,
+                cost_price=price.cost_price,
+                client_price=price.client_price,
+            )
+            for price in work_prices
+        ],
+        batch_size=PRICE_HISTORY_BATCH_SIZE,
+    )
+
+
+def price_snapshot(as_of):
+    """
+    Каталог цен на момент as_of: для каждой работы - последняя запись
+    истории с valid_from <= as_of (один запрос, поиск по индексу work_type + valid_from).
+    """
+    latest = WorkPriceHistory.objects.filter(
+        work_type_id=OuterRef('pk'), valid_from__lte=as_of
+    ).order_by('-valid_from', '-history_id').values('history_id')[:1]
+
+    latest_ids = WorkType.objects.annotate(latest_id=Subquery(latest)).filter(
+        latest_id__isnull=False
+    ).values('latest_id')
+
+    return WorkPriceHistory.objects.filter(history_id__in=latest_ids).select_related(
+        'work_type'
+    ).order_by('work_type__work_name')
+
+
+def price_series(work_type_id, date_from=None, date_to=None):
+    """Ряд цен работы за период (диапазонная выборка по индексу)"""
+    history = WorkPriceHistory.objects.filter(work_type_id=work_type_id)
+    if date_from:
+        history = history.filter(valid_from__gte=date_from)
+    if date_to:
+        history = history.filter(valid_from__lte=date_to)
+    return history.order_by('valid_from', 'history_id')
@@ -0,0 +1,163 @@
+"""
+Статистика SQL-запросов по отпечаткам.
+
+Запрос нормализуется в отпечаток (литералы и параметры заменяются на ?, списки
+IN сворачиваются), по отпечатку копятся число выполнений, суммарное и максимальное
+время. Запросы дольше QUERY_STATS_SLOW_MS сохраняются вместе с планом (EXPLAIN
+QUERY PLAN в SQLite, EXPLAIN в PostgreSQL) и view, из которого они выполнены.
+Данные процесса периодически сохраняются в METRICS_DIR (как метрики), отчет
+по всем воркерам выводит команда query_report.
+"""
+
+import collections
+import contextvars
+import hashlib
+import re
+import threading
+import time
+
+from django.conf import settings
+from django.db import DatabaseError, connections, transaction
+
+from .metrics import read_worker_files, write_worker_file
+
+FILE_PREFIX = 'queries'
+MAX_FINGERPRINTS = 2000
+MAX_SLOW_QUERIES = 100
+
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r'(?<![\w"])-?\d+(?:\.\d+)?\b')
+_PLACEHOLDER_RE = re.compile(r'%s|%\(\w+\)s')
+_IN_LIST_RE = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_VALUES_RE = re.compile(r'(VALUES\s*\(\.\.\.\))(?:\s*,\s*\(\.\.\.\))+', re.IGNORECASE)
+_SPACE_RE = re.compile(r'\s+')
+
+current_view = contextvars.ContextVar('query_stats_view', default=None)
+
+_lock = threading.Lock()
+_stats = {}
+_slow = collections.deque(maxlen=MAX_SLOW_QUERIES)
+_local = threading.local()
+_last_flush = [0.0]
+
+
+def normalize(sql):
+    """Отпечаток запроса: текст без конкретных значений"""
+    sql = _STRING_RE.sub('?', sql)
+    sql = _PLACEHOLDER_RE.sub('?', sql)
+    sql = _NUMBER_RE.sub('?', sql)
+    sql = _IN_LIST_RE.sub('(...)', sql)
+    sql = _VALUES_RE.sub(r'\1', sql)
+    return _SPACE_RE.sub(' ', sql).strip()
+
+
+def fingerprint_id(fingerprint):
+    return hashlib.md5(fingerprint.encode()).hexdigest()[:12]
+
+
+def explain(alias, sql, params):
+    """План запроса; None, если запрос нельзя разобрать"""
+    connection = connections[alias]
+    prefix = connection.ops.explain_query_prefix()
+    _local.explaining = True
+    try:
+        # Точка сохранения: ошибка EXPLAIN не должна ломать транзакцию запроса
+        with transaction.atomic(using=alias):
+            with connection.cursor() as cursor:
+                cursor.execute(f'{prefix} {sql}', params)
+                return '\n'.join(' '.join(str(column) for column in row) for row in cursor.fetchall())
+    except DatabaseError:
+        return None
+    finally:
+        _local.explaining = False
+
+
+class QueryRecorder:
+    """Обертка connection.execute_wrapper, копящая статистику по отпечаткам"""
+
+    def __init__(self, alias='default'):
+        self.alias = alias
+        self.slow_ms = getattr(settings, 'QUERY_STATS_SLOW_MS', 100)
+
+    def __call__(self, execute, sql, params, many, context):
+        if getattr(_local, 'explaining', False):
+            return execute(sql, params, many, context)
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.record(sql, params, many, (time.perf_counter() - started) * 1000)
+
+    def record(self, sql, params, many, duration):
+        fingerprint = normalize(sql)
+        key = fingerprint_id(fingerprint)
+        with _lock:
+            stats = _stats.get(key)
+            if stats is None:
+                if len(_stats) >= MAX_FINGERPRINTS:
+                    return
+                stats = _stats[key] = {
+                    'fingerprint': fingerprint, 'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'views': {},
+                }
+            stats['count'] += 1
+            stats['total_ms'] += duration
+            stats['max_ms'] = max(stats['max_ms'], duration)
+            view = current_view.get()
+            if view:
+                stats['views'][view] = stats['views'].get(view, 0) + 1
+
+        if duration >= self.slow_ms and not many and sql.lstrip().upper().startswith('SELECT'):
+            plan = explain(self.alias, sql, params)
+            with _lock:
+                _slow.append({
+                    'fingerprint_id': key,
+                    'sql': sql,
+                    'params': repr(params)[:500],
+                    'duration_ms': round(duration, 2),
+                    'view': current_view.get(),
+                    'plan': plan,
+                    'time': time.time(),
+                })
+
+
+def snapshot():
+    with _lock:
+        return {
+            'stats': {key: {**stats, 'views': dict(stats['views'])} for key, stats in _stats.items()},
+            'slow': list(_slow),
+        }
+
+
+def flush(force=False):
+    """Сохраняет статистику процесса не чаще METRICS_FLUSH_INTERVAL секунд"""
+    now = time.monotonic()
+    if not force and now - _last_flush[0] < getattr(settings, 'METRICS_FLUSH_INTERVAL', 5):
+        return
+    _last_flush[0] = now
+    write_worker_file(FILE_PREFIX, snapshot())
+
+
+def reset():
+    with _lock:
+        _stats.clear()
+        _slow.clear()
+        _last_flush[0] = 0.0
+
+
+def collect():
+    """Статистика всех живых воркеров: (отпечатки, медленные запросы)"""
+    stats = {}
+    slow = []
+    for data in read_worker_files(FILE_PREFIX):
+        for key, worker_stats in data['stats'].items():
+            total = stats.get(key)
+            if total is None:
+                stats[key] = {**worker_stats, 'views': dict(worker_stats['views'])}
+                continue
+            total['count'] += worker_stats['count']
+            total['total_ms'] += worker_stats['total_ms']
+            total['max_ms'] = max(total['max_ms'], worker_stats['max_ms'])
+            for view, count in worker_stats['views'].items():
+                total['views'][view] = total['views'].get(view, 0) + count
+        slow.extend(data['slow'])
+    return stats, slow
@@ -0,0 +1,65 @@
+"""
+Справочники ролей и статусов в памяти процесса.
+
+Роли и статусы загружаются двумя запросами и живут до смены версий разделов
+ролей или статусов в общем кэше, поэтому проверки роли пользователя и поиск
+статуса по названию в обработке запроса не обращаются к БД.
+"""
+
+import threading
+
+from .caching import SECTION_ROLES, SECTION_STATUSES, combined_version
+from .metrics import record_cache
+from .models import Role, Status
+
+ROLE_MANAGER = 'менеджер'
+ROLE_FOREMAN = 'прораб'
+
+STATUS_DRAFT = 'Черновик'
+
+_lock = threading.Lock()
+_registry = {'version': None, 'roles': {}, 'statuses': {}}
+
+
+def _load_registry():
+    """Текущие справочники; перечитываются только после изменения ролей или статусов"""
+    version = combined_version(SECTION_ROLES, SECTION_STATUSES)
+    hit = _registry['version'] == version
+    record_cache('registry', hit)
+    if hit:
+        return _registry
+
+    with _lock:
+        if _registry['version'] != version:
+            roles = {role.role_id: role for role in Role.objects.all()}
+            statuses = {status.status_name: status for status in Status.objects.all()}
+            _registry.update(version=version, roles=roles, statuses=statuses)
+    return _registry
+
+
+def get_role(role_id):
+    """Роль по id или None"""
+    return _load_registry()['roles'].get(role_id)
+
+
+def get_status(status_name):
+    """Статус по названию или None"""
+    return _load_registry()['statuses'].get(status_name)
+
+
+def draft_status():
+    return get_status(STATUS_DRAFT)
+
+
+def attach_role(user):
+    """Подставляет пользователю роль из справочника вместо отдельной загрузки"""
+    role = get_role(user.role_id)
+    if role is not None:
+        user.role = role
+    return user
+
+
+def clear_registry():
+    """Сбрасывает справочники процесса (для тестов и команд управления)"""
+    with _lock:
+        _registry.update(version=None, roles={}, statuses={})
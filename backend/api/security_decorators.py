@@ -11,6 +11,18 @@ import logging
 security_logger = logging.getLogger('security')
 audit_logger = logging.getLogger('audit')
 
+def load_estimate_for_check(view, estimate_id, kwargs):
+    """
+    Смета для проверки доступа. Если смета - объект самого ViewSet, используется
+    кэшированный get_object() (без повторного запроса), иначе загружаются только
+    поля, нужные для проверки.
+    """
+    from .models import Estimate
+
+    if kwargs.get('pk') == estimate_id and hasattr(view, 'get_object') and view.get_queryset().model is Estimate:
+        return view.get_object()
+    return Estimate.objects.only('estimate_id', 'foreman_id').get(pk=estimate_id)
+
 def ensure_estimate_access(func):
     """
     Декоратор для проверки доступа к смете.
@@ -31,7 +43,7 @@ def ensure_estimate_access(func):
         
         if estimate_id:
             try:
-                estimate = Estimate.objects.get(pk=estimate_id)
+                estimate = load_estimate_for_check(self, estimate_id, kwargs)
                 permission_check = CanAccessEstimate()
                 
                 if not permission_check.has_object_permission(request, self, estimate):
@@ -1,7 +1,16 @@
+from decimal import Decimal
+
 from rest_framework import serializers
 from django.contrib.auth.hashers import make_password
+from django.db import IntegrityError, transaction
 from django.db.models import F
-from .models import WorkCategory, User, Project, Estimate, WorkType, WorkPrice, Status, Role, ProjectAssignment
+from django.db.models.signals import post_save
+from .models import WorkCategory, User, Project, Estimate, WorkType, WorkPrice, WorkPriceHistory, Status, Role, ProjectAssignment
+from .pricing import PRICING_RULES, PRICING_RULE_CATEGORY_MARGIN, PRICING_RULE_MARKUP, PRICING_RULE_ROUND
+from .catalog import work_type_prices
+from .sync import MUTATION_TYPES
+from .caching import SECTION_ESTIMATES
+from .signals import changes_atomic, defer_estimate_change, defer_invalidate, snapshot_work_type
 
 # --- Сериализатор для логина (кастомный) ---
 class UserSerializer(serializers.ModelSerializer):
@@ -50,6 +59,137 @@ class LoginSerializer(serializers.Serializer):
     email = serializers.EmailField()
     password = serializers.CharField()
 
+class EstimateRepriceSerializer(serializers.Serializer):
+    # Статусы смет, позиции которых нужно пересчитать
+    status_ids = serializers.ListField(child=serializers.IntegerField(), allow_empty=False)
+    # {category_id: процент}; если не передано - берутся текущие цены каталога
+    category_percents = serializers.DictField(
+        child=serializers.DecimalField(max_digits=6, decimal_places=2), required=False
+    )
+    dry_run = serializers.BooleanField(default=False)
+
+    def validate_category_percents(self, value):
+        percents = {}
+        for category_id, percent in value.items():
+            try:
+                category_id = int(category_id)
+            except (TypeError, ValueError):
+                raise serializers.ValidationError(f'Некорректный ID категории: {category_id}')
+            if percent <= -100:
+                raise serializers.ValidationError('Процент изменения цены должен быть больше -100')
+            percents[category_id] = percent
+        return percents
+
+
+class BatchOperationSerializer(serializers.Serializer):
+    method = serializers.ChoiceField(choices=['GET', 'POST', 'PUT', 'PATCH', 'DELETE'])
+    # Путь относительно /api/v1/ (например, "estimate-items/?estimate=5") или абсолютный
+    path = serializers.CharField(max_length=500)
+    body = serializers.JSONField(required=False)
+
+
+class BatchRequestSerializer(serializers.Serializer):
+    MAX_OPERATIONS = 50
+
+    requests = BatchOperationSerializer(many=True)
+    # Выполнить все запросы в одной транзакции (откат при первой ошибке)
+    atomic = serializers.BooleanField(default=False)
+
+    def validate_requests(self, value):
+        if not value:
+            raise serializers.ValidationError('Список запросов пуст')
+        if len(value) > self.MAX_OPERATIONS:
+            raise serializers.ValidationError(f'Не более {self.MAX_OPERATIONS} запросов в пакете')
+        return value
+
+
+class SyncMutationSerializer(serializers.Serializer):
+    client_id = serializers.CharField(max_length=100)
+    type = serializers.ChoiceField(choices=MUTATION_TYPES)
+    # Смета/работа по id на сервере или по client_id изменения, создавшего их в этой же пачке
+    estimate_id = serializers.IntegerField(required=False)
+    estimate_client_id = serializers.CharField(max_length=100, required=False)
+    item_id = serializers.IntegerField(required=False)
+    item_client_id = serializers.CharField(max_length=100, required=False)
+    # Версия сметы, которую видел клиент
+    base_version = serializers.IntegerField(required=False)
+    data = serializers.DictField(required=False)
+
+
+class SyncRequestSerializer(serializers.Serializer):
+    MAX_MUTATIONS = 200
+
+    mutations = SyncMutationSerializer(many=True)
+
+    def validate_mutations(self, value):
+        if not value:
+            raise serializers.ValidationError('Список изменений пуст')
+        if len(value) > self.MAX_MUTATIONS:
+            raise serializers.ValidationError(f'Не более {self.MAX_MUTATIONS} изменений в пакете')
+        client_ids = [mutation['client_id'] for mutation in value]
+        if len(set(client_ids)) != len(client_ids):
+            raise serializers.ValidationError('client_id изменений должны быть уникальны')
+        return value
+
+
+class SyncEstimateDataSerializer(serializers.Serializer):
+    name = serializers.CharField(max_length=50)
+    project_id = serializers.IntegerField()
+    foreman_id = serializers.IntegerField(required=False)
+
+
+class SyncItemDataSerializer(serializers.Serializer):
+    work_type = serializers.IntegerField()
+    quantity = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=Decimal('0.01'))
+    # Без цен используются текущие цены каталога
+    cost_price_per_unit = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=0, required=False)
+    client_price_per_unit = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=0, required=False)
+
+
+class SyncQuantityDataSerializer(serializers.Serializer):
+    quantity = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=Decimal('0.01'))
+
+
+class EstimatePricingRuleSerializer(serializers.Serializer):
+    rule = serializers.ChoiceField(choices=PRICING_RULES)
+    # k для markup, шаг для round, одинаковый процент маржи для category_ids в category_margin
+    value = serializers.DecimalField(max_digits=10, decimal_places=4, required=False)
+    # {category_id: процент маржи} - своя маржа для каждой категории (category_margin)
+    category_margins = serializers.DictField(
+        child=serializers.DecimalField(max_digits=10, decimal_places=4), required=False
+    )
+    category_ids = serializers.ListField(child=serializers.IntegerField(), required=False)
+    item_ids = serializers.ListField(child=serializers.IntegerField(), required=False)
+
+    def validate_category_margins(self, value):
+        margins = {}
+        for category_id, margin in value.items():
+            try:
+                margins[int(category_id)] = margin
+            except (TypeError, ValueError):
+                raise serializers.ValidationError(f'Некорректный ID категории: {category_id}')
+        return margins
+
+    def validate(self, data):
+        rule = data['rule']
+        value = data.get('value')
+        if rule in (PRICING_RULE_MARKUP, PRICING_RULE_ROUND) and (value is None or value <= 0):
+            raise serializers.ValidationError('Значение правила должно быть больше 0')
+        if rule == PRICING_RULE_CATEGORY_MARGIN:
+            margins = data.get('category_margins')
+            if not margins:
+                if not data.get('category_ids'):
+                    raise serializers.ValidationError(
+                        'Для маржи по категориям необходимо указать category_margins или category_ids'
+                    )
+                if value is None:
+                    raise serializers.ValidationError('Для маржи по category_ids необходимо указать value')
+                margins = {category_id: value for category_id in data['category_ids']}
+            if any(margin <= -100 for margin in margins.values()):
+                raise serializers.ValidationError('Маржа должна быть больше -100%')
+            data['category_margins'] = margins
+        return data
+
 class RoleSerializer(serializers.ModelSerializer):
     class Meta:
         model = Role
@@ -100,6 +240,7 @@ class EstimateListSerializer(serializers.ModelSerializer):
     mobile_total_amount = serializers.DecimalField(max_digits=12, decimal_places=2, read_only=True)
     currency = serializers.SerializerMethodField()
     createdDate = serializers.DateTimeField(source='created_at', read_only=True, format='%d.%m.%Y')
+    version = serializers.IntegerField(read_only=True)
 
     class Meta:
         model = Estimate
@@ -107,7 +248,7 @@ class EstimateListSerializer(serializers.ModelSerializer):
             'estimate_id', 'estimate_number', 'name', 'objectId', 
             'project', 'project_id', 'creator', 'foreman',  # ДОБАВЛЕНЫ КРИТИЧЕСКИЕ ПОЛЯ
             'status', 'project_name', 'creator_name', 'foreman_name', 
-            'totalAmount', 'mobile_total_amount', 'currency', 'created_at', 'createdDate'
+            'totalAmount', 'mobile_total_amount', 'currency', 'created_at', 'createdDate', 'version'
         ]
 
     def get_foreman_name(self, obj):
@@ -124,6 +265,14 @@ class WorkPriceSerializer(serializers.ModelSerializer):
         model = WorkPrice
         fields = ['cost_price', 'client_price']
 
+class WorkPriceHistorySerializer(serializers.ModelSerializer):
+    work_type_id = serializers.IntegerField(read_only=True)
+    work_name = serializers.CharField(source='work_type.work_name', read_only=True)
+
+    class Meta:
+        model = WorkPriceHistory
+        fields = ['work_type_id', 'work_name', 'valid_from', 'cost_price', 'client_price']
+
 class WorkTypeSerializer(serializers.ModelSerializer):
     category = WorkCategorySerializer(read_only=True)
     category_id = serializers.IntegerField(write_only=True)
@@ -153,23 +302,131 @@ class StatusSerializer(serializers.ModelSerializer):
 
 # --- Сериализаторы для Смет ---
 
+PRICE_FIELDS = ('cost_price_per_unit', 'client_price_per_unit')
+
+
+def weighted_price(quantity, price, added_quantity, added_price):
+    """Средневзвешенная по количеству цена объединенной позиции, с точностью до копейки"""
+    total_quantity = Decimal(quantity) + Decimal(added_quantity)
+    if not total_quantity:
+        return Decimal(price)
+    total = Decimal(quantity) * Decimal(price) + Decimal(added_quantity) * Decimal(added_price)
+    return (total / total_quantity).quantize(Decimal('0.01'))
+
+
+def merge_or_create_item(estimate, work_type, added_by, quantity, **fields):
+    """
+    Добавляет работу в смету. Если такая работа этого автора уже есть,
+    увеличивает ее количество вместо новой позиции: при тех же ценах одним
+    UPDATE с F(), при других - с пересчетом цен в средневзвешенные (как при
+    объединении дублей миграцией 0011). Возвращает (позиция, создана ли).
+    """
+    lookup = {'estimate': estimate, 'work_type': work_type, 'added_by': added_by}
+    prices = {field: fields[field] for field in PRICE_FIELDS if fields.get(field) is not None}
+    for _ in range(2):
+        with changes_atomic():
+            if added_by is not None and EstimateItem.objects.filter(**lookup, **prices).update(
+                quantity=F('quantity') + quantity
+            ):
+                item = EstimateItem.objects.get(**lookup)
+                # UPDATE не отправляет сигналы: кэш, версия сметы и события обновляются обработчиками post_save
+                post_save.send(
+                    sender=EstimateItem, instance=item, created=False,
+                    update_fields=frozenset(['quantity']), raw=False, using=item._state.db,
+                )
+                return item, False
+            item = None
+            if added_by is not None and prices:
+                item = EstimateItem.objects.select_for_update().filter(**lookup).first()
+            if item is not None:
+                # Цены отличаются: итог позиции сохраняется с точностью до округления цены
+                for field, price in prices.items():
+                    setattr(item, field, weighted_price(item.quantity, getattr(item, field), quantity, price))
+                item.quantity += Decimal(quantity)
+                item.save(update_fields=['quantity', *prices])
+                return item, False
+            try:
+                with transaction.atomic():
+                    return EstimateItem.objects.create(quantity=quantity, **lookup, **fields), True
+            except IntegrityError:
+                # Параллельный запрос успел создать такую же позицию - объединяем с ней
+                continue
+    raise IntegrityError('Не удалось добавить работу в смету')
+
+
+class WorkTypeField(serializers.PrimaryKeyRelatedField):
+    """
+    Тип работы по ID. Если сериализатор сметы заранее загрузил типы работ всех
+    позиций (context['work_types']), они берутся оттуда без запроса на позицию.
+    """
+
+    def to_internal_value(self, data):
+        work_types = self.context.get('work_types')
+        if work_types is not None and not isinstance(data, bool):
+            try:
+                work_type = work_types.get(int(data))
+            except (TypeError, ValueError):
+                work_type = None
+            if work_type is not None:
+                return work_type
+        return super().to_internal_value(data)
+
+
 class EstimateItemSerializer(serializers.ModelSerializer):
+    work_type = WorkTypeField(queryset=WorkType.objects.all())
+    # Смета для создания позиции через /estimate-items/
+    estimate = serializers.PrimaryKeyRelatedField(queryset=Estimate.objects.all(), write_only=True, required=False)
     # Поля для чтения для удобства фронтенда
-    work_name = serializers.CharField(source='work_type.work_name', read_only=True)
-    unit_of_measurement = serializers.CharField(source='work_type.unit_of_measurement', read_only=True)
     added_by_name = serializers.CharField(source='added_by.full_name', read_only=True)
     added_by_email = serializers.CharField(source='added_by.email', read_only=True)
 
     class Meta:
         model = EstimateItem
         fields = [
-            'item_id', 'work_type', 'work_name', 'unit_of_measurement',
+            'item_id', 'estimate', 'work_type', 'work_name', 'unit_of_measurement', 'category_name',
             'quantity', 'cost_price_per_unit', 'client_price_per_unit',
             'added_by', 'added_by_name', 'added_by_email'
         ]
         # work_type будет использоваться для записи (ожидает ID),
-        # а вложенные поля work_name и unit_of_measurement - для чтения.
-        read_only_fields = ['item_id', 'work_name', 'unit_of_measurement', 'added_by_name', 'added_by_email']
+        # а work_name, unit_of_measurement и category_name - снимок работы в позиции, только для чтения.
+        read_only_fields = [
+            'item_id', 'work_name', 'unit_of_measurement', 'category_name', 'added_by_name', 'added_by_email'
+        ]
+        # Уникальность (смета, работа, автор) обеспечивает merge_or_create_item, а не валидация
+        validators = []
+        # Цены можно не передавать - они берутся из каталога
+        extra_kwargs = {
+            'cost_price_per_unit': {'required': False},
+            'client_price_per_unit': {'required': False},
+        }
+
+    def validate(self, data):
+        if isinstance(self.instance, EstimateItem):
+            # Смета задается только при создании: позицию нельзя перенести в чужую смету
+            estimate = data.pop('estimate', None)
+            if estimate is not None and estimate.pk != self.instance.estimate_id:
+                raise serializers.ValidationError({'estimate': 'Позицию нельзя перенести в другую смету'})
+            # Существующая позиция при обновлении сохраняет свои цены
+            return data
+        if 'work_type' not in data:
+            return data
+        if 'cost_price_per_unit' not in data or 'client_price_per_unit' not in data:
+            prices = work_type_prices(data['work_type'].pk)
+            if prices is None:
+                raise serializers.ValidationError(
+                    {'work_type': f'Для работы "{data["work_type"].work_name}" не задана цена в каталоге'}
+                )
+            data.setdefault('cost_price_per_unit', prices[0])
+            data.setdefault('client_price_per_unit', prices[1])
+        return data
+
+    def create(self, validated_data):
+        if not validated_data.get('estimate'):
+            raise serializers.ValidationError({'estimate': 'Обязательное поле.'})
+        item, created = merge_or_create_item(**validated_data)
+        # Работа объединена с существующей позицией - ответ 200 вместо 201
+        self.merged = not created
+        return item
 
 
 class EstimateDetailSerializer(serializers.ModelSerializer):
@@ -195,30 +452,29 @@ class EstimateDetailSerializer(serializers.ModelSerializer):
     
     # Поля для совместимости с фронтендом
     name = serializers.CharField(source='estimate_number', required=False)
+    # Версия для обнаружения конфликтов при офлайн-синхронизации
+    version = serializers.IntegerField(read_only=True)
     
     class Meta:
         model = Estimate
         fields = [
             'estimate_id', 'estimate_number', 'name', 'status', 'status_id', 
             'project', 'project_id', 'creator', 'foreman', 'foreman_id',
-            'client', 'created_at', 'items'
+            'client', 'created_at', 'items', 'version'
         ]
 
-    def to_representation(self, instance):
-        """Переопределяем для использования отфильтрованных элементов работ"""
-        data = super().to_representation(instance)
-        
-        import logging
-        logger = logging.getLogger('django')
-        
-        # Если есть отфильтрованные элементы (установлены в retrieve методе ViewSet)
-        if hasattr(instance, '_filtered_items'):
-            logger.warning(f"🔍 DEBUG serializer: Используем отфильтрованные items: {len(instance._filtered_items)}")
-            data['items'] = EstimateItemSerializer(instance._filtered_items, many=True).data
-        else:
-            logger.warning(f"🔍 DEBUG serializer: Нет _filtered_items, используем стандартные items: {len(data.get('items', []))}")
-        
-        return data
+    def to_internal_value(self, data):
+        # Типы работ всех позиций одним запросом вместо запроса на каждую позицию
+        items = data.get('items') if hasattr(data, 'get') else None
+        if isinstance(items, list):
+            work_type_ids = {
+                int(item['work_type']) for item in items
+                if isinstance(item, dict) and str(item.get('work_type', '')).isdigit()
+            }
+            self.context['work_types'] = {
+                work_type.pk: work_type for work_type in WorkType.objects.filter(pk__in=work_type_ids)
+            }
+        return super().to_internal_value(data)
 
     def validate(self, data):
         # Проверяем, что название сметы указано
@@ -232,10 +488,8 @@ class EstimateDetailSerializer(serializers.ModelSerializer):
         items_data = validated_data.pop('items', [])
         
         # ИСПРАВЛЕНО: Безопасное создание сметы с транзакционностью
-        from django.db import transaction
-        
         try:
-            with transaction.atomic():
+            with changes_atomic():
                 estimate = Estimate.objects.create(**validated_data)
                 work_type_ids = []
                 created_items = []
@@ -275,7 +529,8 @@ class EstimateDetailSerializer(serializers.ModelSerializer):
                         else:
                             item_data['added_by'] = estimate.creator
                             print(f"🔍 DEBUG create: ⚠️ Нет request.user, используем creator = {estimate.creator.email if estimate.creator else 'None'}")
-                        created_item = EstimateItem.objects.create(estimate=estimate, **item_data)
+                        item_data.pop('estimate', None)
+                        created_item, _ = merge_or_create_item(estimate=estimate, **item_data)
                         created_items.append(created_item)
                         work_type_ids.append(work_type.pk if hasattr(work_type, 'pk') else work_type)
                     except Exception as e:
@@ -294,94 +549,136 @@ class EstimateDetailSerializer(serializers.ModelSerializer):
             
         return estimate
 
+    def resolve_item_authors(self, instance, items_data, old_items):
+        """
+        Авторы строк полной замены работ. Строка с item_id позиции этой сметы
+        сохраняет ее автора; строка без item_id получает автора первой еще не
+        занятой старой позиции с тем же типом работы; новые работы записываются
+        на текущего пользователя (без запроса - на прораба сметы).
+        """
+        old_by_id = {item.item_id: item for item in old_items}
+        raw_items = (self.initial_data.get('items') or []) if isinstance(self.initial_data, dict) else []
+
+        request = self.context.get('request')
+        current_user = request.user if request is not None and hasattr(request.user, 'email') else instance.foreman
+
+        author_ids = [None] * len(items_data)
+        claimed = set()
+        # Сначала строки, явно ссылающиеся на свою позицию
+        for index in range(len(items_data)):
+            raw = raw_items[index] if index < len(raw_items) and isinstance(raw_items[index], dict) else {}
+            old_item = old_by_id.get(raw.get('item_id'))
+            if old_item is not None and old_item.item_id not in claimed:
+                claimed.add(old_item.item_id)
+                author_ids[index] = old_item.added_by_id
+        # Затем строки без item_id - по типу работы
+        unclaimed = {}
+        for item in old_items:
+            if item.item_id not in claimed:
+                unclaimed.setdefault(item.work_type_id, []).append(item)
+        for index, item_data in enumerate(items_data):
+            if author_ids[index] is not None:
+                continue
+            work_type = item_data.get('work_type')
+            work_type_id = work_type.pk if hasattr(work_type, 'pk') else work_type
+            candidates = unclaimed.get(work_type_id)
+            if candidates:
+                author_ids[index] = candidates.pop(0).added_by_id
+
+        users = User.objects.in_bulk({author_id for author_id in author_ids if author_id is not None})
+        return [users.get(author_id, current_user) for author_id in author_ids]
+
+    def replace_items(self, instance, items_data):
+        """
+        Полная замена работ сметы пачкой запросов, а не запросами на каждую строку.
+        Строки одной работы одного автора объединяются со средневзвешенными ценами;
+        существующие позиции обновляются на месте (сохраняя снимок работы и
+        связанные записи), недостающие создаются одним bulk_create, лишние
+        удаляются одним запросом.
+        """
+        old_items = list(instance.items.select_for_update())
+        # КРИТИЧНО: Сохраняем авторство старых работ - по позициям, а не по типу работы
+        authors = self.resolve_item_authors(instance, items_data, old_items)
+
+        lines = {}
+        for item_data, author in zip(items_data, authors):
+            work_type = item_data.get('work_type')
+            quantity = item_data.get('quantity', 0)
+            cost_price = item_data.get('cost_price_per_unit', 0)
+            client_price = item_data.get('client_price_per_unit', 0)
+
+            # КРИТИЧНО: Валидация данных для предотвращения некорректных записей
+            if not work_type:
+                raise serializers.ValidationError(f'Не указан тип работы в позиции сметы')
+            if quantity <= 0:
+                raise serializers.ValidationError(f'Количество должно быть больше 0 (получено: {quantity})')
+            if cost_price < 0:
+                raise serializers.ValidationError(f'Себестоимость не может быть отрицательной (получено: {cost_price})')
+            if client_price < 0:
+                raise serializers.ValidationError(f'Цена клиента не может быть отрицательной (получено: {client_price})')
+
+            key = (work_type.pk, author.pk if author is not None else None)
+            line = lines.get(key)
+            if line is None:
+                lines[key] = {
+                    'work_type': work_type, 'added_by': author, 'quantity': Decimal(quantity),
+                    'cost_price_per_unit': Decimal(cost_price), 'client_price_per_unit': Decimal(client_price),
+                }
+                continue
+            for field, price in (('cost_price_per_unit', cost_price), ('client_price_per_unit', client_price)):
+                line[field] = weighted_price(line['quantity'], line[field], quantity, price)
+            line['quantity'] += Decimal(quantity)
+
+        old_by_key = {(item.work_type_id, item.added_by_id): item for item in old_items}
+        changed, created = [], []
+        for key, line in lines.items():
+            item = old_by_key.pop(key, None) if key[1] is not None else None
+            if item is None:
+                item = EstimateItem(estimate=instance, **line)
+                # bulk_create не отправляет pre_save - снимок работы заполняется здесь
+                snapshot_work_type(EstimateItem, item)
+                created.append(item)
+                continue
+            values = (line['quantity'], line['cost_price_per_unit'], line['client_price_per_unit'])
+            if values != (item.quantity, item.cost_price_per_unit, item.client_price_per_unit):
+                item.quantity, item.cost_price_per_unit, item.client_price_per_unit = values
+                changed.append(item)
+
+        if old_by_key:
+            EstimateItem.objects.filter(pk__in=[item.item_id for item in old_by_key.values()]).delete()
+        if changed:
+            EstimateItem.objects.bulk_update(changed, ['quantity', 'cost_price_per_unit', 'client_price_per_unit'])
+        if created:
+            EstimateItem.objects.bulk_create(created)
+        if changed or created:
+            # bulk-операции не отправляют сигналы: кэш, версия сметы и событие - вручную
+            defer_invalidate(SECTION_ESTIMATES)
+            defer_estimate_change(instance.estimate_id, items_changed=True)
+
+        # Обновляем счетчики использования только после успешной замены всех items
+        if lines:
+            WorkType.objects.filter(pk__in={key[0] for key in lines}).update(usage_count=F('usage_count') + 1)
+
     def update(self, instance, validated_data):
-        items_data = validated_data.pop('items', [])
+        # Без items в запросе (PATCH полей сметы) работы не пересоздаются
+        items_data = validated_data.pop('items', None)
         
         instance.estimate_number = validated_data.get('estimate_number', instance.estimate_number)
         instance.status = validated_data.get('status', instance.status)
         instance.project = validated_data.get('project', instance.project)
         instance.foreman = validated_data.get('foreman', instance.foreman)
-        instance.save()
 
         # ИСПРАВЛЕНО: Безопасное обновление items с транзакционностью
-        if items_data is not None:
-            from django.db import transaction
-            
-            try:
-                with transaction.atomic():
-                    # КРИТИЧНО: Сохраняем информацию о том, кто добавил старые работы
-                    old_items_authors = {}
-                    for old_item in instance.items.all():
-                        # Ключ - тип работы, значение - кто добавил
-                        old_items_authors[old_item.work_type_id] = old_item.added_by_id
-                    
-                    # Теперь удаляем старые items
-                    instance.items.all().delete()
-                    
-                    work_type_ids = []
-                    created_items = []
-                    
-                    # Валидация и подготовка данных перед созданием
-                    for item_data in items_data:
-                        work_type = item_data.get('work_type')
-                        quantity = item_data.get('quantity', 0)
-                        cost_price = item_data.get('cost_price_per_unit', 0)
-                        client_price = item_data.get('client_price_per_unit', 0)
-                        
-                        # КРИТИЧНО: Валидация данных для предотвращения некорректных записей
-                        if not work_type:
-                            raise serializers.ValidationError(f'Не указан тип работы в позиции сметы')
-                        if quantity <= 0:
-                            raise serializers.ValidationError(f'Количество должно быть больше 0 (получено: {quantity})')
-                        if cost_price < 0:
-                            raise serializers.ValidationError(f'Себестоимость не может быть отрицательной (получено: {cost_price})')
-                        if client_price < 0:
-                            raise serializers.ValidationError(f'Цена клиента не может быть отрицательной (получено: {client_price})')
-                        
-                        # Проверяем существование work_type
-                        if not WorkType.objects.filter(pk=work_type.pk if hasattr(work_type, 'pk') else work_type).exists():
-                            raise serializers.ValidationError(f'Тип работы с ID {work_type} не найден')
-                        
-                        try:
-                            # КРИТИЧНО: Сохраняем авторство существующих работ или устанавливаем для новых
-                            work_type_id = work_type.pk if hasattr(work_type, 'pk') else work_type
-                            
-                            # Проверяем, была ли эта работа раньше
-                            if work_type_id in old_items_authors and old_items_authors[work_type_id] is not None:
-                                # Сохраняем старого автора
-                                from api.models import User
-                                item_data['added_by'] = User.objects.get(pk=old_items_authors[work_type_id])
-                                print(f"🔍 DEBUG update: Сохраняем старого автора для {work_type_id}")
-                            else:
-                                # Это новая работа - устанавливаем текущего пользователя
-                                print(f"🔍 DEBUG update: context = {self.context}")
-                                print(f"🔍 DEBUG update: 'request' in context = {'request' in self.context}")
-                                
-                                current_user = self.context.get('request').user if 'request' in self.context else None
-                                print(f"🔍 DEBUG update: current_user = {current_user}")
-                                
-                                if current_user and hasattr(current_user, 'email'):
-                                    item_data['added_by'] = current_user
-                                    print(f"🔍 DEBUG update: ✅ НОВАЯ работа, added_by = {current_user.email}")
-                                else:
-                                    item_data['added_by'] = instance.foreman
-                                    print(f"🔍 DEBUG update: ⚠️ НОВАЯ работа, используем foreman = {instance.foreman.email if instance.foreman else 'None'}")
-                            
-                            created_item = EstimateItem.objects.create(estimate=instance, **item_data)
-                            created_items.append(created_item)
-                            work_type_ids.append(work_type.pk if hasattr(work_type, 'pk') else work_type)
-                        except Exception as e:
-                            raise serializers.ValidationError(f'Ошибка создания позиции сметы: {str(e)}')
-                    
-                    # Обновляем счетчики использования только после успешного создания всех items
-                    if work_type_ids:
-                        WorkType.objects.filter(pk__in=work_type_ids).update(usage_count=F('usage_count') + 1)
-                        
-            except Exception as e:
-                # Логируем ошибку для отладки
-                import logging
-                logger = logging.getLogger(__name__)
-                logger.error(f'Ошибка обновления сметы {instance.estimate_id}: {str(e)}')
-                raise
+        try:
+            with changes_atomic():
+                instance.save()
+                if items_data is not None:
+                    self.replace_items(instance, items_data)
+        except Exception as e:
+            # Логируем ошибку для отладки
+            import logging
+            logger = logging.getLogger(__name__)
+            logger.error(f'Ошибка обновления сметы {instance.estimate_id}: {str(e)}')
+            raise
 
         return instance
\ No newline at end of file
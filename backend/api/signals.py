@@ -0,0 +1,199 @@
+"""
+Обработчики сигналов моделей: инвалидация версионированного кэша,
+версии смет, снимок работы в позициях и журнал изменений для потока событий.
+"""
+
+from contextlib import contextmanager
+from functools import partial
+from weakref import WeakKeyDictionary
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_init, post_save, pre_save
+from django.dispatch import receiver
+
+from .caching import (
+    SECTION_CATALOG, SECTION_ESTIMATES, SECTION_PROJECTS, SECTION_ROLES, SECTION_STATUSES, SECTION_USERS,
+    bump_version,
+)
+from .catalog import work_type_snapshot
+from .events import record_estimate_changes, record_event
+from .sync import bump_estimate_versions
+from .models import (
+    ChangeEvent, Estimate, EstimateItem, Project, ProjectAssignment, Role, Status, User, WorkCategory, WorkPrice,
+    WorkType,
+)
+
+
+# Сметы, каталог и разделы кэша, измененные в текущей транзакции соединения:
+# версии, события и инвалидация выполняются один раз при фиксации, а не на каждую сохраненную строку
+_pending_changes = WeakKeyDictionary()
+
+
+def _pending_batch():
+    connection = transaction.get_connection()
+    pending = _pending_changes.get(connection)
+    if pending is None or not any(entry[1] is pending['flush'] for entry in connection.run_on_commit):
+        # Нет отложенных изменений или их транзакция откатилась
+        pending = _pending_changes[connection] = {
+            'bump': set(), 'items': set(), 'estimates': {}, 'catalog': False, 'sections': set(),
+            'flush': partial(flush_pending_changes, committed=True),
+        }
+    return pending
+
+
+def _schedule_flush(pending):
+    # Обработчик ставится на каждое изменение: регистрация из отмененной точки
+    # сохранения снимается вместе с ней. Вне транзакции он выполняется сразу
+    transaction.on_commit(pending['flush'])
+
+
+def defer_estimate_change(estimate_id, bump=True, items_changed=False, instance=None):
+    pending = _pending_batch()
+    if bump:
+        pending['bump'].add(estimate_id)
+    if items_changed:
+        pending['items'].add(estimate_id)
+    if instance is not None:
+        pending['estimates'].setdefault(estimate_id, []).append(instance)
+    _schedule_flush(pending)
+
+
+def defer_catalog_change():
+    pending = _pending_batch()
+    pending['catalog'] = True
+    _schedule_flush(pending)
+
+
+def defer_invalidate(*sections):
+    """
+    Инвалидация разделов кэша на транзакцию: при первом изменении раздела
+    (чтобы чтения внутри транзакции не получали закэшированное до него)
+    и один раз при фиксации - вместо двух сбросов на каждую строку.
+    """
+    pending = _pending_batch()
+    new_sections = set(sections) - pending['sections']
+    if new_sections and transaction.get_connection().in_atomic_block:
+        bump_version(*new_sections)
+    pending['sections'].update(new_sections)
+    _schedule_flush(pending)
+
+
+def flush_pending_changes(committed=False):
+    """
+    Увеличивает версии и записывает события отложенных изменений смет
+    (UPDATE, SELECT и INSERT на транзакцию), одно событие изменения каталога
+    и инвалидирует измененные разделы кэша.
+    Вызывается при фиксации и перед чтением версий внутри транзакции
+    (синхронизация, ответ на изменение сметы).
+    """
+    pending = _pending_changes.pop(transaction.get_connection(), None)
+    if pending is None:
+        return
+    if pending['catalog']:
+        record_event(ChangeEvent.KIND_CATALOG_CHANGED)
+    if pending['bump']:
+        bump_estimate_versions(pending['bump'])
+    versions = record_estimate_changes(pending['estimates'], pending['items'])
+    # Версии в сохраненных экземплярах, как после refresh_from_db
+    for estimate_id, instances in pending['estimates'].items():
+        for instance in instances:
+            instance.version = versions.get(estimate_id, instance.version)
+    if pending['sections']:
+        bump_version(*pending['sections'])
+        if not committed:
+            # Сброс до фиксации: данные, закэшированные до коммита, должны устареть и после него
+            transaction.on_commit(partial(bump_version, *pending['sections']))
+
+
+@contextmanager
+def changes_atomic():
+    """
+    transaction.atomic, в котором отложенные версии и события смет внешнего
+    блока записываются перед фиксацией - атомарно с данными, а не в on_commit.
+    Во вложенном блоке изменения копятся до фиксации внешней транзакции.
+    """
+    outermost = not transaction.get_connection().in_atomic_block
+    with transaction.atomic():
+        yield
+        if outermost:
+            flush_pending_changes()
+
+
+@receiver([post_save, post_delete], sender=Estimate)
+@receiver([post_save, post_delete], sender=EstimateItem)
+def invalidate_estimates(sender, **kwargs):
+    defer_invalidate(SECTION_ESTIMATES)
+
+
+@receiver(post_save, sender=Estimate)
+def estimate_saved_event(sender, instance, created, **kwargs):
+    defer_estimate_change(instance.estimate_id, bump=not created, instance=instance)
+
+
+@receiver(post_delete, sender=Estimate)
+def estimate_deleted_event(sender, instance, **kwargs):
+    record_event(ChangeEvent.KIND_ESTIMATE_DELETED, instance.estimate_id, instance.foreman_id)
+
+
+@receiver(post_init, sender=EstimateItem)
+def remember_snapshot_work_type(sender, instance, **kwargs):
+    # Работа, с которой снят снимок; через __dict__ - без запроса для отложенного поля
+    instance._snapshot_work_type_id = instance.__dict__.get('work_type_id')
+
+
+@receiver(pre_save, sender=EstimateItem)
+def snapshot_work_type(sender, instance, **kwargs):
+    """
+    Снимок названия, единицы и категории работы при добавлении позиции и при
+    замене в ней работы. Остальные изменения позиции снимок не трогают.
+    """
+    work_type_changed = (
+        not instance._state.adding
+        and getattr(instance, '_snapshot_work_type_id', instance.work_type_id) != instance.work_type_id
+    )
+    if not work_type_changed and (not instance._state.adding or instance.work_name):
+        return
+    snapshot = work_type_snapshot(instance.work_type_id)
+    if snapshot is None:
+        # Работа добавлена после загрузки каталога процессом
+        work_type = WorkType.objects.select_related('category').get(pk=instance.work_type_id)
+        snapshot = (work_type.work_name, work_type.unit_of_measurement, work_type.category.category_name)
+    instance.work_name, instance.unit_of_measurement, instance.category_name = snapshot
+    instance._snapshot_work_type_id = instance.work_type_id
+
+
+@receiver([post_save, post_delete], sender=EstimateItem)
+def estimate_items_changed(sender, instance, **kwargs):
+    if isinstance(kwargs.get('origin'), Estimate):
+        # Позиции удаляются вместе со сметой - достаточно события удаления сметы
+        return
+    defer_estimate_change(instance.estimate_id, items_changed=True)
+
+
+@receiver([post_save, post_delete], sender=Project)
+@receiver([post_save, post_delete], sender=ProjectAssignment)
+def invalidate_projects(sender, **kwargs):
+    defer_invalidate(SECTION_PROJECTS)
+
+
+@receiver([post_save, post_delete], sender=Status)
+def invalidate_statuses(sender, **kwargs):
+    defer_invalidate(SECTION_STATUSES)
+
+
+@receiver([post_save, post_delete], sender=Role)
+def invalidate_roles(sender, **kwargs):
+    defer_invalidate(SECTION_ROLES)
+
+
+@receiver([post_save, post_delete], sender=WorkCategory)
+@receiver([post_save, post_delete], sender=WorkType)
+@receiver([post_save, post_delete], sender=WorkPrice)
+def invalidate_catalog(sender, **kwargs):
+    defer_invalidate(SECTION_CATALOG)
+    defer_catalog_change()
+
+
+@receiver([post_save, post_delete], sender=User)
+def invalidate_users(sender, **kwargs):
+    defer_invalidate(SECTION_USERS)
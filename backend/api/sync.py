@@ -0,0 +1,252 @@
+"""
+Офлайн-синхронизация: применение очереди изменений, накопленных мобильным клиентом.
+
+Изменения применяются по порядку в одной транзакции, каждое - в своей точке
+сохранения, поэтому ошибка одного изменения не отменяет остальные.
+Конфликты определяются по версии сметы (Estimate.version), которую клиент
+видел перед тем, как потерять связь.
+"""
+
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from .catalog import work_type_prices
+from .models import Estimate, EstimateItem, Project, SyncMutation, User, WorkType
+from .registry import draft_status
+
+MUTATION_CREATE_ESTIMATE = 'create_estimate'
+MUTATION_ADD_ITEM = 'add_item'
+MUTATION_CHANGE_QUANTITY = 'change_quantity'
+MUTATION_DELETE_ITEM = 'delete_item'
+MUTATION_TYPES = (MUTATION_CREATE_ESTIMATE, MUTATION_ADD_ITEM, MUTATION_CHANGE_QUANTITY, MUTATION_DELETE_ITEM)
+
+RESULT_APPLIED = 'applied'
+RESULT_CONFLICT = 'conflict'
+RESULT_ERROR = 'error'
+RESULT_FORBIDDEN = 'forbidden'
+RESULT_NOT_FOUND = 'not_found'
+RESULT_SKIPPED = 'skipped'
+
+
+def bump_estimate_versions(estimate_ids):
+    """Увеличивает версии смет одним UPDATE"""
+    return Estimate.objects.filter(pk__in=estimate_ids).update(version=F('version') + 1)
+
+
+class MutationFailed(Exception):
+    def __init__(self, status, message, **extra):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.extra = extra
+
+
+class SyncSession:
+    """Применение одной пачки изменений от пользователя"""
+
+    def __init__(self, user):
+        self.user = user
+        self.is_manager = user.is_manager
+        # Сметы и работы, созданные в этой пачке: client_id -> id
+        self.estimate_refs = {}
+        self.item_refs = {}
+        # Версии смет на момент начала синхронизации
+        self.start_versions = {}
+        self.estimates = {}
+
+    def apply(self, mutations):
+        from .signals import changes_atomic
+        # Версии и события смет пишутся в транзакции вместе с изменениями
+        with changes_atomic():
+            return [self.apply_one(mutation) for mutation in mutations]
+
+    def apply_one(self, mutation):
+        client_id = mutation['client_id']
+        stored = SyncMutation.objects.filter(user=self.user, client_id=client_id).values_list('result', flat=True).first()
+        if stored is not None:
+            # Повтор уже примененного изменения (клиент не получил ответ)
+            self.remember_refs(mutation, stored)
+            return {**stored, 'replayed': True}
+
+        try:
+            with transaction.atomic():
+                result = self.dispatch(mutation)
+                result = {'client_id': client_id, 'status': RESULT_APPLIED, **result}
+                SyncMutation.objects.create(user=self.user, client_id=client_id, result=result)
+        except MutationFailed as exc:
+            result = {'client_id': client_id, 'status': exc.status, 'error': exc.message, **exc.extra}
+        except IntegrityError as exc:
+            result = {'client_id': client_id, 'status': RESULT_ERROR, 'error': str(exc)}
+
+        self.remember_refs(mutation, result)
+        return result
+
+    def remember_refs(self, mutation, result):
+        if result.get('status') != RESULT_APPLIED:
+            return
+        if mutation['type'] == MUTATION_CREATE_ESTIMATE:
+            self.estimate_refs[mutation['client_id']] = result['estimate_id']
+        elif mutation['type'] == MUTATION_ADD_ITEM:
+            self.item_refs[mutation['client_id']] = result['item_id']
+
+    def dispatch(self, mutation):
+        handlers = {
+            MUTATION_CREATE_ESTIMATE: self.create_estimate,
+            MUTATION_ADD_ITEM: self.add_item,
+            MUTATION_CHANGE_QUANTITY: self.change_quantity,
+            MUTATION_DELETE_ITEM: self.delete_item,
+        }
+        return handlers[mutation['type']](mutation)
+
+    # --- Поиск и проверка доступа ---
+
+    def resolve_ref(self, mutation, id_field, ref_field, refs):
+        if mutation.get(id_field):
+            return mutation[id_field]
+        ref = mutation.get(ref_field)
+        if ref is None:
+            raise MutationFailed(RESULT_ERROR, f'Не указан {id_field} или {ref_field}')
+        if ref not in refs:
+            raise MutationFailed(RESULT_SKIPPED, f'Изменение {ref} не было применено')
+        return refs[ref]
+
+    def get_estimate(self, estimate_id):
+        if estimate_id not in self.estimates:
+            from .signals import flush_pending_changes
+            # Версии должны учитывать изменения, еще не записанные до фиксации
+            flush_pending_changes()
+            estimate = Estimate.objects.select_for_update().filter(pk=estimate_id).first()
+            if estimate is None:
+                raise MutationFailed(RESULT_NOT_FOUND, f'Смета {estimate_id} не найдена')
+            self.estimates[estimate_id] = estimate
+            self.start_versions.setdefault(estimate_id, estimate.version)
+        estimate = self.estimates[estimate_id]
+        if not self.is_manager and estimate.foreman_id != self.user.user_id:
+            raise MutationFailed(RESULT_FORBIDDEN, 'Нет доступа к данной смете')
+        return estimate
+
+    def check_version(self, mutation, estimate):
+        """Изменение существующей работы допустимо, только если смета не менялась после base_version"""
+        base_version = mutation.get('base_version')
+        start_version = self.start_versions[estimate.estimate_id]
+        if base_version is not None and base_version != start_version:
+            raise MutationFailed(
+                RESULT_CONFLICT, 'Смета была изменена на сервере',
+                estimate_id=estimate.estimate_id, version=self.current_version(estimate.estimate_id),
+            )
+
+    def get_item(self, mutation):
+        item_id = self.resolve_ref(mutation, 'item_id', 'item_client_id', self.item_refs)
+        item = EstimateItem.objects.filter(pk=item_id).first()
+        if item is None:
+            raise MutationFailed(RESULT_NOT_FOUND, f'Работа {item_id} не найдена')
+        estimate = self.get_estimate(item.estimate_id)
+        if not self.is_manager and item.added_by_id != self.user.user_id:
+            raise MutationFailed(RESULT_FORBIDDEN, 'Можно изменять только свои работы')
+        self.check_version(mutation, estimate)
+        return item, estimate
+
+    def validated_data(self, serializer_class, mutation):
+        serializer = serializer_class(data=mutation.get('data') or {})
+        if not serializer.is_valid():
+            raise MutationFailed(RESULT_ERROR, 'Некорректные данные', errors=serializer.errors)
+        return serializer.validated_data
+
+    def current_version(self, estimate_id):
+        from .signals import flush_pending_changes
+        flush_pending_changes()
+        return Estimate.objects.filter(pk=estimate_id).values_list('version', flat=True).first()
+
+    # --- Обработчики изменений ---
+
+    def create_estimate(self, mutation):
+        from .serializers import SyncEstimateDataSerializer
+        data = self.validated_data(SyncEstimateDataSerializer, mutation)
+        name = data['name'].strip()
+        if not name:
+            raise MutationFailed(RESULT_ERROR, 'Название сметы обязательно для заполнения')
+        project = Project.objects.filter(pk=data['project_id']).first()
+        if project is None:
+            raise MutationFailed(RESULT_NOT_FOUND, 'Проект не найден')
+
+        foreman = self.user
+        if self.is_manager and data.get('foreman_id'):
+            foreman = User.objects.filter(pk=data['foreman_id']).first()
+            if foreman is None:
+                raise MutationFailed(RESULT_NOT_FOUND, 'Прораб не найден')
+
+        estimate = Estimate.objects.create(
+            estimate_number=name,
+            project=project,
+            creator=self.user,
+            foreman=foreman,
+            status=draft_status(),
+        )
+        self.estimates[estimate.estimate_id] = estimate
+        self.start_versions[estimate.estimate_id] = estimate.version
+        return {'estimate_id': estimate.estimate_id, 'version': estimate.version}
+
+    def add_item(self, mutation):
+        estimate_id = self.resolve_ref(mutation, 'estimate_id', 'estimate_client_id', self.estimate_refs)
+        estimate = self.get_estimate(estimate_id)
+        from .serializers import SyncItemDataSerializer, merge_or_create_item
+        data = self.validated_data(SyncItemDataSerializer, mutation)
+
+        work_type = WorkType.objects.filter(pk=data['work_type']).first()
+        if work_type is None:
+            raise MutationFailed(RESULT_NOT_FOUND, 'Тип работы не найден')
+
+        cost_price = data.get('cost_price_per_unit')
+        client_price = data.get('client_price_per_unit')
+        if cost_price is None or client_price is None:
+            # Цены не переданы - берем текущие цены каталога
+            prices = work_type_prices(work_type.work_type_id)
+            if prices is None:
+                raise MutationFailed(RESULT_ERROR, 'Для работы не задана цена')
+            cost_price = prices[0] if cost_price is None else cost_price
+            client_price = prices[1] if client_price is None else client_price
+
+        item, _ = merge_or_create_item(
+            estimate=estimate,
+            work_type=work_type,
+            added_by=self.user,
+            quantity=data['quantity'],
+            cost_price_per_unit=cost_price,
+            client_price_per_unit=client_price,
+        )
+        return {'estimate_id': estimate_id, 'item_id': item.item_id, 'version': self.current_version(estimate_id)}
+
+    def change_quantity(self, mutation):
+        item, estimate = self.get_item(mutation)
+        from .serializers import SyncQuantityDataSerializer
+        data = self.validated_data(SyncQuantityDataSerializer, mutation)
+        item.quantity = data['quantity']
+        item.save(update_fields=['quantity'])
+        return {
+            'estimate_id': estimate.estimate_id,
+            'item_id': item.item_id,
+            'version': self.current_version(estimate.estimate_id),
+        }
+
+    def delete_item(self, mutation):
+        item, estimate = self.get_item(mutation)
+        item_id = item.item_id
+        item.delete()
+        return {
+            'estimate_id': estimate.estimate_id,
+            'item_id': item_id,
+            'version': self.current_version(estimate.estimate_id),
+        }
+
+
+def apply_mutations(user, mutations):
+    """Применяет очередь изменений; возвращает результаты по каждому изменению и версии затронутых смет"""
+    session = SyncSession(user)
+    results = session.apply(mutations)
+    from .signals import flush_pending_changes
+    flush_pending_changes()
+    estimates = Estimate.objects.filter(pk__in=list(session.estimates))
+    if not session.is_manager:
+        estimates = estimates.filter(foreman=user)
+    versions = dict(estimates.values_list('estimate_id', 'version'))
+    return {'results': results, 'versions': {str(key): value for key, value in versions.items()}}
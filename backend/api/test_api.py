@@ -2,13 +2,18 @@
 Comprehensive API tests for the estimate management system
 """
 
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from rest_framework.test import APITestCase, APIClient
 from rest_framework import status
 from django.contrib.auth.hashers import make_password
 import json
+from decimal import Decimal
 
+from api.catalog import clear_catalog_prices, work_type_prices
+from api import registry
 from api.models import (
     User, Role, AuthToken, Project, Estimate, WorkCategory, WorkType, 
     WorkPrice, EstimateItem, Status, ProjectAssignment, Client
@@ -495,4 +500,1274 @@ class ExcelExportTestCase(APITestCase):
         self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.manager_token.token}')
         
         response = self.client.get('/api/v1/estimates/999/export/internal/')
-        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
\ No newline at end of file
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_foreman_exports_only_own_estimates(self):
+        """Test that a foreman cannot export an estimate of another foreman"""
+        foreman_role = Role.objects.create(role_name='прораб')
+        foreman = User.objects.create(
+            email='foreman@test.com',
+            full_name='Test Foreman',
+            password_hash=make_password('testpass123'),
+            role=foreman_role
+        )
+        own_estimate = Estimate.objects.create(
+            estimate_number='OWN-001', project=self.project, creator=self.manager, foreman=foreman,
+            status=self.status
+        )
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AuthToken.objects.create(user=foreman).token}')
+
+        own = self.client.get(f'/api/v1/estimates/{own_estimate.estimate_id}/export/client/')
+        other = self.client.get(f'/api/v1/estimates/{self.estimate.estimate_id}/export/client/')
+
+        self.assertEqual(own.status_code, status.HTTP_200_OK)
+        self.assertEqual(other.status_code, status.HTTP_404_NOT_FOUND)
+
+class EstimateRepriceTestCase(APITestCase):
+    """Tests for set-based repricing of estimate items"""
+
+    def setUp(self):
+        self.manager_role = Role.objects.create(role_name='менеджер')
+        self.foreman_role = Role.objects.create(role_name='прораб')
+
+        self.manager = User.objects.create(
+            email='manager@test.com',
+            full_name='Test Manager',
+            password_hash=make_password('testpass123'),
+            role=self.manager_role
+        )
+        self.foreman = User.objects.create(
+            email='foreman@test.com',
+            full_name='Test Foreman',
+            password_hash=make_password('testpass123'),
+            role=self.foreman_role
+        )
+        self.manager_token = AuthToken.objects.create(user=self.manager)
+        self.foreman_token = AuthToken.objects.create(user=self.foreman)
+
+        self.project = Project.objects.create(project_name='Test Project')
+        self.draft = Status.objects.create(status_name='Черновик')
+        self.done = Status.objects.create(status_name='Завершена')
+        self.category = WorkCategory.objects.create(category_name='Test Category')
+        self.work_type = WorkType.objects.create(
+            work_name='Test Work',
+            category=self.category,
+            unit_of_measurement='шт'
+        )
+        WorkPrice.objects.create(work_type=self.work_type, cost_price=120.00, client_price=180.00)
+
+        self.open_estimate = Estimate.objects.create(
+            estimate_number='OPEN-001', project=self.project,
+            creator=self.manager, foreman=self.foreman, status=self.draft
+        )
+        self.closed_estimate = Estimate.objects.create(
+            estimate_number='DONE-001', project=self.project,
+            creator=self.manager, foreman=self.foreman, status=self.done
+        )
+        for estimate in (self.open_estimate, self.closed_estimate):
+            EstimateItem.objects.create(
+                estimate=estimate,
+                work_type=self.work_type,
+                quantity=10,
+                cost_price_per_unit=100.00,
+                client_price_per_unit=150.00
+            )
+
+    def test_dry_run_reports_deltas_without_changes(self):
+        """Test that dry run reports deltas and leaves prices untouched"""
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.manager_token.token}')
+
+        data = {'status_ids': [self.draft.status_id], 'dry_run': True}
+        response = self.client.post('/api/v1/estimates/reprice/', json.dumps(data), content_type='application/json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['estimates_count'], 1)
+        self.assertEqual(response.data['total_cost_delta'], '200.00')
+        self.assertEqual(response.data['total_client_delta'], '300.00')
+        item = EstimateItem.objects.get(estimate=self.open_estimate)
+        self.assertEqual(float(item.cost_price_per_unit), 100.00)
+
+    def test_catalog_repricing_updates_only_selected_statuses(self):
+        """Test that catalog prices are applied only to estimates in selected statuses"""
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.manager_token.token}')
+
+        data = {'status_ids': [self.draft.status_id]}
+        response = self.client.post('/api/v1/estimates/reprice/', json.dumps(data), content_type='application/json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        open_item = EstimateItem.objects.get(estimate=self.open_estimate)
+        closed_item = EstimateItem.objects.get(estimate=self.closed_estimate)
+        self.assertEqual(float(open_item.cost_price_per_unit), 120.00)
+        self.assertEqual(float(open_item.client_price_per_unit), 180.00)
+        self.assertEqual(float(closed_item.cost_price_per_unit), 100.00)
+
+    def test_category_percent_repricing(self):
+        """Test percentage repricing per category"""
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.manager_token.token}')
+
+        data = {
+            'status_ids': [self.draft.status_id],
+            'category_percents': {str(self.category.category_id): '10'}
+        }
+        response = self.client.post('/api/v1/estimates/reprice/', json.dumps(data), content_type='application/json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['total_client_delta'], '150.00')
+        item = EstimateItem.objects.get(estimate=self.open_estimate)
+        self.assertEqual(float(item.cost_price_per_unit), 110.00)
+        self.assertEqual(float(item.client_price_per_unit), 165.00)
+
+    def test_foreman_cannot_reprice(self):
+        """Test that foreman cannot run repricing"""
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.foreman_token.token}')
+
+        data = {'status_ids': [self.draft.status_id]}
+        response = self.client.post('/api/v1/estimates/reprice/', json.dumps(data), content_type='application/json')
+
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class EstimatePricingRuleTestCase(APITestCase):
+    """Tests for server-side pricing rules applied to an estimate"""
+
+    def setUp(self):
+        self.manager_role = Role.objects.create(role_name='менеджер')
+        self.manager = User.objects.create(
+            email='manager@test.com',
+            full_name='Test Manager',
+            password_hash=make_password('testpass123'),
+            role=self.manager_role
+        )
+        self.manager_token = AuthToken.objects.create(user=self.manager)
+
+        self.project = Project.objects.create(project_name='Test Project')
+        self.status = Status.objects.create(status_name='Черновик')
+        self.category = WorkCategory.objects.create(category_name='Test Category')
+        self.other_category = WorkCategory.objects.create(category_name='Other Category')
+        self.work_type = WorkType.objects.create(
+            work_name='Test Work', category=self.category, unit_of_measurement='шт'
+        )
+        self.other_work_type = WorkType.objects.create(
+            work_name='Other Work', category=self.other_category, unit_of_measurement='м2'
+        )
+        self.estimate = Estimate.objects.create(
+            estimate_number='TEST-001', project=self.project,
+            creator=self.manager, foreman=self.manager, status=self.status
+        )
+        self.item = EstimateItem.objects.create(
+            estimate=self.estimate, work_type=self.work_type,
+            quantity=2, cost_price_per_unit=100.00, client_price_per_unit=101.00
+        )
+        self.other_item = EstimateItem.objects.create(
+            estimate=self.estimate, work_type=self.other_work_type,
+            quantity=1, cost_price_per_unit=50.00, client_price_per_unit=52.00
+        )
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.manager_token.token}')
+
+    def post_rule(self, data):
+        return self.client.post(
+            f'/api/v1/estimates/{self.estimate.estimate_id}/pricing-rules/',
+            json.dumps(data), content_type='application/json'
+        )
+
+    def test_markup_rule(self):
+        """Test markup applied to cost price of all items"""
+        response = self.post_rule({'rule': 'markup', 'value': '1.5'})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['items_updated'], 2)
+        self.assertEqual(response.data['total_client'], '375.00')
+        self.assertEqual(response.data['total_profit'], '125.00')
+
+    def test_round_rule(self):
+        """Test rounding client price to a step"""
+        response = self.post_rule({'rule': 'round', 'value': '5'})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.item.refresh_from_db()
+        self.other_item.refresh_from_db()
+        self.assertEqual(float(self.item.client_price_per_unit), 100.00)
+        self.assertEqual(float(self.other_item.client_price_per_unit), 50.00)
+
+    def test_category_margin_rule(self):
+        """Test margin applied only to the selected category"""
+        response = self.post_rule({
+            'rule': 'category_margin', 'value': '20',
+            'category_ids': [self.category.category_id]
+        })
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['items_updated'], 1)
+        self.item.refresh_from_db()
+        self.other_item.refresh_from_db()
+        self.assertEqual(float(self.item.client_price_per_unit), 120.00)
+        self.assertEqual(float(self.other_item.client_price_per_unit), 52.00)
+
+    def test_category_margin_per_category(self):
+        """Test that each category gets its own margin"""
+        response = self.post_rule({
+            'rule': 'category_margin',
+            'category_margins': {str(self.category.category_id): '20', str(self.other_category.category_id): '50'},
+        })
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['items_updated'], 2)
+        self.item.refresh_from_db()
+        self.other_item.refresh_from_db()
+        self.assertEqual(self.item.client_price_per_unit, Decimal('120.00'))
+        self.assertEqual(self.other_item.client_price_per_unit, Decimal('75.00'))
+
+    def test_category_margin_rejects_invalid_margins(self):
+        """Test that per-category margins must be above -100% and keyed by category ID"""
+        too_low = self.post_rule({
+            'rule': 'category_margin', 'category_margins': {str(self.category.category_id): '-100'},
+        })
+        bad_key = self.post_rule({'rule': 'category_margin', 'category_margins': {'abc': '10'}})
+
+        self.assertEqual(too_low.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(bad_key.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_category_margin_requires_categories(self):
+        """Test that category margin rule requires category_ids"""
+        response = self.post_rule({'rule': 'category_margin', 'value': '20'})
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class WorkPriceHistoryTestCase(APITestCase):
+    """Tests for append-only price history and as-of lookups"""
+
+    def setUp(self):
+        self.manager_role = Role.objects.create(role_name='менеджер')
+        self.manager = User.objects.create(
+            email='manager@test.com',
+            full_name='Test Manager',
+            password_hash=make_password('testpass123'),
+            role=self.manager_role
+        )
+        self.manager_token = AuthToken.objects.create(user=self.manager)
+        self.category = WorkCategory.objects.create(category_name='Test Category')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.manager_token.token}')
+
+    def test_price_changes_are_recorded(self):
+        """Test that create and price update append history rows"""
+        from django.utils import timezone
+        from api.models import WorkPriceHistory
+
+        response = self.client.post('/api/v1/work-types/', {
+            'work_name': 'Test Work', 'category_id': self.category.category_id,
+            'unit_of_measurement': 'шт', 'cost_price': '100.00', 'client_price': '150.00'
+        })
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        work_type_id = response.data['work_type_id']
+        between = timezone.now()
+
+        response = self.client.patch(f'/api/v1/work-types/{work_type_id}/', {'client_price': '170.00'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # Повторное сохранение без изменения цены не создает запись
+        self.client.patch(f'/api/v1/work-types/{work_type_id}/', {'client_price': '170.00'})
+
+        self.assertEqual(WorkPriceHistory.objects.filter(work_type_id=work_type_id).count(), 2)
+
+        response = self.client.get('/api/v1/work-types/prices/', {'as_of': between.isoformat()})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['prices']), 1)
+        self.assertEqual(response.data['prices'][0]['client_price'], '150.00')
+
+        response = self.client.get('/api/v1/work-types/prices/')
+        self.assertEqual(response.data['prices'][0]['client_price'], '170.00')
+
+        response = self.client.get(f'/api/v1/work-types/{work_type_id}/price-history/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([row['client_price'] for row in response.data], ['150.00', '170.00'])
+
+    def test_snapshot_before_first_price_is_empty(self):
+        """Test that work types without history at the date are omitted"""
+        work_type = WorkType.objects.create(
+            work_name='Test Work', category=self.category, unit_of_measurement='шт'
+        )
+        from api.pricing import record_price_history
+        record_price_history([WorkPrice.objects.create(work_type=work_type, cost_price=1, client_price=2)])
+
+        response = self.client.get('/api/v1/work-types/prices/', {'as_of': '2000-01-01'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['prices'], [])
+
+    def test_invalid_date_rejected(self):
+        """Test that invalid as_of is rejected"""
+        response = self.client.get('/api/v1/work-types/prices/', {'as_of': 'yesterday'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_import_with_unchanged_prices_keeps_history(self):
+        """Test that importing float cells equal to current prices appends no history rows"""
+        import io
+        import openpyxl
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from api.models import WorkPriceHistory
+        from api.pricing import record_price_history
+
+        work_type = WorkType.objects.create(
+            work_name='Test Work', category=self.category, unit_of_measurement='шт'
+        )
+        record_price_history([WorkPrice.objects.create(
+            work_type=work_type, cost_price=Decimal('100.10'), client_price=Decimal('150.15')
+        )])
+
+        workbook = openpyxl.Workbook()
+        sheet = workbook.active
+        sheet.append(['Наименование', 'Категория', 'Ед. изм.', 'Себестоимость', 'Цена клиента'])
+        # Ячейки xlsx читаются как float, цена клиента - с точностью больше копеек
+        sheet.append(['Test Work', 'Test Category', 'шт', 100.1, 150.149])
+        buffer = io.BytesIO()
+        workbook.save(buffer)
+        upload = SimpleUploadedFile('work_types.xlsx', buffer.getvalue())
+
+        response = self.client.post('/api/v1/work-types/import/', {'file': upload}, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(WorkPriceHistory.objects.filter(work_type=work_type).count(), 1)
+
+
+class FinanceSummaryTestCase(APITestCase):
+    """Tests for server-side finance aggregates"""
+
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+
+        # Данные теста фиксируются заранее: отложенные сбросы кэша не попадают в проверки
+        with self.captureOnCommitCallbacks(execute=True):
+            self.manager_role = Role.objects.create(role_name='менеджер')
+            self.foreman_role = Role.objects.create(role_name='прораб')
+            self.manager = User.objects.create(
+                email='manager@test.com',
+                full_name='Test Manager',
+                password_hash=make_password('testpass123'),
+                role=self.manager_role
+            )
+            self.foreman = User.objects.create(
+                email='foreman@test.com',
+                full_name='Test Foreman',
+                password_hash=make_password('testpass123'),
+                role=self.foreman_role
+            )
+            self.manager_token = AuthToken.objects.create(user=self.manager)
+            self.foreman_token = AuthToken.objects.create(user=self.foreman)
+
+            self.project = Project.objects.create(project_name='Test Project')
+            self.status = Status.objects.create(status_name='Черновик')
+            self.category = WorkCategory.objects.create(category_name='Test Category')
+            self.work_type = WorkType.objects.create(
+                work_name='Test Work', category=self.category, unit_of_measurement='шт'
+            )
+            self.estimate = Estimate.objects.create(
+                estimate_number='TEST-001', project=self.project,
+                creator=self.foreman, foreman=self.foreman, status=self.status
+            )
+            self.foreman_item = EstimateItem.objects.create(
+                estimate=self.estimate, work_type=self.work_type, quantity=2,
+                cost_price_per_unit=100.00, client_price_per_unit=150.00, added_by=self.foreman
+            )
+            EstimateItem.objects.create(
+                estimate=self.estimate, work_type=self.work_type, quantity=1,
+                cost_price_per_unit=10.00, client_price_per_unit=20.00, added_by=self.manager
+            )
+
+    def test_manager_sees_all_items(self):
+        """Test that manager totals include all items"""
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.manager_token.token}')
+        response = self.client.get('/api/v1/finance/summary/')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['groups']), 1)
+        group = response.data['groups'][0]
+        self.assertEqual(group['project_name'], 'Test Project')
+        self.assertEqual(group['status'], 'Черновик')
+        self.assertEqual(group['estimates_count'], 1)
+        self.assertEqual(group['total_cost'], '210.00')
+        self.assertEqual(group['total_client'], '320.00')
+        self.assertEqual(response.data['totals']['total_profit'], '110.00')
+
+    def test_foreman_sees_only_own_items(self):
+        """Test that foreman totals include only items added by the foreman"""
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.foreman_token.token}')
+        response = self.client.get('/api/v1/finance/summary/')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['totals']['total_cost'], '200.00')
+        self.assertEqual(response.data['totals']['total_client'], '300.00')
+
+    def test_summary_cache_invalidated_on_item_change(self):
+        """Test that cached summary is refreshed after an item change"""
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.foreman_token.token}')
+        self.client.get('/api/v1/finance/summary/')
+
+        self.foreman_item.quantity = 3
+        with self.captureOnCommitCallbacks(execute=True):
+            self.foreman_item.save()
+
+        with self.assertNumQueries(2):  # Аутентификация + сводка
+            response = self.client.get('/api/v1/finance/summary/')
+        self.assertEqual(response.data['totals']['total_cost'], '300.00')
+
+        with self.assertNumQueries(1):  # Только аутентификация
+            self.client.get('/api/v1/finance/summary/')
+
+
+class EstimateCategoryBreakdownTestCase(APITestCase):
+    """Tests for per-category estimate subtotals"""
+
+    def setUp(self):
+        self.manager_role = Role.objects.create(role_name='менеджер')
+        self.foreman_role = Role.objects.create(role_name='прораб')
+        self.manager = User.objects.create(
+            email='manager@test.com',
+            full_name='Test Manager',
+            password_hash=make_password('testpass123'),
+            role=self.manager_role
+        )
+        self.foreman = User.objects.create(
+            email='foreman@test.com',
+            full_name='Test Foreman',
+            password_hash=make_password('testpass123'),
+            role=self.foreman_role
+        )
+        self.other_foreman = User.objects.create(
+            email='other@test.com',
+            full_name='Other Foreman',
+            password_hash=make_password('testpass123'),
+            role=self.foreman_role
+        )
+        self.manager_token = AuthToken.objects.create(user=self.manager)
+        self.foreman_token = AuthToken.objects.create(user=self.foreman)
+        self.other_token = AuthToken.objects.create(user=self.other_foreman)
+
+        self.project = Project.objects.create(project_name='Test Project')
+        self.status = Status.objects.create(status_name='Черновик')
+        walls = WorkCategory.objects.create(category_name='Стены')
+        floors = WorkCategory.objects.create(category_name='Полы')
+        plaster = WorkType.objects.create(work_name='Штукатурка', category=walls, unit_of_measurement='м2')
+        paint = WorkType.objects.create(work_name='Покраска', category=walls, unit_of_measurement='м2')
+        screed = WorkType.objects.create(work_name='Стяжка', category=floors, unit_of_measurement='м2')
+
+        self.estimate = Estimate.objects.create(
+            estimate_number='TEST-001', project=self.project,
+            creator=self.foreman, foreman=self.foreman, status=self.status
+        )
+        EstimateItem.objects.create(
+            estimate=self.estimate, work_type=plaster, quantity=10,
+            cost_price_per_unit=10.00, client_price_per_unit=15.00, added_by=self.foreman
+        )
+        EstimateItem.objects.create(
+            estimate=self.estimate, work_type=paint, quantity=10,
+            cost_price_per_unit=5.00, client_price_per_unit=8.00, added_by=self.foreman
+        )
+        EstimateItem.objects.create(
+            estimate=self.estimate, work_type=screed, quantity=2,
+            cost_price_per_unit=100.00, client_price_per_unit=130.00, added_by=self.manager
+        )
+        self.url = f'/api/v1/estimates/{self.estimate.estimate_id}/categories/'
+
+    def test_manager_breakdown(self):
+        """Test subtotals per category for manager"""
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.manager_token.token}')
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        categories = {row['category_name']: row for row in response.data['categories']}
+        self.assertEqual(categories['Стены']['items_count'], 2)
+        self.assertEqual(categories['Стены']['total_cost'], '150.00')
+        self.assertEqual(categories['Стены']['total_profit'], '80.00')
+        self.assertEqual(categories['Полы']['total_client'], '260.00')
+        self.assertEqual(response.data['totals']['total_cost'], '350.00')
+
+    def test_breakdown_does_not_join_work_types(self):
+        """Test that subtotals are grouped by the item snapshot without joining the catalog"""
+        from api.finance import category_breakdown
+
+        with CaptureQueriesContext(connection) as context:
+            breakdown = category_breakdown(EstimateItem.objects.filter(estimate=self.estimate))
+
+        self.assertEqual([row['category_name'] for row in breakdown], ['Полы', 'Стены'])
+        self.assertEqual(len(context.captured_queries), 1)
+        self.assertNotIn('api_worktype', context.captured_queries[0]['sql'])
+
+    def test_foreman_breakdown_only_own_items(self):
+        """Test that foreman subtotals include only own items"""
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.foreman_token.token}')
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([row['category_name'] for row in response.data['categories']], ['Стены'])
+        self.assertEqual(response.data['totals']['total_client'], '230.00')
+
+    def test_other_foreman_has_no_access(self):
+        """Test that other foreman cannot read the breakdown"""
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.other_token.token}')
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_export_uses_category_subtotals(self):
+        """Test that internal export writes subtotals from the aggregation"""
+        import io
+        import openpyxl
+
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.manager_token.token}')
+        response = self.client.get(f'/api/v1/estimates/{self.estimate.estimate_id}/export/internal/')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        sheet = openpyxl.load_workbook(io.BytesIO(response.content)).active
+        subtotals = [row[5] for row in sheet.iter_rows(values_only=True) if row[1] == 'Итого по разделу:']
+        self.assertEqual(sorted(subtotals), [150.0, 200.0])
+        grand_total = [row[5] for row in sheet.iter_rows(values_only=True) if row[1] == 'ОБЩИЙ ИТОГ:']
+        self.assertEqual(grand_total, [350.0])
+
+
+class BootstrapTestCase(APITestCase):
+    """Tests for the mobile bootstrap endpoint"""
+
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+
+        # Данные теста фиксируются заранее: отложенные сбросы кэша не попадают в проверки
+        with self.captureOnCommitCallbacks(execute=True):
+            self.manager_role = Role.objects.create(role_name='менеджер')
+            self.foreman_role = Role.objects.create(role_name='прораб')
+            self.manager = User.objects.create(
+                email='manager@test.com',
+                full_name='Test Manager',
+                password_hash=make_password('testpass123'),
+                role=self.manager_role
+            )
+            self.foreman = User.objects.create(
+                email='foreman@test.com',
+                full_name='Test Foreman',
+                password_hash=make_password('testpass123'),
+                role=self.foreman_role
+            )
+            self.foreman_token = AuthToken.objects.create(user=self.foreman)
+
+            self.project = Project.objects.create(project_name='Assigned Project')
+            Project.objects.create(project_name='Other Project')
+            ProjectAssignment.objects.create(user=self.foreman, project=self.project)
+            self.status = Status.objects.create(status_name='Черновик')
+            self.category = WorkCategory.objects.create(category_name='Test Category')
+            WorkType.objects.create(work_name='Test Work', category=self.category, unit_of_measurement='шт')
+            Estimate.objects.create(
+                estimate_number='OWN-001', project=self.project,
+                creator=self.foreman, foreman=self.foreman, status=self.status
+            )
+            Estimate.objects.create(
+                estimate_number='OTHER-001', project=self.project,
+                creator=self.manager, foreman=self.manager, status=self.status
+            )
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.foreman_token.token}')
+
+    def test_bootstrap_returns_role_scoped_sections(self):
+        """Test that bootstrap returns all sections scoped to the foreman"""
+        response = self.client.get('/api/v1/bootstrap/')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['user']['email'], 'foreman@test.com')
+        self.assertEqual([p['project_name'] for p in response.data['projects']], ['Assigned Project'])
+        self.assertEqual([e['estimate_number'] for e in response.data['estimates']], ['OWN-001'])
+        self.assertEqual(len(response.data['statuses']), 1)
+        self.assertEqual(len(response.data['work_categories']), 1)
+        self.assertEqual(len(response.data['work_types']), 1)
+        self.assertEqual(response.data['unchanged'], [])
+
+    def test_known_versions_skip_unchanged_sections(self):
+        """Test that sections with matching versions are omitted"""
+        versions = self.client.get('/api/v1/bootstrap/').data['versions']
+        known = ','.join(f'{section}:{version}' for section, version in versions.items())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            WorkType.objects.create(work_name='New Work', category=self.category, unit_of_measurement='м2')
+        response = self.client.get('/api/v1/bootstrap/', {'versions': known})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('work_types', response.data)
+        self.assertEqual(len(response.data['work_types']), 2)
+        self.assertNotIn('estimates', response.data)
+        self.assertIn('estimates', response.data['unchanged'])
+        self.assertIn('statuses', response.data['unchanged'])
+
+
+class BatchRequestTestCase(APITestCase):
+    """Tests for the generic batch endpoint"""
+
+    def setUp(self):
+        self.manager_role = Role.objects.create(role_name='менеджер')
+        self.foreman_role = Role.objects.create(role_name='прораб')
+        self.manager = User.objects.create(
+            email='manager@test.com',
+            full_name='Test Manager',
+            password_hash=make_password('testpass123'),
+            role=self.manager_role
+        )
+        self.foreman = User.objects.create(
+            email='foreman@test.com',
+            full_name='Test Foreman',
+            password_hash=make_password('testpass123'),
+            role=self.foreman_role
+        )
+        self.manager_token = AuthToken.objects.create(user=self.manager)
+        self.foreman_token = AuthToken.objects.create(user=self.foreman)
+        self.project = Project.objects.create(project_name='Test Project')
+
+    def post_batch(self, data):
+        return self.client.post('/api/v1/batch/', json.dumps(data), content_type='application/json')
+
+    def test_batch_executes_sub_requests(self):
+        """Test that sub-requests are executed and responses returned in order"""
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.manager_token.token}')
+        response = self.post_batch({'requests': [
+            {'method': 'POST', 'path': 'work-categories/', 'body': {'category_name': 'Batch Category'}},
+            {'method': 'GET', 'path': f'projects/{self.project.project_id}/'},
+            {'method': 'GET', 'path': 'no-such-endpoint/'},
+        ]})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        statuses = [item['status'] for item in response.data['responses']]
+        self.assertEqual(statuses, [201, 200, 404])
+        self.assertEqual(response.data['responses'][1]['body']['project_name'], 'Test Project')
+        self.assertTrue(WorkCategory.objects.filter(category_name='Batch Category').exists())
+
+    def test_sub_requests_keep_permission_checks(self):
+        """Test that each sub-request runs its own permission checks"""
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.foreman_token.token}')
+        response = self.post_batch({'requests': [
+            {'method': 'GET', 'path': 'work-categories/'},
+            {'method': 'POST', 'path': 'work-categories/', 'body': {'category_name': 'Forbidden'}},
+        ]})
+
+        self.assertEqual([item['status'] for item in response.data['responses']], [200, 403])
+        self.assertFalse(WorkCategory.objects.filter(category_name='Forbidden').exists())
+
+    def test_atomic_batch_rolls_back_on_error(self):
+        """Test that an atomic batch is rolled back on the first failed sub-request"""
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.manager_token.token}')
+        response = self.post_batch({'atomic': True, 'requests': [
+            {'method': 'POST', 'path': 'work-categories/', 'body': {'category_name': 'Rolled Back'}},
+            {'method': 'POST', 'path': 'work-categories/', 'body': {'category_name': 'Rolled Back'}},
+            {'method': 'GET', 'path': 'work-categories/'},
+        ]})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.data['rolled_back'])
+        self.assertEqual(len(response.data['responses']), 2)
+        self.assertFalse(WorkCategory.objects.filter(category_name='Rolled Back').exists())
+
+    def test_nested_batch_rejected(self):
+        """Test that batch requests cannot be nested"""
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.manager_token.token}')
+        response = self.post_batch({'requests': [
+            {'method': 'POST', 'path': 'batch/', 'body': {'requests': []}},
+        ]})
+
+        self.assertEqual(response.data['responses'][0]['status'], 400)
+
+
+class SyncTestCase(APITestCase):
+    """Tests for offline outbox replay"""
+
+    def setUp(self):
+        self.manager_role = Role.objects.create(role_name='менеджер')
+        self.foreman_role = Role.objects.create(role_name='прораб')
+        self.manager = User.objects.create(
+            email='manager@test.com',
+            full_name='Test Manager',
+            password_hash=make_password('testpass123'),
+            role=self.manager_role
+        )
+        self.foreman = User.objects.create(
+            email='foreman@test.com',
+            full_name='Test Foreman',
+            password_hash=make_password('testpass123'),
+            role=self.foreman_role
+        )
+        self.foreman_token = AuthToken.objects.create(user=self.foreman)
+        self.project = Project.objects.create(project_name='Test Project')
+        self.status = Status.objects.create(status_name='Черновик')
+        self.category = WorkCategory.objects.create(category_name='Test Category')
+        self.work_type = WorkType.objects.create(
+            category=self.category, work_name='Test Work', unit_of_measurement='шт'
+        )
+        WorkPrice.objects.create(work_type=self.work_type, cost_price=100, client_price=150)
+        # Изменения фиксируются так же, как в отдельной транзакции
+        with self.captureOnCommitCallbacks(execute=True):
+            self.estimate = Estimate.objects.create(
+                estimate_number='Test Estimate', project=self.project, status=self.status,
+                creator=self.manager, foreman=self.foreman
+            )
+            self.item = EstimateItem.objects.create(
+                estimate=self.estimate, work_type=self.work_type, quantity=1,
+                cost_price_per_unit=100, client_price_per_unit=150, added_by=self.foreman
+            )
+        self.estimate.refresh_from_db()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.foreman_token.token}')
+
+    def sync(self, mutations):
+        return self.client.post('/api/v1/sync/', {'mutations': mutations}, format='json')
+
+    def test_version_changes_with_items(self):
+        """Test that item changes bump the estimate version"""
+        version = self.estimate.version
+        self.item.quantity = 2
+        with self.captureOnCommitCallbacks(execute=True):
+            self.item.save()
+        self.estimate.refresh_from_db()
+        self.assertEqual(self.estimate.version, version + 1)
+
+    def test_mutations_applied_in_order(self):
+        """Test that a queue with a new estimate and references to it is applied"""
+        response = self.sync([
+            {'client_id': 'e1', 'type': 'create_estimate', 'data': {'name': 'Offline', 'project_id': self.project.project_id}},
+            {'client_id': 'i1', 'type': 'add_item', 'estimate_client_id': 'e1',
+             'data': {'work_type': self.work_type.work_type_id, 'quantity': '2.5'}},
+            {'client_id': 'i2', 'type': 'change_quantity', 'item_client_id': 'i1', 'data': {'quantity': 3}},
+            {'client_id': 'i3', 'type': 'delete_item', 'item_id': self.item.item_id,
+             'base_version': self.estimate.version},
+        ])
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([r['status'] for r in response.data['results']], ['applied'] * 4)
+
+        new_estimate = Estimate.objects.get(estimate_number='Offline')
+        self.assertEqual(new_estimate.foreman, self.foreman)
+        new_item = new_estimate.items.get()
+        self.assertEqual(new_item.quantity, 3)
+        # Цены не переданы - взяты из каталога
+        self.assertEqual(new_item.client_price_per_unit, 150)
+        self.assertFalse(EstimateItem.objects.filter(pk=self.item.item_id).exists())
+        self.assertEqual(response.data['versions'][str(new_estimate.estimate_id)], new_estimate.version)
+
+    def test_stale_version_reports_conflict(self):
+        """Test that changing an item of a modified estimate is reported as a conflict"""
+        base_version = self.estimate.version
+        EstimateItem.objects.create(
+            estimate=self.estimate, work_type=self.work_type, quantity=1,
+            cost_price_per_unit=100, client_price_per_unit=150, added_by=self.manager
+        )
+
+        response = self.sync([
+            {'client_id': 'q1', 'type': 'change_quantity', 'item_id': self.item.item_id,
+             'base_version': base_version, 'data': {'quantity': 5}},
+            {'client_id': 'a1', 'type': 'add_item', 'estimate_id': self.estimate.estimate_id,
+             'base_version': base_version, 'data': {'work_type': self.work_type.work_type_id, 'quantity': 1}},
+        ])
+
+        results = response.data['results']
+        self.assertEqual(results[0]['status'], 'conflict')
+        self.assertEqual(results[0]['version'], base_version + 1)
+        self.assertEqual(results[1]['status'], 'applied')
+        # Изменение количества отклонено, добавленная работа объединена с существующей
+        self.item.refresh_from_db()
+        self.assertEqual(self.item.quantity, 2)
+
+    def test_replayed_mutation_not_applied_twice(self):
+        """Test that resending a mutation with the same client_id returns the stored result"""
+        mutation = {'client_id': 'add-1', 'type': 'add_item', 'estimate_id': self.estimate.estimate_id,
+                    'data': {'work_type': self.work_type.work_type_id, 'quantity': 1}}
+        first = self.sync([mutation])
+        second = self.sync([mutation])
+
+        self.assertEqual(second.data['results'][0]['item_id'], first.data['results'][0]['item_id'])
+        self.assertTrue(second.data['results'][0]['replayed'])
+        # Работа уже была в смете - количество увеличено один раз
+        self.item.refresh_from_db()
+        self.assertEqual(self.estimate.items.count(), 1)
+        self.assertEqual(self.item.quantity, 2)
+
+    def test_foreman_cannot_touch_foreign_estimate(self):
+        """Test that per-mutation access checks are applied"""
+        other_estimate = Estimate.objects.create(
+            estimate_number='Other', project=self.project, status=self.status,
+            creator=self.manager, foreman=self.manager
+        )
+        response = self.sync([
+            {'client_id': 'f1', 'type': 'add_item', 'estimate_id': other_estimate.estimate_id,
+             'data': {'work_type': self.work_type.work_type_id, 'quantity': 1}},
+            {'client_id': 'f2', 'type': 'add_item', 'estimate_id': self.estimate.estimate_id,
+             'data': {'work_type': self.work_type.work_type_id, 'quantity': 0}},
+        ])
+
+        self.assertEqual([r['status'] for r in response.data['results']], ['forbidden', 'error'])
+        self.assertFalse(other_estimate.items.exists())
+        self.assertNotIn(str(other_estimate.estimate_id), response.data['versions'])
+
+
+class EstimateItemMergeTestCase(APITestCase):
+    """Tests for merge-on-write of duplicate work types"""
+
+    def setUp(self):
+        self.manager_role = Role.objects.create(role_name='менеджер')
+        self.foreman_role = Role.objects.create(role_name='прораб')
+        self.manager = User.objects.create(
+            email='manager@test.com',
+            full_name='Test Manager',
+            password_hash=make_password('testpass123'),
+            role=self.manager_role
+        )
+        self.foreman = User.objects.create(
+            email='foreman@test.com',
+            full_name='Test Foreman',
+            password_hash=make_password('testpass123'),
+            role=self.foreman_role
+        )
+        self.manager_token = AuthToken.objects.create(user=self.manager)
+        self.foreman_token = AuthToken.objects.create(user=self.foreman)
+        self.project = Project.objects.create(project_name='Test Project')
+        self.status = Status.objects.create(status_name='Черновик')
+        self.category = WorkCategory.objects.create(category_name='Test Category')
+        self.work_type = WorkType.objects.create(
+            category=self.category, work_name='Test Work', unit_of_measurement='шт'
+        )
+        self.estimate = Estimate.objects.create(
+            estimate_number='Test Estimate', project=self.project, status=self.status,
+            creator=self.manager, foreman=self.foreman
+        )
+
+    def add_item(self, quantity):
+        return self.client.post('/api/v1/estimate-items/', {
+            'estimate': self.estimate.estimate_id,
+            'work_type': self.work_type.work_type_id,
+            'quantity': quantity,
+            'cost_price_per_unit': '100.00',
+            'client_price_per_unit': '150.00',
+        }, format='json')
+
+    def test_duplicate_work_type_increments_quantity(self):
+        """Test that adding the same work type again updates the existing item"""
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.foreman_token.token}')
+        first = self.add_item('2.00')
+        second = self.add_item('3.50')
+
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(second.status_code, status.HTTP_200_OK)
+        self.assertEqual(second.data['item_id'], first.data['item_id'])
+        self.assertEqual(self.estimate.items.get().quantity, Decimal('5.50'))
+
+    def test_different_authors_keep_separate_items(self):
+        """Test that the same work type from another author is a separate item"""
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.foreman_token.token}')
+        self.add_item('1.00')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.manager_token.token}')
+        self.add_item('1.00')
+
+        self.assertEqual(self.estimate.items.count(), 2)
+
+    def test_item_cannot_be_moved_to_another_estimate(self):
+        """Test that PATCH cannot move an item into an estimate of another foreman"""
+        other_foreman = User.objects.create(
+            email='other@test.com',
+            full_name='Other Foreman',
+            password_hash=make_password('testpass123'),
+            role=self.foreman_role
+        )
+        other_estimate = Estimate.objects.create(
+            estimate_number='Other Estimate', project=self.project, status=self.status,
+            creator=self.manager, foreman=other_foreman
+        )
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.foreman_token.token}')
+        item_id = self.add_item('1.00').data['item_id']
+
+        response = self.client.patch(
+            f'/api/v1/estimate-items/{item_id}/', {'estimate': other_estimate.estimate_id}, format='json'
+        )
+        same = self.client.patch(
+            f'/api/v1/estimate-items/{item_id}/', {'estimate': self.estimate.estimate_id, 'quantity': '2.00'},
+            format='json'
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(same.status_code, status.HTTP_200_OK)
+        self.assertEqual(EstimateItem.objects.get(pk=item_id).estimate_id, self.estimate.estimate_id)
+        self.assertFalse(other_estimate.items.exists())
+
+    def test_detail_update_merges_duplicates(self):
+        """Test that duplicate work types in an estimate update are merged"""
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.manager_token.token}')
+        item = {
+            'work_type': self.work_type.work_type_id, 'quantity': '1.00',
+            'cost_price_per_unit': '100.00', 'client_price_per_unit': '150.00',
+        }
+        response = self.client.put(f'/api/v1/estimates/{self.estimate.estimate_id}/', {
+            'name': 'Test Estimate', 'project_id': self.project.project_id, 'items': [item, item],
+        }, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.estimate.items.get().quantity, Decimal('2.00'))
+
+    def test_merge_with_different_prices_keeps_total(self):
+        """Test that merging lines with different prices uses quantity-weighted prices"""
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.manager_token.token}')
+        response = self.client.put(f'/api/v1/estimates/{self.estimate.estimate_id}/', {
+            'name': 'Test Estimate', 'project_id': self.project.project_id, 'items': [
+                {'work_type': self.work_type.work_type_id, 'quantity': '1.00',
+                 'cost_price_per_unit': '15.00', 'client_price_per_unit': '30.00'},
+                {'work_type': self.work_type.work_type_id, 'quantity': '2.00',
+                 'cost_price_per_unit': '20.00', 'client_price_per_unit': '30.00'},
+            ],
+        }, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        item = self.estimate.items.get()
+        self.assertEqual(item.quantity, Decimal('3.00'))
+        self.assertEqual(item.cost_price_per_unit, Decimal('18.33'))
+        self.assertEqual(item.client_price_per_unit, Decimal('30.00'))
+
+    def test_detail_update_keeps_authors_per_item(self):
+        """Test that a full update keeps the author of every item of the same work type"""
+        foreman_item = EstimateItem.objects.create(
+            estimate=self.estimate, work_type=self.work_type, quantity=1,
+            cost_price_per_unit=100, client_price_per_unit=150, added_by=self.foreman
+        )
+        manager_item = EstimateItem.objects.create(
+            estimate=self.estimate, work_type=self.work_type, quantity=2,
+            cost_price_per_unit=100, client_price_per_unit=150, added_by=self.manager
+        )
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.manager_token.token}')
+        response = self.client.put(f'/api/v1/estimates/{self.estimate.estimate_id}/', {
+            'name': 'Test Estimate', 'project_id': self.project.project_id, 'items': [
+                {'item_id': manager_item.item_id, 'work_type': self.work_type.work_type_id, 'quantity': '5.00',
+                 'cost_price_per_unit': '100.00', 'client_price_per_unit': '150.00'},
+                {'item_id': foreman_item.item_id, 'work_type': self.work_type.work_type_id, 'quantity': '3.00',
+                 'cost_price_per_unit': '100.00', 'client_price_per_unit': '150.00'},
+            ],
+        }, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        quantities = dict(self.estimate.items.values_list('added_by', 'quantity'))
+        self.assertEqual(quantities, {self.manager.user_id: Decimal('5.00'), self.foreman.user_id: Decimal('3.00')})
+
+
+class EstimateItemPriceFillTestCase(APITestCase):
+    """Tests for filling missing item prices from the catalog"""
+
+    def setUp(self):
+        clear_catalog_prices()
+        self.manager_role = Role.objects.create(role_name='менеджер')
+        self.manager = User.objects.create(
+            email='manager@test.com',
+            full_name='Test Manager',
+            password_hash=make_password('testpass123'),
+            role=self.manager_role
+        )
+        self.manager_token = AuthToken.objects.create(user=self.manager)
+        self.project = Project.objects.create(project_name='Test Project')
+        self.status = Status.objects.create(status_name='Черновик')
+        self.category = WorkCategory.objects.create(category_name='Test Category')
+        self.work_type = WorkType.objects.create(
+            category=self.category, work_name='Test Work', unit_of_measurement='шт'
+        )
+        self.price = WorkPrice.objects.create(work_type=self.work_type, cost_price=100, client_price=150)
+        self.estimate = Estimate.objects.create(
+            estimate_number='Test Estimate', project=self.project, status=self.status,
+            creator=self.manager, foreman=self.manager
+        )
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.manager_token.token}')
+
+    def test_missing_prices_filled_from_catalog(self):
+        """Test that an item created with work type and quantity gets catalog prices"""
+        response = self.client.post('/api/v1/estimate-items/', {
+            'estimate': self.estimate.estimate_id, 'work_type': self.work_type.work_type_id, 'quantity': 2,
+        }, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['cost_price_per_unit'], '100.00')
+        self.assertEqual(response.data['client_price_per_unit'], '150.00')
+
+    def test_catalog_change_refreshes_prices(self):
+        """Test that the in-process prices are reloaded after a catalog change"""
+        self.assertEqual(work_type_prices(self.work_type.work_type_id), (Decimal('100.00'), Decimal('150.00')))
+        with self.assertNumQueries(0):
+            work_type_prices(self.work_type.work_type_id)
+
+        self.price.client_price = 175
+        with self.captureOnCommitCallbacks(execute=True):
+            self.price.save()
+
+        self.assertEqual(work_type_prices(self.work_type.work_type_id)[1], Decimal('175.00'))
+
+    def test_nested_items_filled_and_explicit_prices_kept(self):
+        """Test that estimate create fills only the prices that are missing"""
+        other_type = WorkType.objects.create(
+            category=self.category, work_name='Other Work', unit_of_measurement='м2'
+        )
+        WorkPrice.objects.create(work_type=other_type, cost_price=10, client_price=20)
+        response = self.client.post('/api/v1/estimates/', {
+            'name': 'New Estimate', 'project_id': self.project.project_id,
+            'items': [
+                {'work_type': self.work_type.work_type_id, 'quantity': 1},
+                {'work_type': other_type.work_type_id, 'quantity': 1,
+                 'cost_price_per_unit': '12.00', 'client_price_per_unit': '25.00'},
+            ],
+        }, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        items = EstimateItem.objects.filter(estimate__estimate_number='New Estimate').order_by('work_type_id')
+        self.assertEqual([item.client_price_per_unit for item in items], [Decimal('150.00'), Decimal('25.00')])
+
+    def test_work_type_without_price_rejected(self):
+        """Test that a work type without a catalog price requires explicit prices"""
+        no_price = WorkType.objects.create(
+            category=self.category, work_name='No Price', unit_of_measurement='шт'
+        )
+        response = self.client.post('/api/v1/estimate-items/', {
+            'estimate': self.estimate.estimate_id, 'work_type': no_price.work_type_id, 'quantity': 1,
+        }, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class EstimateItemSnapshotTestCase(APITestCase):
+    """Tests for the work type snapshot stored in estimate items"""
+
+    def setUp(self):
+        self.manager_role = Role.objects.create(role_name='менеджер')
+        self.manager = User.objects.create(
+            email='manager@test.com',
+            full_name='Test Manager',
+            password_hash=make_password('testpass123'),
+            role=self.manager_role
+        )
+        self.manager_token = AuthToken.objects.create(user=self.manager)
+        self.project = Project.objects.create(project_name='Test Project')
+        self.status = Status.objects.create(status_name='Черновик')
+        self.category = WorkCategory.objects.create(category_name='Test Category')
+        self.work_type = WorkType.objects.create(
+            category=self.category, work_name='Old Name', unit_of_measurement='шт'
+        )
+        self.estimate = Estimate.objects.create(
+            estimate_number='Test Estimate', project=self.project, status=self.status,
+            creator=self.manager, foreman=self.manager
+        )
+        self.item = EstimateItem.objects.create(
+            estimate=self.estimate, work_type=self.work_type, quantity=1,
+            cost_price_per_unit=100, client_price_per_unit=150, added_by=self.manager
+        )
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.manager_token.token}')
+
+    def test_snapshot_taken_on_insert(self):
+        """Test that work name, unit and category are copied into the item"""
+        self.assertEqual(
+            (self.item.work_name, self.item.unit_of_measurement, self.item.category_name),
+            ('Old Name', 'шт', 'Test Category')
+        )
+
+    def test_rename_does_not_change_existing_items(self):
+        """Test that renaming a work type keeps the name in existing estimates"""
+        self.work_type.work_name = 'New Name'
+        self.work_type.save()
+
+        response = self.client.get(f'/api/v1/estimate-items/?estimate={self.estimate.estimate_id}')
+        items = response.data['results'] if isinstance(response.data, dict) else response.data
+        self.assertEqual(items[0]['work_name'], 'Old Name')
+        self.assertEqual(items[0]['category_name'], 'Test Category')
+
+    def test_snapshot_refreshed_when_work_type_changes(self):
+        """Test that replacing the work type of an item takes a new snapshot"""
+        other_category = WorkCategory.objects.create(category_name='Other Category')
+        other_work_type = WorkType.objects.create(
+            category=other_category, work_name='Other Work', unit_of_measurement='м2'
+        )
+        response = self.client.patch(
+            f'/api/v1/estimate-items/{self.item.item_id}/', {'work_type': other_work_type.work_type_id}, format='json'
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.item.refresh_from_db()
+        self.assertEqual(
+            (self.item.work_name, self.item.unit_of_measurement, self.item.category_name),
+            ('Other Work', 'м2', 'Other Category')
+        )
+
+    def test_full_update_keeps_existing_snapshot(self):
+        """Test that a full estimate update does not re-snapshot items from the renamed catalog"""
+        self.work_type.work_name = 'New Name'
+        self.work_type.save()
+
+        response = self.client.put(f'/api/v1/estimates/{self.estimate.estimate_id}/', {
+            'name': 'Test Estimate', 'project_id': self.project.project_id, 'items': [{
+                'item_id': self.item.item_id, 'work_type': self.work_type.work_type_id, 'quantity': '2.00',
+                'cost_price_per_unit': '100.00', 'client_price_per_unit': '150.00',
+            }],
+        }, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        item = self.estimate.items.get()
+        self.assertEqual((item.item_id, item.quantity), (self.item.item_id, Decimal('2.00')))
+        self.assertEqual(item.work_name, 'Old Name')
+
+
+class EstimateDetailQueryTestCase(APITestCase):
+    """Tests for the estimate detail loader"""
+
+    def setUp(self):
+        self.manager_role = Role.objects.create(role_name='менеджер')
+        self.foreman_role = Role.objects.create(role_name='прораб')
+        self.manager = User.objects.create(
+            email='manager@test.com',
+            full_name='Test Manager',
+            password_hash=make_password('testpass123'),
+            role=self.manager_role
+        )
+        self.foreman = User.objects.create(
+            email='foreman@test.com',
+            full_name='Test Foreman',
+            password_hash=make_password('testpass123'),
+            role=self.foreman_role
+        )
+        self.manager_token = AuthToken.objects.create(user=self.manager)
+        self.foreman_token = AuthToken.objects.create(user=self.foreman)
+        self.project = Project.objects.create(project_name='Test Project')
+        self.status = Status.objects.create(status_name='Черновик')
+        self.category = WorkCategory.objects.create(category_name='Test Category')
+        self.estimate = Estimate.objects.create(
+            estimate_number='Test Estimate', project=self.project, status=self.status,
+            creator=self.manager, foreman=self.foreman
+        )
+        for index in range(10):
+            work_type = WorkType.objects.create(
+                category=self.category, work_name=f'Work {index}', unit_of_measurement='шт'
+            )
+            EstimateItem.objects.create(
+                estimate=self.estimate, work_type=work_type, quantity=1,
+                cost_price_per_unit=100, client_price_per_unit=150,
+                added_by=self.foreman if index % 2 else self.manager
+            )
+        # Справочник ролей уже загружен процессом (установившийся режим)
+        registry.get_role(self.manager_role.role_id)
+
+    def get_detail(self, token):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {token.token}')
+        with self.assertNumQueries(3):
+            response = self.client.get(f'/api/v1/estimates/{self.estimate.estimate_id}/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def test_manager_detail_query_budget(self):
+        """Test that the manager gets all items with a fixed number of queries"""
+        data = self.get_detail(self.manager_token)
+        self.assertEqual(len(data['items']), 10)
+
+    def test_foreman_detail_shows_own_items(self):
+        """Test that the foreman gets only own items with a fixed number of queries"""
+        data = self.get_detail(self.foreman_token)
+        self.assertEqual(len(data['items']), 5)
+        self.assertTrue(all(item['added_by'] == self.foreman.user_id for item in data['items']))
+
+    def test_update_loads_estimate_once(self):
+        """Test that update fetches the estimate a single time"""
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.foreman_token.token}')
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.patch(
+                f'/api/v1/estimates/{self.estimate.estimate_id}/', {'name': 'Renamed'}, format='json'
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # Загрузки сметы через ViewSet (с проектом и статусом), без чтений аудита и версии
+        estimate_selects = [
+            query['sql'] for query in context.captured_queries
+            if query['sql'].startswith('SELECT') and 'FROM "api_estimate" ' in query['sql']
+            and 'JOIN "api_project"' in query['sql']
+        ]
+        self.assertEqual(len(estimate_selects), 1)
+
+    def test_foreman_cannot_update_foreign_estimate(self):
+        """Test that the queryset scope hides estimates of other foremen"""
+        other_estimate = Estimate.objects.create(
+            estimate_number='Other', project=self.project, status=self.status,
+            creator=self.manager, foreman=self.manager
+        )
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.foreman_token.token}')
+        response = self.client.patch(
+            f'/api/v1/estimates/{other_estimate.estimate_id}/', {'name': 'Renamed'}, format='json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class RoleStatusRegistryTestCase(APITestCase):
+    """Tests for the per-process role and status registry"""
+
+    def setUp(self):
+        registry.clear_registry()
+        self.manager_role = Role.objects.create(role_name='менеджер')
+        self.foreman_role = Role.objects.create(role_name='прораб')
+        self.draft = Status.objects.create(status_name='Черновик')
+        self.manager = User.objects.create(
+            email='manager@test.com',
+            full_name='Test Manager',
+            password_hash=make_password('testpass123'),
+            role=self.manager_role
+        )
+        self.manager_token = AuthToken.objects.create(user=self.manager)
+        self.project = Project.objects.create(project_name='Test Project')
+
+    def test_lookups_are_cached_until_tables_change(self):
+        """Test that roles and statuses are read from the database once per version"""
+        self.assertEqual(registry.draft_status(), self.draft)
+        with self.assertNumQueries(0):
+            self.assertEqual(registry.draft_status(), self.draft)
+            self.assertEqual(registry.get_role(self.foreman_role.role_id).role_name, 'прораб')
+
+        self.foreman_role.role_name = 'бригадир'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.foreman_role.save()
+        self.assertEqual(registry.get_role(self.foreman_role.role_id).role_name, 'бригадир')
+
+    def test_authenticated_user_has_capability_flags(self):
+        """Test that the authenticated user gets its role from the registry"""
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.manager_token.token}')
+        response = self.client.post('/api/v1/estimates/', {
+            'name': 'New Estimate', 'project_id': self.project.project_id
+        }, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        estimate = Estimate.objects.get(estimate_id=response.data['estimate_id'])
+        self.assertEqual(estimate.status, self.draft)
+        self.assertTrue(self.manager.is_manager)
+        self.assertFalse(self.manager.is_foreman)
+
+
+class ReferenceDataCacheTestCase(APITestCase):
+    """Tests for HTTP caching of reference data endpoints"""
+
+    def setUp(self):
+        self.manager_role = Role.objects.create(role_name='менеджер')
+        self.manager = User.objects.create(
+            email='manager@test.com',
+            full_name='Test Manager',
+            password_hash=make_password('testpass123'),
+            role=self.manager_role
+        )
+        self.manager_token = AuthToken.objects.create(user=self.manager)
+        Status.objects.create(status_name='Черновик')
+        registry.get_role(self.manager_role.role_id)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.manager_token.token}')
+
+    def test_cached_list_costs_no_queries(self):
+        """Test that a repeated list is served from the cache with an ETag and max-age"""
+        first = self.client.get('/api/v1/statuses/')
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        self.assertIn('max-age=60', first['Cache-Control'])
+
+        # Только запрос токена аутентификации
+        with self.assertNumQueries(1):
+            second = self.client.get('/api/v1/statuses/')
+        self.assertEqual(second['ETag'], first['ETag'])
+        self.assertEqual(second.json(), first.json())
+
+    def test_if_none_match_and_invalidation(self):
+        """Test that a matching ETag gives 304 and writes change the ETag"""
+        etag = self.client.get('/api/v1/roles/')['ETag']
+
+        not_modified = self.client.get('/api/v1/roles/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(not_modified.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Role.objects.create(role_name='прораб')
+        changed = self.client.get('/api/v1/roles/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(changed.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(changed['ETag'], etag)
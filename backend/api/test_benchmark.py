@@ -0,0 +1,61 @@
+"""
+Tests for the in-process load benchmark
+"""
+
+from django.test import SimpleTestCase, TransactionTestCase
+
+from api.benchmark import BenchmarkOptions, compare, percentile, run_benchmark
+from api.dataset import DatasetOptions, generate_dataset
+
+
+class BenchmarkStatsTestCase(SimpleTestCase):
+    """Tests for percentiles and baseline comparison"""
+
+    def test_percentile_nearest_rank(self):
+        """Test that percentiles use the nearest-rank method"""
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 95), 95)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([7], 99), 7)
+
+    def test_compare_flags_regression(self):
+        """Test that a p95 slowdown above the threshold is reported as a regression"""
+        baseline = {'throughput': 100.0, 'endpoints': {'estimate_list': {'p95_ms': 50.0}}}
+        faster = {'throughput': 110.0, 'endpoints': {'estimate_list': {'p95_ms': 45.0}}}
+        slower = {'throughput': 100.0, 'endpoints': {'estimate_list': {'p95_ms': 80.0}}}
+
+        self.assertFalse(compare(faster, baseline)[1])
+        rows, regressed = compare(slower, baseline)
+        self.assertTrue(regressed)
+        self.assertEqual(rows[1], ('estimate_list, p95 мс', 50.0, 80.0, 60.0))
+
+
+class BenchmarkScenarioTestCase(TransactionTestCase):
+    """Tests for the foreman and manager scenarios"""
+
+    def setUp(self):
+        generate_dataset(DatasetOptions(
+            managers=1, foremen=1, projects=2, work_types=20, estimates_per_project=2, items_per_estimate=5,
+        ))
+
+    def run_scenarios(self, foreman_share):
+        return run_benchmark(BenchmarkOptions(users=1, foreman_share=foreman_share, iterations=1))
+
+    def test_foreman_scenario(self):
+        """Test that the foreman workflow runs without errors"""
+        result = self.run_scenarios(foreman_share=1)
+
+        self.assertEqual(result['errors'], 0, result['endpoints'])
+        self.assertEqual(result['endpoints']['item_add']['count'], 3)
+        for step in ('login', 'bootstrap', 'estimate_list', 'estimate_detail', 'estimate_save'):
+            self.assertIn(step, result['endpoints'])
+        self.assertGreater(result['endpoints']['estimate_detail']['p50_ms'], 0)
+
+    def test_manager_scenario(self):
+        """Test that the manager workflow exports and imports without errors"""
+        result = self.run_scenarios(foreman_share=0)
+
+        self.assertEqual(result['errors'], 0, result['endpoints'])
+        for step in ('estimate_list', 'export_client', 'export_internal', 'finance_summary', 'work_type_import'):
+            self.assertEqual(result['endpoints'][step]['count'], 1)
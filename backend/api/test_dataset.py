@@ -0,0 +1,90 @@
+"""
+Tests for the synthetic dataset generator
+"""
+
+from io import StringIO
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+
+from api.dataset import DatasetOptions, generate_dataset
+from api.models import Estimate, EstimateItem, Project, ProjectAssignment, User, WorkPrice, WorkType
+
+
+class GenerateDatasetTestCase(TestCase):
+    """Tests for the generate_dataset command"""
+
+    def generate(self, **options):
+        out = StringIO()
+        call_command(
+            'generate_dataset', '--managers', '2', '--foremen', '4', '--projects', '6', '--work-types', '40',
+            '--estimates-per-project', '3', '--items-per-estimate', '10', *self.flatten(options), stdout=out,
+        )
+        return out.getvalue()
+
+    @staticmethod
+    def flatten(options):
+        return [value for name, option in options.items() for value in (f'--{name}', str(option))]
+
+    def test_dataset_sizes(self):
+        """Test that the requested numbers of objects are created"""
+        self.generate()
+
+        self.assertEqual(User.objects.count(), 6)
+        self.assertEqual(Project.objects.count(), 6)
+        self.assertEqual(WorkType.objects.count(), 40)
+        self.assertEqual(WorkPrice.objects.count(), 40)
+        self.assertEqual(Estimate.objects.count(), 18)
+        items = EstimateItem.objects.count()
+        self.assertGreaterEqual(items, 18 * 5)
+        self.assertLessEqual(items, 18 * 15)
+
+    def test_dataset_is_consistent(self):
+        """Test that every estimate belongs to an assigned foreman and items carry the work snapshot"""
+        self.generate()
+
+        assigned = set(ProjectAssignment.objects.values_list('project_id', 'user_id'))
+        for project_id, foreman_id in Estimate.objects.values_list('project_id', 'foreman_id'):
+            self.assertIn((project_id, foreman_id), assigned)
+        self.assertFalse(EstimateItem.objects.filter(work_name='').exists())
+
+    def test_same_seed_gives_same_dataset(self):
+        """Test that the generator is deterministic for a seed"""
+        options = DatasetOptions(managers=1, foremen=2, projects=3, work_types=20, estimates_per_project=2,
+                                 items_per_estimate=5, seed=7)
+        generate_dataset(options)
+        first = list(EstimateItem.objects.order_by('item_id').values_list('work_name', 'quantity'))
+        EstimateItem.objects.all().delete()
+        Estimate.objects.all().delete()
+        ProjectAssignment.objects.all().delete()
+        Project.objects.all().delete()
+        User.objects.all().delete()
+        WorkType.objects.all().delete()
+
+        generate_dataset(options)
+        second = list(EstimateItem.objects.order_by('item_id').values_list('work_name', 'quantity'))
+        self.assertEqual(first, second)
+
+    def test_second_run_uses_existing_catalog(self):
+        """Test that a run with another e-mail domain builds estimates from the already created catalog"""
+        self.generate()
+        estimates, items = Estimate.objects.count(), EstimateItem.objects.count()
+        self.generate(**{'email-domain': 'second.example.com'})
+
+        self.assertEqual(WorkType.objects.count(), 40)
+        self.assertEqual(Estimate.objects.count(), estimates * 2)
+        self.assertGreaterEqual(EstimateItem.objects.count() - items, 18 * 5)
+
+    def test_zero_items_per_estimate(self):
+        """Test that --items-per-estimate 0 creates empty estimates"""
+        self.generate(**{'items-per-estimate': 0})
+
+        self.assertEqual(Estimate.objects.count(), 18)
+        self.assertEqual(EstimateItem.objects.count(), 0)
+
+    def test_existing_dataset_users_rejected(self):
+        """Test that a second run with the same e-mail domain is refused"""
+        self.generate()
+        with self.assertRaises(CommandError):
+            self.generate()
@@ -0,0 +1,307 @@
+"""
+Tests for the change event log and the SSE stream
+"""
+
+import asyncio
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from django.contrib.auth.hashers import make_password
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase
+
+from api import events
+from api.caching import SECTION_CATALOG, SECTION_ESTIMATES
+from api.models import (
+    AuthToken, ChangeEvent, Estimate, EstimateItem, Project, Role, Status, User, WorkCategory, WorkPrice, WorkType
+)
+
+
+def run_stream(headers=(), query_string=b''):
+    """Runs the SSE application until the first poll and returns the sent messages"""
+    scope = {'type': 'http', 'path': events.EVENTS_PATH, 'headers': list(headers), 'query_string': query_string}
+    messages = []
+
+    async def receive():
+        # Client disconnects right after the first poll
+        await asyncio.sleep(0)
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        messages.append(message)
+
+    async_to_sync(events.events_application)(scope, receive, send)
+    return messages
+
+
+class ChangeEventTestCase(TestCase):
+    """Tests for event recording and role filtering"""
+
+    def setUp(self):
+        self.manager_role = Role.objects.create(role_name='менеджер')
+        self.foreman_role = Role.objects.create(role_name='прораб')
+        self.manager = User.objects.create(
+            email='manager@test.com',
+            full_name='Test Manager',
+            password_hash=make_password('testpass123'),
+            role=self.manager_role
+        )
+        self.foreman = User.objects.create(
+            email='foreman@test.com',
+            full_name='Test Foreman',
+            password_hash=make_password('testpass123'),
+            role=self.foreman_role
+        )
+        self.other_foreman = User.objects.create(
+            email='other@test.com',
+            full_name='Other Foreman',
+            password_hash=make_password('testpass123'),
+            role=self.foreman_role
+        )
+        self.foreman_token = AuthToken.objects.create(user=self.foreman)
+        self.project = Project.objects.create(project_name='Test Project')
+        self.status = Status.objects.create(status_name='Черновик')
+        self.category = WorkCategory.objects.create(category_name='Test Category')
+        self.work_type = WorkType.objects.create(
+            category=self.category, work_name='Test Work', unit_of_measurement='шт'
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            self.own_estimate = Estimate.objects.create(
+                project=self.project, status=self.status, creator=self.manager, foreman=self.foreman
+            )
+            self.other_estimate = Estimate.objects.create(
+                project=self.project, status=self.status, creator=self.manager, foreman=self.other_foreman
+            )
+        self.start_id = events.last_event_id()
+
+    def add_item(self, estimate):
+        # Каждое изменение - отдельная зафиксированная транзакция
+        with self.captureOnCommitCallbacks(execute=True):
+            return EstimateItem.objects.create(
+                estimate=estimate, work_type=self.work_type, quantity=1,
+                cost_price_per_unit=10, client_price_per_unit=15, added_by=self.manager
+            )
+
+    def test_changes_are_recorded(self):
+        """Test that estimate, item and catalog changes write events"""
+        item = self.add_item(self.own_estimate)
+        with self.captureOnCommitCallbacks(execute=True):
+            WorkPrice.objects.create(work_type=self.work_type, cost_price=10, client_price=15)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.own_estimate.delete()
+
+        kinds = list(
+            ChangeEvent.objects.filter(event_id__gt=self.start_id).order_by('event_id').values_list('kind', flat=True)
+        )
+        self.assertEqual(kinds, [
+            ChangeEvent.KIND_ITEMS_CHANGED,
+            ChangeEvent.KIND_CATALOG_CHANGED,
+            ChangeEvent.KIND_ESTIMATE_DELETED,
+        ])
+        self.assertEqual(
+            ChangeEvent.objects.get(kind=ChangeEvent.KIND_ITEMS_CHANGED).foreman_id, self.foreman.user_id
+        )
+        self.assertFalse(EstimateItem.objects.filter(pk=item.pk).exists())
+
+    def test_transaction_changes_are_batched(self):
+        """Test that item changes in one transaction bump the version and write events once"""
+        work_types = WorkType.objects.bulk_create([
+            WorkType(category=self.category, work_name=f'Work {index}', unit_of_measurement='шт')
+            for index in range(5)
+        ])
+        self.own_estimate.estimate_number = 'Renamed'
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self.own_estimate.save()
+            items = [
+                EstimateItem.objects.create(
+                    estimate=self.own_estimate, work_type=work_type, quantity=1,
+                    cost_price_per_unit=10, client_price_per_unit=15, added_by=self.manager
+                )
+                for work_type in work_types
+            ]
+            for item in items:
+                item.quantity = 2
+                item.save()
+            items[0].delete()
+            version = Estimate.objects.values_list('version', flat=True).get(pk=self.own_estimate.pk)
+
+        self.assertTrue(callbacks)
+        kinds = list(
+            ChangeEvent.objects.filter(event_id__gt=self.start_id).order_by('event_id').values_list('kind', flat=True)
+        )
+        self.assertEqual(kinds, [ChangeEvent.KIND_ESTIMATE_UPDATED, ChangeEvent.KIND_ITEMS_CHANGED])
+        # Версия сохраненного экземпляра обновлена без повторного чтения
+        self.assertEqual(self.own_estimate.version, version + 1)
+        self.assertEqual(Estimate.objects.get(pk=self.own_estimate.pk).version, version + 1)
+
+    def test_cache_invalidated_once_per_transaction(self):
+        """Test that item changes in one transaction bump the estimates cache version a fixed number of times"""
+        with mock.patch('api.signals.bump_version') as bump_version:
+            with self.captureOnCommitCallbacks(execute=True):
+                for index in range(5):
+                    self.own_estimate.items.create(
+                        work_type=WorkType.objects.create(
+                            category=self.category, work_name=f'Cached {index}', unit_of_measurement='шт'
+                        ),
+                        quantity=1, cost_price_per_unit=10, client_price_per_unit=15, added_by=self.manager
+                    )
+
+        bumped = [call.args for call in bump_version.call_args_list]
+        # При первом изменении раздела и при фиксации
+        self.assertEqual(sum(args.count(SECTION_ESTIMATES) for args in bumped), 2)
+        self.assertEqual(sum(args.count(SECTION_CATALOG) for args in bumped), 2)
+
+    def test_catalog_changes_recorded_once_per_transaction(self):
+        """Test that saving many catalog rows in one transaction writes a single catalog event"""
+        with self.captureOnCommitCallbacks(execute=True):
+            category = WorkCategory.objects.create(category_name='Imported')
+            for index in range(3):
+                work_type = WorkType.objects.create(
+                    category=category, work_name=f'Imported {index}', unit_of_measurement='шт'
+                )
+                WorkPrice.objects.create(work_type=work_type, cost_price=10, client_price=15)
+
+        self.assertEqual(
+            list(ChangeEvent.objects.filter(event_id__gt=self.start_id).values_list('kind', flat=True)),
+            [ChangeEvent.KIND_CATALOG_CHANGED]
+        )
+
+    def test_rolled_back_changes_are_not_recorded(self):
+        """Test that pending changes of a rolled back transaction do not leak into the next one"""
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                EstimateItem.objects.create(
+                    estimate=self.own_estimate, work_type=self.work_type, quantity=1,
+                    cost_price_per_unit=10, client_price_per_unit=15, added_by=self.manager
+                )
+                raise RuntimeError
+        self.add_item(self.other_estimate)
+
+        self.assertEqual(
+            list(ChangeEvent.objects.filter(event_id__gt=self.start_id).values_list('kind', 'estimate_id')),
+            [(ChangeEvent.KIND_ITEMS_CHANGED, self.other_estimate.estimate_id)]
+        )
+        self.own_estimate.refresh_from_db()
+        self.assertEqual(self.own_estimate.version, 1)
+
+    def test_foreman_sees_only_own_estimates_and_catalog(self):
+        """Test that foreman events are filtered by estimate foreman"""
+        self.add_item(self.own_estimate)
+        self.add_item(self.other_estimate)
+        with self.captureOnCommitCallbacks(execute=True):
+            WorkPrice.objects.create(work_type=self.work_type, cost_price=10, client_price=15)
+
+        foreman_events = events.events_for_user(self.foreman, self.start_id)
+        manager_events = events.events_for_user(self.manager, self.start_id)
+
+        self.assertEqual(
+            [(event.kind, event.estimate_id) for event in foreman_events],
+            [(ChangeEvent.KIND_ITEMS_CHANGED, self.own_estimate.estimate_id), (ChangeEvent.KIND_CATALOG_CHANGED, None)]
+        )
+        self.assertEqual(len(manager_events), 3)
+
+    def test_repeated_events_are_coalesced(self):
+        """Test that a batch keeps only the last event per kind and estimate"""
+        item = self.add_item(self.own_estimate)
+        for quantity in (2, 3):
+            item.quantity = quantity
+            with self.captureOnCommitCallbacks(execute=True):
+                item.save()
+
+        chunk, last_id = events.read_events(self.manager, events.open_cursor(self.start_id))
+
+        self.assertEqual(chunk.count('event: items_changed'), 1)
+        self.assertIn(f'id: {last_id}\n', chunk)
+
+    def test_late_committed_events_are_not_skipped(self):
+        """Test that an event whose id is below the cursor is sent once it becomes visible"""
+        cursor = events.open_cursor(self.start_id)
+        self.add_item(self.own_estimate)
+        self.add_item(self.other_estimate)
+        late, sent = ChangeEvent.objects.filter(event_id__gt=self.start_id).order_by('event_id')
+        late_id = late.event_id
+        # Транзакция события с меньшим id еще не зафиксирована
+        late.delete()
+
+        first_chunk, first_id = events.read_events(self.manager, cursor)
+        ChangeEvent.objects.create(
+            event_id=late_id, kind=late.kind, estimate_id=late.estimate_id, foreman_id=late.foreman_id
+        )
+        second_chunk, second_id = events.read_events(self.manager, cursor)
+        third_chunk, _ = events.read_events(self.manager, cursor)
+
+        self.assertIn(f'id: {sent.event_id}\n', first_chunk)
+        self.assertEqual(first_id, sent.event_id)
+        self.assertIn(f'id: {late_id}\n', second_chunk)
+        self.assertEqual(second_id, sent.event_id)
+        self.assertEqual(third_chunk, '')
+
+    def test_open_cursor_skips_earlier_events(self):
+        """Test that events before the cursor position are not replayed from the reread window"""
+        self.add_item(self.own_estimate)
+        cursor = events.open_cursor(events.last_event_id())
+
+        self.assertEqual(events.read_events(self.manager, cursor), ('', cursor.after_id))
+
+
+class ChangeEventStreamTestCase(TransactionTestCase):
+    """Tests for the SSE stream (journal reads run in worker threads with their own connections)"""
+
+    def setUp(self):
+        self.manager_role = Role.objects.create(role_name='менеджер')
+        self.foreman_role = Role.objects.create(role_name='прораб')
+        self.manager = User.objects.create(
+            email='manager@test.com',
+            full_name='Test Manager',
+            password_hash=make_password('testpass123'),
+            role=self.manager_role
+        )
+        self.foreman = User.objects.create(
+            email='foreman@test.com',
+            full_name='Test Foreman',
+            password_hash=make_password('testpass123'),
+            role=self.foreman_role
+        )
+        self.foreman_token = AuthToken.objects.create(user=self.foreman)
+        self.project = Project.objects.create(project_name='Test Project')
+        self.status = Status.objects.create(status_name='Черновик')
+        self.category = WorkCategory.objects.create(category_name='Test Category')
+        self.work_type = WorkType.objects.create(
+            category=self.category, work_name='Test Work', unit_of_measurement='шт'
+        )
+        self.own_estimate = Estimate.objects.create(
+            project=self.project, status=self.status, creator=self.manager, foreman=self.foreman
+        )
+        self.start_id = events.last_event_id()
+
+    def add_item(self, estimate):
+        return EstimateItem.objects.create(
+            estimate=estimate, work_type=self.work_type, quantity=1,
+            cost_price_per_unit=10, client_price_per_unit=15, added_by=self.manager
+        )
+
+    def test_stream_resumes_from_last_event_id(self):
+        """Test that the stream replays events after Last-Event-ID"""
+        self.add_item(self.own_estimate)
+        messages = run_stream(headers=[
+            (b'authorization', f'Bearer {self.foreman_token.token}'.encode()),
+            (b'last-event-id', str(self.start_id).encode()),
+        ])
+
+        self.assertEqual(messages[0]['status'], 200)
+        body = b''.join(message.get('body', b'') for message in messages[1:]).decode()
+        self.assertIn('event: items_changed', body)
+        self.assertIn(f'"estimate_id": {self.own_estimate.estimate_id}', body)
+
+    def test_stream_requires_token(self):
+        """Test that the stream rejects requests without a valid token"""
+        messages = run_stream(query_string=b'token=invalid')
+        self.assertEqual(messages[0]['status'], 401)
+
+    def test_stream_reads_close_connection(self):
+        """Test that journal reads in worker threads close their database connection"""
+        with mock.patch.object(events, 'connection') as connection:
+            last_id = async_to_sync(events._read)(events.last_event_id)
+
+        self.assertEqual(last_id, self.start_id)
+        connection.close.assert_called_once_with()
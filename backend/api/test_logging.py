@@ -0,0 +1,71 @@
+"""
+Tests for the queued JSON file logging
+"""
+
+import gzip
+import json
+import logging
+import os
+import sys
+import tempfile
+
+from django.test import SimpleTestCase
+
+from core.logging_handlers import CompressingRotatingFileHandler, JsonFormatter, QueuedFileHandler
+
+
+class QueuedFileLoggingTestCase(SimpleTestCase):
+    """Tests for the queue handler and the rotating file handler"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.filename = os.path.join(self.directory.name, 'audit.log')
+
+    def make_record(self, message, *args):
+        return logging.LogRecord('audit', logging.INFO, __file__, 1, message, args, None)
+
+    def test_records_written_as_json_lines(self):
+        """Test that records are formatted by the writer thread into JSON lines"""
+        handler = QueuedFileHandler(self.filename)
+        handler.setFormatter(JsonFormatter())
+        handler.handle(self.make_record('Смета %s открыта', 12))
+        handler.close()
+
+        with open(self.filename, encoding='utf-8') as log_file:
+            line = json.loads(log_file.readline())
+        self.assertEqual(line['message'], 'Смета 12 открыта')
+        self.assertEqual(line['logger'], 'audit')
+
+    def test_record_prepared_in_calling_thread(self):
+        """Test that arguments and exceptions are rendered before the record is queued"""
+        handler = QueuedFileHandler(self.filename)
+        handler.setFormatter(JsonFormatter())
+        items = ['первая']
+        try:
+            raise ValueError('ошибка сметы')
+        except ValueError:
+            record = logging.LogRecord('audit', logging.ERROR, __file__, 1, 'Работы: %s', (items,), sys.exc_info())
+        handler.handle(record)
+        # Изменение аргумента после вызова логгера не попадает в журнал
+        items.append('вторая')
+        handler.close()
+
+        with open(self.filename, encoding='utf-8') as log_file:
+            line = json.loads(log_file.readline())
+        self.assertEqual(line['message'], "Работы: ['первая']")
+        self.assertIn('ValueError: ошибка сметы', line['exception'])
+        # Запись вызывающего кода не изменена
+        self.assertEqual(record.args, (items,))
+
+    def test_size_rotation_compresses_and_keeps_backups(self):
+        """Test that files rotated by size are gzipped and old ones are removed"""
+        handler = CompressingRotatingFileHandler(self.filename, max_bytes=100, backup_count=2)
+        for index in range(20):
+            handler.handle(self.make_record('x' * 60 + str(index)))
+        handler.close()
+
+        rotated = sorted(name for name in os.listdir(self.directory.name) if name.endswith('.gz'))
+        self.assertEqual(len(rotated), 2)
+        with gzip.open(os.path.join(self.directory.name, rotated[0]), 'rt', encoding='utf-8') as rotated_file:
+            self.assertIn('x' * 60, rotated_file.read())
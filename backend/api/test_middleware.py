@@ -0,0 +1,368 @@
+"""
+Tests for API middleware
+"""
+
+import json
+import os
+import tempfile
+import threading
+from io import StringIO
+from unittest import mock
+
+from django.contrib.auth.hashers import make_password
+from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.management import call_command
+from django.test import RequestFactory, SimpleTestCase, override_settings
+from django.http import JsonResponse
+from rest_framework import status
+from rest_framework.test import APITestCase, APITransactionTestCase
+
+from auditlog.models import LogEntry
+
+from api import audit, metrics, querystats
+from api.middleware import IdempotencyKeyMiddleware, RequestTimingMiddleware
+from api.models import AuthToken, Project, Role, Status, User, WorkCategory
+
+
+class IdempotencyKeyTestCase(APITestCase):
+    """Tests for Idempotency-Key handling on mutating endpoints"""
+
+    def setUp(self):
+        cache.clear()
+        self.manager_role = Role.objects.create(role_name='менеджер')
+        self.manager = User.objects.create(
+            email='manager@test.com',
+            full_name='Test Manager',
+            password_hash=make_password('testpass123'),
+            role=self.manager_role
+        )
+        self.manager_token = AuthToken.objects.create(user=self.manager)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.manager_token.token}')
+
+    def create_project(self, key, name='Test Project'):
+        return self.client.post(
+            '/api/v1/projects/', {'project_name': name}, format='json', HTTP_IDEMPOTENCY_KEY=key
+        )
+
+    def test_retry_replays_first_response(self):
+        """Test that a retry with the same key does not create a duplicate"""
+        first = self.create_project('key-1')
+        second = self.create_project('key-1')
+
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(second.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(second['Idempotency-Replayed'], 'true')
+        self.assertEqual(second.json()['project_id'], first.data['project_id'])
+        self.assertEqual(Project.objects.count(), 1)
+
+    def test_different_keys_are_independent(self):
+        """Test that requests without a key or with another key are executed"""
+        self.create_project('key-1')
+        self.create_project('key-2')
+        self.client.post('/api/v1/projects/', {'project_name': 'Test Project'}, format='json')
+
+        self.assertEqual(Project.objects.count(), 3)
+
+    def test_key_reused_with_other_body(self):
+        """Test that a key cannot be reused for a different request body"""
+        self.create_project('key-1')
+        response = self.create_project('key-1', name='Other Project')
+
+        self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+        self.assertEqual(Project.objects.count(), 1)
+
+    def test_key_is_scoped_to_user(self):
+        """Test that the same key from another user is not replayed"""
+        self.create_project('key-1')
+        other = User.objects.create(
+            email='other@test.com',
+            full_name='Other Manager',
+            password_hash=make_password('testpass123'),
+            role=self.manager_role
+        )
+        other_token = AuthToken.objects.create(user=other)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {other_token.token}')
+        response = self.create_project('key-1')
+
+        self.assertNotIn('Idempotency-Replayed', response)
+        self.assertEqual(Project.objects.count(), 2)
+
+
+class IdempotencyLockTestCase(SimpleTestCase):
+    """Tests for serialization of concurrent duplicates"""
+
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+
+    def test_concurrent_duplicate_waits_for_first_response(self):
+        """Test that a concurrent duplicate gets the first response without running the view"""
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def view(request):
+            calls.append(request)
+            started.set()
+            release.wait(5)
+            return JsonResponse({'created': len(calls)}, status=201)
+
+        middleware = IdempotencyKeyMiddleware(view)
+        make_request = lambda: self.factory.post(
+            '/api/v1/projects/', data='{}', content_type='application/json', HTTP_IDEMPOTENCY_KEY='key-1'
+        )
+
+        responses = {}
+        first = threading.Thread(target=lambda: responses.setdefault('first', middleware(make_request())))
+        first.start()
+        started.wait(5)
+
+        with mock.patch.object(IdempotencyKeyMiddleware, 'WAIT_INTERVAL', 0.01):
+            second = threading.Thread(target=lambda: responses.setdefault('second', middleware(make_request())))
+            second.start()
+            release.set()
+            first.join(5)
+            second.join(5)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(responses['second'].status_code, 201)
+        self.assertEqual(responses['second']['Idempotency-Replayed'], 'true')
+        self.assertEqual(responses['second'].content, responses['first'].content)
+
+    def test_result_stored_before_lock_is_replayed(self):
+        """Test that a result stored between the first lookup and taking the lock is replayed"""
+        calls = []
+
+        def view(request):
+            calls.append(request)
+            return JsonResponse({'created': len(calls)}, status=201)
+
+        middleware = IdempotencyKeyMiddleware(view)
+        make_request = lambda: self.factory.post(
+            '/api/v1/projects/', data='{}', content_type='application/json', HTTP_IDEMPOTENCY_KEY='key-1'
+        )
+        first = middleware(make_request())
+
+        # Повтор не увидел результат при первом чтении, а блокировка уже снята
+        real_get = cache.get
+        lookups = []
+
+        def stale_get(key, *args, **kwargs):
+            lookups.append(key)
+            return None if len(lookups) == 1 else real_get(key, *args, **kwargs)
+
+        with mock.patch.object(cache, 'get', side_effect=stale_get):
+            second = middleware(make_request())
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(second.status_code, 201)
+        self.assertEqual(second['Idempotency-Replayed'], 'true')
+        self.assertEqual(second.content, first.content)
+
+
+class AuditBufferTestCase(APITransactionTestCase):
+    """Tests for buffered audit log writes (real commits are needed for on_commit)"""
+
+    def setUp(self):
+        self.manager_role = Role.objects.create(role_name='менеджер')
+        self.manager = User.objects.create(
+            email='manager@test.com',
+            full_name='Test Manager',
+            password_hash=make_password('testpass123'),
+            role=self.manager_role
+        )
+        self.manager_token = AuthToken.objects.create(user=self.manager)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.manager_token.token}')
+        LogEntry.objects.all().delete()
+
+    def test_request_changes_written_in_one_batch(self):
+        """Test that audit entries of a request are written with one bulk insert"""
+        with mock.patch.object(audit, 'write_entries', wraps=audit.write_entries) as write_entries:
+            response = self.client.post('/api/v1/batch/', {'requests': [
+                {'method': 'POST', 'path': 'projects/', 'body': {'project_name': 'First'}},
+                {'method': 'POST', 'path': 'projects/', 'body': {'project_name': 'Second'}},
+            ]}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        write_entries.assert_called_once()
+        entries = LogEntry.objects.filter(action=LogEntry.Action.CREATE)
+        self.assertEqual(entries.count(), 2)
+        self.assertTrue(all(entry.actor_email == 'manager@test.com' for entry in entries))
+
+    def test_rolled_back_changes_not_logged(self):
+        """Test that changes from a rolled back atomic batch leave no audit entries"""
+        response = self.client.post('/api/v1/batch/', {'atomic': True, 'requests': [
+            {'method': 'POST', 'path': 'projects/', 'body': {'project_name': 'Rolled Back'}},
+            {'method': 'GET', 'path': 'estimates/999999/'},
+        ]}, format='json')
+
+        self.assertTrue(response.data['rolled_back'])
+        self.assertFalse(LogEntry.objects.exists())
+
+
+@override_settings(REQUEST_TIMING_ENABLED=True)
+class RequestTimingTestCase(APITestCase):
+    """Tests for per-request query and timing instrumentation"""
+
+    def setUp(self):
+        self.manager_role = Role.objects.create(role_name='менеджер')
+        self.manager = User.objects.create(
+            email='manager@test.com',
+            full_name='Test Manager',
+            password_hash=make_password('testpass123'),
+            role=self.manager_role
+        )
+        self.manager_token = AuthToken.objects.create(user=self.manager)
+        Status.objects.create(status_name='Черновик')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.manager_token.token}')
+
+    def test_server_timing_header(self):
+        """Test that the response reports queries, DB time and DRF phases"""
+        response = self.client.get('/api/v1/projects/')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        timing = response['Server-Timing']
+        self.assertRegex(timing, r'db;dur=[\d.]+;desc="\d+ queries"')
+        for phase in ('auth', 'view', 'render', 'total'):
+            self.assertIn(f'{phase};dur=', timing)
+
+    def test_disabled_by_setting(self):
+        """Test that the middleware is not used when the setting is off"""
+        with override_settings(REQUEST_TIMING_ENABLED=False):
+            with self.assertRaises(MiddlewareNotUsed):
+                RequestTimingMiddleware(lambda request: None)
+
+
+class MetricsTestCase(APITestCase):
+    """Tests for the metrics registry and the /metrics/ endpoint"""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.metrics_dir = directory.name
+        settings_override = override_settings(METRICS_DIR=self.metrics_dir, METRICS_TOKEN='')
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        metrics.reset()
+
+        self.manager_role = Role.objects.create(role_name='менеджер')
+        self.manager = User.objects.create(
+            email='manager@test.com',
+            full_name='Test Manager',
+            password_hash=make_password('testpass123'),
+            role=self.manager_role
+        )
+        self.manager_token = AuthToken.objects.create(user=self.manager)
+
+    def test_request_metrics_exported(self):
+        """Test that request counts and latency histograms are exported per view"""
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.manager_token.token}')
+        self.client.get('/api/v1/projects/')
+        self.client.get('/api/v1/projects/')
+
+        response = self.client.get('/api/v1/metrics/')
+        body = response.content.decode()
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('http_requests_total{method="GET",status="200",view="project-list"} 2', body)
+        self.assertIn('http_request_duration_seconds_count{method="GET",view="project-list"} 2', body)
+        self.assertIn('# TYPE http_request_db_queries histogram', body)
+
+    def test_workers_are_aggregated(self):
+        """Test that snapshots of other worker processes are summed"""
+        metrics.inc('http_requests_total', view='health-check', method='GET', status=200)
+        with open(os.path.join(self.metrics_dir, 'worker-999999.json'), 'w') as worker_file:
+            json.dump({'counters': [
+                ['http_requests_total', [['method', 'GET'], ['status', '200'], ['view', 'health-check']], 4],
+            ], 'histograms': []}, worker_file)
+
+        counters, _ = metrics.collect()
+
+        key = ('http_requests_total', (('method', 'GET'), ('status', '200'), ('view', 'health-check')))
+        self.assertEqual(counters[key], 5)
+
+    def test_metrics_token_required_when_configured(self):
+        """Test that the endpoint checks METRICS_TOKEN"""
+        with override_settings(METRICS_TOKEN='secret'):
+            denied = self.client.get('/api/v1/metrics/')
+            allowed = self.client.get('/api/v1/metrics/', HTTP_AUTHORIZATION='Bearer secret')
+
+        self.assertEqual(denied.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(allowed.status_code, status.HTTP_200_OK)
+
+    def test_metrics_require_manager_without_token(self):
+        """Test that without METRICS_TOKEN the endpoint is closed to anonymous users and foremen"""
+        foreman = User.objects.create(
+            email='foreman@test.com',
+            full_name='Test Foreman',
+            password_hash=make_password('testpass123'),
+            role=Role.objects.create(role_name='прораб')
+        )
+        foreman_token = AuthToken.objects.create(user=foreman)
+
+        anonymous = self.client.get('/api/v1/metrics/')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {foreman_token.token}')
+        foreman_response = self.client.get('/api/v1/metrics/')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.manager_token.token}')
+        manager_response = self.client.get('/api/v1/metrics/')
+
+        self.assertEqual(anonymous.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(foreman_response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(manager_response.status_code, status.HTTP_200_OK)
+
+
+class QueryStatsTestCase(APITestCase):
+    """Tests for the SQL fingerprint statistics and the query_report command"""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings_override = override_settings(
+            METRICS_DIR=directory.name, QUERY_STATS_ENABLED=True, QUERY_STATS_SLOW_MS=0,
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        querystats.reset()
+        self.addCleanup(querystats.reset)
+
+        self.manager_role = Role.objects.create(role_name='менеджер')
+        self.manager = User.objects.create(
+            email='manager@test.com',
+            full_name='Test Manager',
+            password_hash=make_password('testpass123'),
+            role=self.manager_role
+        )
+        self.manager_token = AuthToken.objects.create(user=self.manager)
+        for index in range(3):
+            Project.objects.create(project_name=f'Проект {index}', address=f'Адрес {index}')
+
+    def test_fingerprint_replaces_literals(self):
+        """Test that queries differing only in values share one fingerprint"""
+        first = querystats.normalize('SELECT * FROM "api_project" WHERE "id" IN (1, 2, 3) AND "name" = \'a\'')
+        second = querystats.normalize('SELECT *  FROM "api_project" WHERE "id" IN (%s, %s) AND "name" = %s')
+
+        self.assertEqual(first, second)
+        self.assertEqual(first, 'SELECT * FROM "api_project" WHERE "id" IN (...) AND "name" = ?')
+
+    def test_slow_queries_captured_with_plan_and_view(self):
+        """Test that queries over the threshold are stored with EXPLAIN and the view name"""
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.manager_token.token}')
+        self.client.get('/api/v1/projects/')
+        self.client.get('/api/v1/projects/')
+        querystats.flush(force=True)
+
+        stats, slow = querystats.collect()
+        project_stats = [item for item in stats.values() if 'FROM "api_project"' in item['fingerprint']]
+        self.assertTrue(project_stats)
+        self.assertEqual(project_stats[0]['views'], {'GET project-list': project_stats[0]['count']})
+        self.assertGreaterEqual(project_stats[0]['count'], 2)
+
+        captured = [query for query in slow if query['view'] == 'GET project-list']
+        self.assertTrue(captured)
+        self.assertTrue(all(query['plan'] for query in captured))
+
+        out = StringIO()
+        call_command('query_report', '--top', '5', '--slow', stdout=out)
+        self.assertIn('GET project-list', out.getvalue())
+
@@ -0,0 +1,176 @@
+"""
+Query budget tests: the number of SQL queries per endpoint must not grow
+with the number of estimate items (N+1 regressions in serializers and views)
+"""
+
+from django.contrib.auth.hashers import make_password
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APITestCase
+
+from api import registry
+from api.models import (
+    AuthToken, Estimate, EstimateItem, Project, ProjectAssignment, Role, Status, User, WorkCategory, WorkPrice,
+    WorkType,
+)
+
+ESTIMATE_SIZES = (10, 100, 1000)
+
+
+class QueryBudgetMixin:
+    """Сравнение числа SQL-запросов одного и того же запроса к API на разных объемах данных"""
+
+    def capture(self, method, url, **kwargs):
+        # Запросы обработчиков фиксации (версии и события смет) входят в бюджет
+        with CaptureQueriesContext(connection) as context, self.captureOnCommitCallbacks(execute=True):
+            response = getattr(self.client, method)(url, **kwargs)
+        self.assertLess(response.status_code, 400, f'{method.upper()} {url}: {response.status_code}')
+        return [query['sql'] for query in context.captured_queries]
+
+    def assertConstantQueries(self, method, url_for_size, **kwargs):
+        """Число запросов для всех размеров смет одинаково; при ошибке выводится SQL"""
+        captured = {size: self.capture(method, url_for_size(size), **kwargs) for size in ESTIMATE_SIZES}
+        smallest, largest = ESTIMATE_SIZES[0], ESTIMATE_SIZES[-1]
+        if len({len(queries) for queries in captured.values()}) > 1:
+            counts = ', '.join(f'{size} позиций: {len(queries)}' for size, queries in captured.items())
+            sql = '\n'.join(f'{index}. {query}' for index, query in enumerate(captured[largest], start=1))
+            self.fail(f'Число запросов зависит от размера сметы ({counts}).\nЗапросы для {largest} позиций:\n{sql}')
+        return len(captured[smallest])
+
+    def assertQueryBudget(self, budget, method, url_for_size, **kwargs):
+        """Число запросов постоянно и не превышает budget"""
+        count = self.assertConstantQueries(method, url_for_size, **kwargs)
+        self.assertLessEqual(count, budget, f'{method.upper()}: {count} запросов при бюджете {budget}')
+
+
+class EstimateQueryBudgetTestCase(QueryBudgetMixin, APITestCase):
+    """Query budgets of the estimate endpoints for estimates of 10, 100 and 1000 items"""
+
+    def setUp(self):
+        self.manager_role = Role.objects.create(role_name='менеджер')
+        self.foreman_role = Role.objects.create(role_name='прораб')
+        self.manager = User.objects.create(
+            email='manager@test.com',
+            full_name='Test Manager',
+            password_hash=make_password('testpass123'),
+            role=self.manager_role
+        )
+        self.foreman = User.objects.create(
+            email='foreman@test.com',
+            full_name='Test Foreman',
+            password_hash=make_password('testpass123'),
+            role=self.foreman_role
+        )
+        self.manager_token = AuthToken.objects.create(user=self.manager)
+        self.foreman_token = AuthToken.objects.create(user=self.foreman)
+        self.status = Status.objects.create(status_name='Черновик')
+        self.category = WorkCategory.objects.create(category_name='Test Category')
+
+        work_types = WorkType.objects.bulk_create([
+            WorkType(category=self.category, work_name=f'Work {index}', unit_of_measurement='шт')
+            for index in range(max(ESTIMATE_SIZES))
+        ])
+        WorkPrice.objects.bulk_create([
+            WorkPrice(work_type=work_type, cost_price=100, client_price=150) for work_type in work_types
+        ])
+
+        # Отдельный проект на каждый размер: список смет проекта растет вместе с позициями
+        self.estimates = {}
+        for size in ESTIMATE_SIZES:
+            project = Project.objects.create(project_name=f'Project {size}')
+            ProjectAssignment.objects.create(user=self.foreman, project=project)
+            with self.captureOnCommitCallbacks(execute=True):
+                estimate = Estimate.objects.create(
+                    estimate_number=f'Estimate {size}', project=project, status=self.status,
+                    creator=self.manager, foreman=self.foreman
+                )
+            EstimateItem.objects.bulk_create([
+                EstimateItem(
+                    estimate=estimate, work_type=work_type, quantity=index % 7 + 1,
+                    cost_price_per_unit=100, client_price_per_unit=150,
+                    added_by=self.foreman if index % 2 else self.manager,
+                    work_name=work_type.work_name, unit_of_measurement='шт', category_name='Test Category',
+                )
+                for index, work_type in enumerate(work_types[:size])
+            ])
+            self.estimates[size] = estimate
+
+        # Справочник ролей уже загружен процессом (установившийся режим)
+        registry.get_role(self.manager_role.role_id)
+
+    def login(self, token):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {token.token}')
+
+    def estimate_url(self, size, suffix=''):
+        return f'/api/v1/estimates/{self.estimates[size].estimate_id}/{suffix}'
+
+    def test_list_budget(self):
+        """Test that the estimate list of a project does not depend on item counts"""
+        self.login(self.foreman_token)
+        self.assertQueryBudget(
+            3, 'get', lambda size: f'/api/v1/estimates/?project={self.estimates[size].project_id}'
+        )
+
+    def test_retrieve_budget(self):
+        """Test that the estimate detail loads items with a fixed number of queries"""
+        for token in (self.manager_token, self.foreman_token):
+            self.login(token)
+            self.assertQueryBudget(3, 'get', self.estimate_url)
+
+    def test_update_budget(self):
+        """Test that updating an estimate does not touch items one by one"""
+        self.login(self.foreman_token)
+        # Сохранение сметы с ее версией и событием - одна транзакция (две точки сохранения в тесте)
+        self.assertQueryBudget(
+            13, 'patch', self.estimate_url, data={'estimate_number': 'Renamed'}, format='json'
+        )
+        # PATCH без items не пересоздает работы
+        for size, estimate in self.estimates.items():
+            self.assertEqual(estimate.items.count(), size)
+
+    def test_full_update_budget(self):
+        """Test that a full PUT of the items writes them in bulk, not item by item"""
+        with self.captureOnCommitCallbacks(execute=True):
+            extra = WorkType.objects.create(category=self.category, work_name='Extra Work', unit_of_measurement='м2')
+        self.login(self.foreman_token)
+        captured = {}
+        for size, estimate in self.estimates.items():
+            items = [
+                {
+                    'item_id': item.item_id, 'work_type': item.work_type_id, 'quantity': str(item.quantity),
+                    'cost_price_per_unit': '100.00', 'client_price_per_unit': '150.00',
+                }
+                for item in estimate.items.order_by('item_id')
+            ]
+            # Одна позиция удалена, одна изменена, одна добавлена
+            items = items[1:]
+            items[0]['quantity'] = '42.00'
+            items.append({
+                'work_type': extra.work_type_id, 'quantity': '1.00',
+                'cost_price_per_unit': '10.00', 'client_price_per_unit': '20.00',
+            })
+            captured[size] = self.capture('put', self.estimate_url(size), data={
+                'name': f'Estimate {size}', 'project_id': estimate.project_id, 'items': items,
+            }, format='json')
+            self.assertEqual(estimate.items.count(), size)
+            self.assertEqual(estimate.items.get(work_type=extra).work_name, 'Extra Work')
+
+        # Первый запрос прогревает каталог и кэши процесса - сравниваются следующие
+        counts = {size: len(captured[size]) for size in ESTIMATE_SIZES[1:]}
+        self.assertEqual(len(set(counts.values())), 1, f'Число запросов зависит от размера сметы: {counts}')
+        self.assertLessEqual(counts[ESTIMATE_SIZES[-1]], 25)
+
+    def test_items_list_budget(self):
+        """Test that the paginated items list of an estimate has a fixed query count"""
+        for token in (self.manager_token, self.foreman_token):
+            self.login(token)
+            self.assertQueryBudget(
+                3, 'get', lambda size: f'/api/v1/estimate-items/?estimate={self.estimates[size].estimate_id}'
+            )
+
+    def test_export_budget(self):
+        """Test that client and internal exports load items in bulk"""
+        self.login(self.manager_token)
+        for suffix in ('export/client/', 'export/internal/'):
+            self.assertQueryBudget(4, 'get', lambda size: self.estimate_url(size, suffix))
+
@@ -0,0 +1,94 @@
+"""
+Замеры запроса: число SQL-запросов, время БД и фаз обработки (аутентификация,
+view, рендеринг). Заполняются RequestTimingMiddleware и отдаются клиенту
+в заголовке Server-Timing; сводка по view периодически пишется в журнал.
+"""
+
+import contextlib
+import logging
+import threading
+import time
+
+timing_logger = logging.getLogger('api.timing')
+
+
+class RequestTimings:
+    """Замеры одного запроса (время в миллисекундах)"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.total = 0.0
+        self.phases = {}
+        self._running = {}
+        self.queries = 0
+        self.db_time = 0.0
+
+    def start(self, name):
+        self._running[name] = time.perf_counter()
+
+    def stop(self, name):
+        started = self._running.pop(name, None)
+        if started is not None:
+            self.phases[name] = self.phases.get(name, 0.0) + (time.perf_counter() - started) * 1000
+
+    def track_query(self, execute, sql, params, many, context):
+        """Обертка для connection.execute_wrapper"""
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.db_time += (time.perf_counter() - started) * 1000
+
+    def finish(self):
+        for name in list(self._running):
+            self.stop(name)
+        self.total = (time.perf_counter() - self.started) * 1000
+
+    def server_timing(self):
+        metrics = [f'db;dur={self.db_time:.1f};desc="{self.queries} queries"']
+        metrics += [f'{name};dur={duration:.1f}' for name, duration in self.phases.items()]
+        metrics.append(f'total;dur={self.total:.1f}')
+        return ', '.join(metrics)
+
+
+@contextlib.contextmanager
+def timed_phase(request, name):
+    """Замер фазы запроса; request - HttpRequest или Request DRF"""
+    timings = getattr(getattr(request, '_request', request), 'timings', None)
+    if timings is None:
+        yield
+        return
+    timings.start(name)
+    try:
+        yield
+    finally:
+        timings.stop(name)
+
+
+class ViewTimingStats:
+    """Накопленные замеры по view в процессе; сводка пишется в журнал каждые log_every запросов"""
+
+    def __init__(self, log_every):
+        self.log_every = log_every
+        self.lock = threading.Lock()
+        self.views = {}
+
+    def record(self, view, timings):
+        with self.lock:
+            stats = self.views.setdefault(view, {'count': 0, 'total': 0.0, 'db': 0.0, 'queries': 0, 'max': 0.0})
+            stats['count'] += 1
+            stats['total'] += timings.total
+            stats['db'] += timings.db_time
+            stats['queries'] += timings.queries
+            stats['max'] = max(stats['max'], timings.total)
+            if stats['count'] < self.log_every:
+                return
+            summary = dict(stats)
+            del self.views[view]
+
+        count = summary['count']
+        timing_logger.info(
+            "VIEW %s: запросов %d, среднее %.1f мс (макс. %.1f), БД %.1f мс, SQL-запросов %.1f",
+            view, count, summary['total'] / count, summary['max'], summary['db'] / count, summary['queries'] / count,
+        )
@@ -8,6 +8,7 @@ from .views import (
     WorkTypeViewSet,
     StatusListView,
     HealthCheckView,
+    MetricsView,
     EstimateViewSet, # Импортируем новый ViewSet
     UserViewSet,
     RoleViewSet,
@@ -15,7 +16,16 @@ from .views import (
     WorkTypeImportView,
     EstimateClientExportView,
     EstimateInternalExportView,
-    EstimateItemViewSet
+    EstimateItemViewSet,
+    EstimateRepriceView,
+    EstimatePricingRuleView,
+    WorkPriceSnapshotView,
+    WorkPriceSeriesView,
+    FinanceSummaryView,
+    EstimateCategoryBreakdownView,
+    BootstrapView,
+    BatchView,
+    SyncView
 )
 
 router = DefaultRouter()
@@ -30,10 +40,20 @@ router.register(r'project-assignments', ProjectAssignmentViewSet, basename='proj
 
 urlpatterns = [
     path('health/', HealthCheckView.as_view(), name='health-check'),
+    path('metrics/', MetricsView.as_view(), name='metrics'),
     path('work-types/import/', WorkTypeImportView.as_view(), name='work-type-import'),
+    path('work-types/prices/', WorkPriceSnapshotView.as_view(), name='work-price-snapshot'),
+    path('work-types/<int:work_type_id>/price-history/', WorkPriceSeriesView.as_view(), name='work-price-history'),
     path('auth/login/', LoginView.as_view(), name='custom_login'),
     path('auth/me/', CurrentUserView.as_view(), name='current_user'),
+    path('bootstrap/', BootstrapView.as_view(), name='bootstrap'),
+    path('batch/', BatchView.as_view(), name='batch'),
+    path('sync/', SyncView.as_view(), name='sync'),
     path('statuses/', StatusListView.as_view(), name='status-list'),
+    path('finance/summary/', FinanceSummaryView.as_view(), name='finance-summary'),
+    path('estimates/reprice/', EstimateRepriceView.as_view(), name='estimate-reprice'),
+    path('estimates/<int:estimate_id>/categories/', EstimateCategoryBreakdownView.as_view(), name='estimate-categories'),
+    path('estimates/<int:estimate_id>/pricing-rules/', EstimatePricingRuleView.as_view(), name='estimate-pricing-rules'),
     path('estimates/<int:estimate_id>/export/client/', EstimateClientExportView.as_view(), name='estimate-client-export'),
     path('estimates/<int:estimate_id>/export/internal/', EstimateInternalExportView.as_view(), name='estimate-internal-export'),
     path('', include(router.urls)),
@@ -2,19 +2,43 @@ from rest_framework import generics, status, viewsets
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.pagination import PageNumberPagination
+from rest_framework.renderers import JSONRenderer
+from django.conf import settings
 from django.contrib.auth.hashers import check_password
-from django.db.models import Sum, F, DecimalField, Value, Q
+from django.core.cache import cache
+from django.core.handlers.wsgi import WSGIRequest
+from django.db import transaction
+from django.urls import resolve, Resolver404
+from django.db.models import Sum, F, DecimalField, Value, Q, Prefetch, prefetch_related_objects
 from django.db.models.functions import Coalesce
+from django.utils.cache import patch_cache_control
+from django.utils.timezone import now as timezone_now
+from decimal import Decimal, InvalidOperation
+import hashlib
+import hmac
+import io
+import json
 import logging
 
 from .models import WorkCategory, User, AuthToken, Project, Estimate, WorkType, Status, WorkPrice, Role, ProjectAssignment, EstimateItem
 from .serializers import (
     WorkCategorySerializer, LoginSerializer, UserSerializer, ProjectSerializer, 
     EstimateListSerializer, WorkTypeSerializer, StatusSerializer, EstimateDetailSerializer, RoleSerializer,
-    ProjectAssignmentSerializer, EstimateItemSerializer
+    ProjectAssignmentSerializer, EstimateItemSerializer, EstimateRepriceSerializer,
+    EstimatePricingRuleSerializer, WorkPriceHistorySerializer, BatchRequestSerializer, SyncRequestSerializer
 )
 from .permissions import IsManager, IsAuthenticatedCustom, CanAccessEstimate
 from .security_decorators import ensure_estimate_access, audit_critical_action, log_data_change
+from .caching import (
+    SECTION_CATALOG, SECTION_ESTIMATES, SECTION_PROJECTS, SECTION_ROLES, SECTION_STATUSES, SECTION_USERS,
+    combined_version, versioned_key,
+)
+from .finance import get_finance_summary, category_breakdown, serialize_breakdown
+from .pricing import reprice_estimates, apply_pricing_rule, record_price_history, price_snapshot, price_series
+from .sync import apply_mutations
+from .signals import flush_pending_changes
+from .registry import draft_status
+from . import metrics
 import openpyxl
 from rest_framework.parsers import MultiPartParser
 from django.http import HttpResponse
@@ -32,10 +56,53 @@ class WorkTypePagination(PageNumberPagination):
     max_page_size = 100
 
 
+class ReferenceDataCacheMixin:
+    """
+    Список справочника из версионированного кэша со строгим ETag.
+
+    Ответ хранится в общем кэше по версиям разделов reference_sections и полному
+    пути запроса, поэтому в установившемся режиме список не обращается к БД.
+    Клиент получает Cache-Control с max-age и при повторе с If-None-Match -
+    304 без тела. Записи в справочник увеличивают версию раздела через сигналы.
+    """
+    reference_sections = ()
+    reference_max_age = 60
+    reference_cache_timeout = 3600
+
+    def list(self, request, *args, **kwargs):
+        key = versioned_key(
+            f'reference:{self.__class__.__name__}', request.get_full_path(), sections=self.reference_sections
+        )
+        cached = cache.get(key)
+        metrics.record_cache('reference_data', cached is not None)
+        if cached is None:
+            response = super().list(request, *args, **kwargs)
+            content = JSONRenderer().render(response.data)
+            cached = {
+                'data': json.loads(content),
+                'etag': '"%s"' % hashlib.sha256(content).hexdigest(),
+            }
+            cache.set(key, cached, self.reference_cache_timeout)
+
+        if self.etag_matches(request, cached['etag']):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = Response(cached['data'])
+        response['ETag'] = cached['etag']
+        patch_cache_control(response, private=True, max_age=self.reference_max_age, must_revalidate=True)
+        return response
+
+    @staticmethod
+    def etag_matches(request, etag):
+        header = request.META.get('HTTP_IF_NONE_MATCH', '')
+        return any(value.strip() in (etag, '*') for value in header.split(',') if value.strip())
+
+
 class WorkTypeImportView(APIView):
     permission_classes = [IsAuthenticatedCustom, IsManager]
     parser_classes = [MultiPartParser]
 
+    @metrics.timed('operation_duration_seconds', operation='work_type_import')
     def post(self, request, *args, **kwargs):
         file_obj = request.data.get('file')
         if not file_obj:
@@ -49,6 +116,15 @@ class WorkTypeImportView(APIView):
             updated_count = 0
             errors = []
 
+            # Текущие цены для определения изменений (одним запросом)
+            current_prices = {
+                work_name: (cost, client)
+                for work_name, cost, client in WorkPrice.objects.values_list(
+                    'work_type__work_name', 'cost_price', 'client_price'
+                )
+            }
+            changed_prices = []
+
             # Пропускаем заголовки
             for row_idx, row in enumerate(sheet.iter_rows(min_row=2, values_only=True), start=2):
                 name, category_name, unit, cost_price, client_price = row
@@ -63,9 +139,10 @@ class WorkTypeImportView(APIView):
                     continue
                 
                 try:
-                    cost_price = float(cost_price)
-                    client_price = float(client_price)
-                except (ValueError, TypeError):
+                    # Ячейки openpyxl - float: приводим к копейкам, как цены в БД
+                    cost_price = Decimal(str(cost_price)).quantize(Decimal('0.01'))
+                    client_price = Decimal(str(client_price)).quantize(Decimal('0.01'))
+                except (InvalidOperation, ValueError, TypeError):
                     errors.append(f"Строка {row_idx}: цены должны быть числами.")
                     continue
 
@@ -81,7 +158,7 @@ class WorkTypeImportView(APIView):
                     }
                 )
 
-                WorkPrice.objects.update_or_create(
+                work_price, _ = WorkPrice.objects.update_or_create(
                     work_type=work_type,
                     defaults={
                         'cost_price': cost_price,
@@ -89,11 +166,18 @@ class WorkTypeImportView(APIView):
                     }
                 )
 
+                old_prices = current_prices.get(name)
+                if old_prices is None or tuple(old_prices) != (cost_price, client_price):
+                    changed_prices.append(work_price)
+
                 if created:
                     created_count += 1
                 else:
                     updated_count += 1
 
+            # История цен пишется пакетами после обработки файла
+            record_price_history(changed_prices)
+
             response_data = {
                 "message": "Импорт успешно завершен.",
                 "created": created_count,
@@ -140,9 +224,10 @@ class CurrentUserView(APIView):
 
 # --- ViewSets для управления ---
 
-class WorkCategoryViewSet(viewsets.ModelViewSet):
+class WorkCategoryViewSet(ReferenceDataCacheMixin, viewsets.ModelViewSet):
     queryset = WorkCategory.objects.all()
     serializer_class = WorkCategorySerializer
+    reference_sections = (SECTION_CATALOG,)
     
     def get_permissions(self):
         if self.action in ['list', 'retrieve']:
@@ -203,11 +288,12 @@ class WorkTypeViewSet(viewsets.ModelViewSet):
         work_type = serializer.save()
         
         # Создаем соответствующую запись в WorkPrice с указанными ценами
-        WorkPrice.objects.create(
+        work_price = WorkPrice.objects.create(
             work_type=work_type, 
             cost_price=cost_price, 
             client_price=client_price
         )
+        record_price_history([work_price])
     
     def perform_update(self, serializer):
         # Проверяем, есть ли данные о ценах в запросе
@@ -220,11 +306,15 @@ class WorkTypeViewSet(viewsets.ModelViewSet):
         # Обновляем цены, если они переданы
         if cost_price is not None or client_price is not None:
             work_price, created = WorkPrice.objects.get_or_create(work_type=work_type)
+            old_prices = (work_price.cost_price, work_price.client_price)
             if cost_price is not None:
                 work_price.cost_price = cost_price
             if client_price is not None:
                 work_price.client_price = client_price
             work_price.save()
+
+            if created or old_prices != (work_price.cost_price, work_price.client_price):
+                record_price_history([work_price])
     
     def perform_destroy(self, instance):
         """Переопределяем удаление для лучшего контроля ошибок"""
@@ -249,15 +339,74 @@ class WorkTypeViewSet(viewsets.ModelViewSet):
                 )
             raise ValidationError(f"Ошибка при удалении: {str(e)}")
 
+def parse_as_of(value, end_of_day=False):
+    """
+    Разбирает дату/время из query-параметра.
+    Дата без времени означает начало дня (или конец дня при end_of_day).
+    """
+    from django.utils.dateparse import parse_date, parse_datetime
+    from django.utils import timezone
+    from datetime import datetime, time
+    from rest_framework.exceptions import ValidationError
+
+    try:
+        moment = parse_datetime(value)
+        if moment is None:
+            day = parse_date(value)
+            if day is None:
+                raise ValueError
+            moment = datetime.combine(day, time.max if end_of_day else time.min)
+    except ValueError:
+        raise ValidationError(f"Некорректная дата: {value}")
+
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+class WorkPriceSnapshotView(APIView):
+    """Каталог цен на указанную дату: ?as_of=YYYY-MM-DD[THH:MM]"""
+    permission_classes = [IsAuthenticatedCustom]
+
+    def get(self, request, *args, **kwargs):
+        as_of = request.query_params.get('as_of')
+        as_of = parse_as_of(as_of, end_of_day=True) if as_of else timezone_now()
+        serializer = WorkPriceHistorySerializer(price_snapshot(as_of), many=True)
+        return Response({'as_of': as_of, 'prices': serializer.data})
+
+
+class WorkPriceSeriesView(APIView):
+    """История цен работы за период: ?from=...&to=..."""
+    permission_classes = [IsAuthenticatedCustom]
+
+    def get(self, request, work_type_id, *args, **kwargs):
+        if not WorkType.objects.filter(work_type_id=work_type_id).exists():
+            from rest_framework.exceptions import NotFound
+            raise NotFound("Работа не найдена")
+
+        date_from = request.query_params.get('from')
+        date_to = request.query_params.get('to')
+        history = price_series(
+            work_type_id,
+            date_from=parse_as_of(date_from) if date_from else None,
+            date_to=parse_as_of(date_to, end_of_day=True) if date_to else None,
+        ).select_related('work_type')
+        return Response(WorkPriceHistorySerializer(history, many=True).data)
+
+
+def projects_for_user(user):
+    """Проекты, доступные пользователю: менеджеру все, прорабу назначенные"""
+    if user.is_manager:
+        return Project.objects.all()
+    else:
+        return Project.objects.filter(projectassignment__user=user)
+
+
 class ProjectViewSet(viewsets.ModelViewSet):
     serializer_class = ProjectSerializer
 
     def get_queryset(self):
-        user = self.request.user
-        if user.role.role_name == 'менеджер':
-            return Project.objects.all()
-        else:
-            return Project.objects.filter(projectassignment__user=user)
+        return projects_for_user(self.request.user)
 
     def get_permissions(self):
         if self.action in ['create', 'update', 'partial_update', 'destroy']:
@@ -279,10 +428,318 @@ class HealthCheckView(APIView):
             'version': '1.0.0'
         })
 
-class StatusListView(generics.ListAPIView):
+class MetricsView(APIView):
+    """
+    Метрики всех воркеров в текстовом формате Prometheus.
+    Если задан METRICS_TOKEN, он передается в заголовке Authorization: Bearer,
+    иначе метрики доступны только менеджерам по обычному токену.
+    """
+    permission_classes = [IsAuthenticatedCustom, IsManager]
+
+    def get_authenticators(self):
+        if getattr(settings, 'METRICS_TOKEN', ''):
+            return []
+        return super().get_authenticators()
+
+    def get_permissions(self):
+        if getattr(settings, 'METRICS_TOKEN', ''):
+            return []
+        return super().get_permissions()
+
+    def get(self, request):
+        token = getattr(settings, 'METRICS_TOKEN', '')
+        if token:
+            provided = request.headers.get('Authorization', '').removeprefix('Bearer ')
+            if not hmac.compare_digest(provided, token):
+                return HttpResponse('Forbidden', status=status.HTTP_403_FORBIDDEN, content_type='text/plain')
+        counters, histograms = metrics.collect()
+        return HttpResponse(metrics.render(counters, histograms), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+class StatusListView(ReferenceDataCacheMixin, generics.ListAPIView):
     queryset = Status.objects.all()
     serializer_class = StatusSerializer
     permission_classes = [IsAuthenticatedCustom]
+    reference_sections = (SECTION_STATUSES,)
+
+def estimates_for_user(user):
+    """Сметы, доступные пользователю: менеджеру все, прорабу только те, где он назначен прорабом"""
+    # Базовый queryset с оптимизацией для связанных полей
+    queryset = Estimate.objects.select_related(
+        'project', 'creator', 'status', 'foreman'
+    ).all()
+
+    if not user.is_manager:
+        # Прораб видит ТОЛЬКО те сметы, где он назначен прорабом
+        queryset = queryset.filter(foreman=user)
+    return queryset
+
+
+def estimate_detail_queryset(user):
+    """
+    Сметы для детального просмотра: работы, видимые пользователю (прорабу - только
+    свои), загружаются одним prefetch-запросом вместе с авторами, поэтому число
+    запросов не зависит от размера сметы.
+    """
+    return estimates_for_user(user).select_related('creator__role', 'foreman__role').prefetch_related(
+        estimate_items_prefetch(user)
+    )
+
+
+def estimate_items_prefetch(user):
+    """Работы сметы, видимые пользователю, вместе с авторами"""
+    items = EstimateItem.objects.select_related('added_by').order_by('item_id')
+    if not user.is_manager:
+        items = items.filter(added_by=user)
+    return Prefetch('items', queryset=items)
+
+
+def annotate_estimate_totals(queryset, user):
+    """
+    Добавляет к сметам суммы работ (totalAmount, mobile_total_amount).
+    Прорабу считаются только добавленные им работы.
+    """
+    if not user.is_manager:
+        # ДЛЯ ПРОРАБОВ: всегда считаем только работы добавленные ими или без автора (старые)
+        # Убираем различие между desktop и mobile - прораб везде видит только свои работы
+        queryset = queryset.annotate(
+            totalAmount=Coalesce(
+                Sum(
+                    F('items__quantity') * F('items__cost_price_per_unit'),
+                    output_field=DecimalField(),
+                    filter=Q(items__added_by=user)  # СТРОГАЯ ФИЛЬТРАЦИЯ: только работы прораба
+                ),
+                Value(0.0), # Если нет работ, вернуть 0.0
+                output_field=DecimalField()
+            ),
+            mobile_total_amount=Coalesce(
+                Sum(
+                    F('items__quantity') * F('items__cost_price_per_unit'),
+                    output_field=DecimalField(),
+                    filter=Q(items__added_by=user)  # СТРОГАЯ ФИЛЬТРАЦИЯ: только работы прораба
+                ),
+                Value(0.0), # Если нет работ, вернуть 0.0
+                output_field=DecimalField()
+            )
+        )
+    else:
+        # ДЛЯ МЕНЕДЖЕРОВ: полная сумма всех работ
+        queryset = queryset.annotate(
+            totalAmount=Coalesce(
+                Sum(
+                    F('items__quantity') * F('items__cost_price_per_unit'),
+                    output_field=DecimalField()
+                ),
+                Value(0.0), # Если нет работ, вернуть 0.0
+                output_field=DecimalField()
+            ),
+            mobile_total_amount=Coalesce(
+                Sum(
+                    F('items__quantity') * F('items__cost_price_per_unit'),
+                    output_field=DecimalField()
+                ),
+                Value(0.0), # Если нет работ, вернуть 0.0
+                output_field=DecimalField()
+            )
+        )
+    return queryset
+
+
+class BootstrapView(APIView):
+    """
+    Стартовые данные мобильного приложения одним запросом: пользователь, проекты,
+    сметы, статусы, категории и работы.
+
+    Каждый раздел имеет версию. Клиент передает известные ему версии
+    (?versions=statuses:123,work_types:456) и получает только изменившиеся разделы;
+    неизменные перечислены в "unchanged".
+    """
+    permission_classes = [IsAuthenticatedCustom]
+
+    # Раздел ответа -> разделы данных, от которых он зависит
+    SECTION_DEPENDENCIES = {
+        'projects': (SECTION_PROJECTS,),
+        'estimates': (SECTION_ESTIMATES, SECTION_PROJECTS, SECTION_STATUSES, SECTION_USERS),
+        'statuses': (SECTION_STATUSES,),
+        'work_categories': (SECTION_CATALOG,),
+        'work_types': (SECTION_CATALOG,),
+    }
+    # Разделы, одинаковые для всех пользователей, кэшируются по версии
+    SHARED_SECTIONS = ('statuses', 'work_categories', 'work_types')
+    SHARED_SECTION_TIMEOUT = 3600
+
+    def get(self, request, *args, **kwargs):
+        user = request.user
+        known_versions = self.parse_versions(request.query_params.get('versions', ''))
+
+        data = {'user': UserSerializer(user).data, 'versions': {}, 'unchanged': []}
+        for section, dependencies in self.SECTION_DEPENDENCIES.items():
+            version = combined_version(*dependencies)
+            data['versions'][section] = version
+            if known_versions.get(section) == version:
+                data['unchanged'].append(section)
+                continue
+
+            if section in self.SHARED_SECTIONS:
+                key = f'bootstrap:{section}:{version}'
+                section_data = cache.get(key)
+                metrics.record_cache('bootstrap', section_data is not None)
+                if section_data is None:
+                    section_data = self.build_section(section, user)
+                    cache.set(key, section_data, self.SHARED_SECTION_TIMEOUT)
+            else:
+                section_data = self.build_section(section, user)
+            data[section] = section_data
+
+        return Response(data)
+
+    @staticmethod
+    def parse_versions(value):
+        versions = {}
+        for pair in value.split(','):
+            section, _, version = pair.partition(':')
+            if section and version:
+                versions[section.strip()] = version.strip()
+        return versions
+
+    def build_section(self, section, user):
+        if section == 'projects':
+            return ProjectSerializer(projects_for_user(user), many=True).data
+        if section == 'estimates':
+            estimates = annotate_estimate_totals(estimates_for_user(user), user).order_by('-created_at')
+            return EstimateListSerializer(estimates, many=True).data
+        if section == 'statuses':
+            return StatusSerializer(Status.objects.order_by('status_id'), many=True).data
+        if section == 'work_categories':
+            return WorkCategorySerializer(WorkCategory.objects.order_by('category_name'), many=True).data
+        if section == 'work_types':
+            work_types = WorkType.objects.select_related('category', 'workprice').order_by(
+                'category__category_name', 'work_name'
+            )
+            return WorkTypeSerializer(work_types, many=True).data
+        raise ValueError(f"Неизвестный раздел: {section}")
+
+
+class BatchView(APIView):
+    """
+    Пакетное выполнение запросов к API в одном HTTP-запросе.
+
+    Каждый подзапрос проходит через URL resolver и обычный view со своими
+    проверками прав; аутентификация выполняется один раз и передается подзапросам.
+    При atomic=true все подзапросы выполняются в одной транзакции, и первая
+    ошибка откатывает изменения уже выполненных.
+    """
+    permission_classes = [IsAuthenticatedCustom]
+    API_PREFIX = '/api/v1/'
+
+    def post(self, request, *args, **kwargs):
+        serializer = BatchRequestSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        operations = serializer.validated_data['requests']
+
+        if not serializer.validated_data['atomic']:
+            return Response({
+                'atomic': False,
+                'responses': [self.execute(request, operation) for operation in operations],
+            })
+
+        responses = []
+        rolled_back = False
+        with transaction.atomic():
+            for operation in operations:
+                result = self.execute(request, operation)
+                responses.append(result)
+                if result['status'] >= 400:
+                    transaction.set_rollback(True)
+                    rolled_back = True
+                    break
+
+        return Response({'atomic': True, 'rolled_back': rolled_back, 'responses': responses})
+
+    def execute(self, request, operation):
+        path, _, query_string = operation['path'].partition('?')
+        if not path.startswith('/'):
+            path = self.API_PREFIX + path
+
+        try:
+            match = resolve(path)
+        except Resolver404:
+            return {'status': status.HTTP_404_NOT_FOUND, 'body': {'error': f'Путь не найден: {path}'}}
+        if not path.startswith(self.API_PREFIX) or getattr(match.func, 'cls', None) is BatchView:
+            return {'status': status.HTTP_400_BAD_REQUEST, 'body': {'error': f'Недопустимый путь: {path}'}}
+
+        sub_request = self.build_request(request, operation['method'], path, query_string, operation.get('body'))
+        sub_request.resolver_match = match
+        try:
+            response = match.func(sub_request, *match.args, **match.kwargs)
+            if hasattr(response, 'render') and callable(response.render):
+                response.render()
+        except Exception as e:
+            security_logger.error(
+                "BATCH: ошибка подзапроса %s %s пользователя %s: %s",
+                operation['method'], path, request.user.email, e,
+            )
+            return {'status': status.HTTP_500_INTERNAL_SERVER_ERROR, 'body': {'error': 'Internal server error'}}
+
+        body = None
+        if response.get('Content-Type', '').startswith('application/json') and response.content:
+            body = json.loads(response.content)
+        return {'status': response.status_code, 'body': body}
+
+    @staticmethod
+    def build_request(request, method, path, query_string, body):
+        """Django-запрос для подзапроса с заголовками исходного запроса"""
+        payload = json.dumps(body).encode('utf-8') if body is not None else b''
+        environ = {key: value for key, value in request.META.items() if not key.startswith('wsgi.')}
+        environ.update({
+            'wsgi.input': io.BytesIO(payload),
+            'wsgi.url_scheme': request.META.get('wsgi.url_scheme', 'http'),
+            'REQUEST_METHOD': method,
+            'PATH_INFO': path,
+            'SCRIPT_NAME': '',
+            'QUERY_STRING': query_string,
+            'CONTENT_TYPE': 'application/json',
+            'CONTENT_LENGTH': str(len(payload)),
+        })
+        sub_request = WSGIRequest(environ)
+        # Общая аутентификация: DRF не будет повторно проверять токен
+        sub_request._force_auth_user = request.user
+        sub_request._force_auth_token = request.auth
+        return sub_request
+
+
+class SyncView(APIView):
+    """
+    Применение очереди офлайн-изменений мобильного клиента:
+    create_estimate, add_item, change_quantity, delete_item.
+
+    Изменения применяются по порядку в одной транзакции, результат возвращается
+    по каждому изменению (applied, conflict, forbidden, not_found, error, skipped).
+    Повтор изменения с тем же client_id возвращает сохраненный результат.
+    """
+    permission_classes = [IsAuthenticatedCustom]
+
+    def post(self, request, *args, **kwargs):
+        serializer = SyncRequestSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        mutations = serializer.validated_data['mutations']
+
+        result = apply_mutations(request.user, mutations)
+        applied = sum(1 for item in result['results'] if item['status'] == 'applied')
+        audit_logger.info(
+            f"СИНХРОНИЗАЦИЯ: Пользователь {request.user.email} отправил {len(mutations)} изменений, применено {applied}"
+        )
+        return Response(result)
+
+
+class FinanceSummaryView(APIView):
+    """
+    Финансовая сводка по проектам и статусам для текущего пользователя:
+    себестоимость, сумма клиента, прибыль и количество смет.
+    """
+    permission_classes = [IsAuthenticatedCustom]
+
+    def get(self, request, *args, **kwargs):
+        return Response(get_finance_summary(request.user))
 
 class EstimateViewSet(viewsets.ModelViewSet):
     permission_classes = [IsAuthenticatedCustom, CanAccessEstimate]
@@ -294,10 +751,6 @@ class EstimateViewSet(viewsets.ModelViewSet):
 
     def perform_create(self, serializer):
         user = self.request.user
-        try:
-            draft_status = Status.objects.get(status_name='Черновик')
-        except Status.DoesNotExist:
-            draft_status = None
 
         # ИСПРАВЛЕНИЕ: Получаем foreman_id из данных запроса
         foreman_id = self.request.data.get('foreman_id')
@@ -321,144 +774,77 @@ class EstimateViewSet(viewsets.ModelViewSet):
         serializer.save(
             creator=user,
             foreman=foreman, 
-            status=draft_status
+            status=draft_status()
         )
 
     def get_queryset(self):
         user = self.request.user
         
-        # Базовый queryset с оптимизацией для связанных полей
-        queryset = Estimate.objects.select_related(
-            'project', 'creator', 'status', 'foreman'
-        ).all()
-
         # КРИТИЧЕСКИ ВАЖНО: Фильтруем по роли пользователя для ВСЕХ операций
-        if user.role.role_name != 'менеджер':
-            # Прораб видит ТОЛЬКО те сметы, где он назначен прорабом
-            queryset = queryset.filter(foreman=user)
+        if self.action == 'retrieve':
+            # Детальный просмотр: работы с учетом роли загружаются одним prefetch
+            return estimate_detail_queryset(user)
 
-        # Если это запрос на список, добавляем аннотацию с общей суммой
+        queryset = estimates_for_user(user)
+
+        # Если это запрос на список, добавляем аннотацию с общей суммой.
+        # update перечитывает работы для ответа сам, destroy они не нужны
         if self.action == 'list':
-            if user.role.role_name != 'менеджер':
-                # ДЛЯ ПРОРАБОВ: всегда считаем только работы добавленные ими или без автора (старые)
-                # Убираем различие между desktop и mobile - прораб везде видит только свои работы
-                queryset = queryset.annotate(
-                    totalAmount=Coalesce(
-                        Sum(
-                            F('items__quantity') * F('items__cost_price_per_unit'),
-                            output_field=DecimalField(),
-                            filter=Q(items__added_by=user)  # СТРОГАЯ ФИЛЬТРАЦИЯ: только работы прораба
-                        ),
-                        Value(0.0), # Если нет работ, вернуть 0.0
-                        output_field=DecimalField()
-                    ),
-                    mobile_total_amount=Coalesce(
-                        Sum(
-                            F('items__quantity') * F('items__cost_price_per_unit'),
-                            output_field=DecimalField(),
-                            filter=Q(items__added_by=user)  # СТРОГАЯ ФИЛЬТРАЦИЯ: только работы прораба
-                        ),
-                        Value(0.0), # Если нет работ, вернуть 0.0
-                        output_field=DecimalField()
-                    )
-                )
-            else:
-                # ДЛЯ МЕНЕДЖЕРОВ: полная сумма всех работ
-                queryset = queryset.annotate(
-                    totalAmount=Coalesce(
-                        Sum(
-                            F('items__quantity') * F('items__cost_price_per_unit'),
-                            output_field=DecimalField()
-                        ),
-                        Value(0.0), # Если нет работ, вернуть 0.0
-                        output_field=DecimalField()
-                    ),
-                    mobile_total_amount=Coalesce(
-                        Sum(
-                            F('items__quantity') * F('items__cost_price_per_unit'),
-                            output_field=DecimalField()
-                        ),
-                        Value(0.0), # Если нет работ, вернуть 0.0
-                        output_field=DecimalField()
-                    )
-                )
-        else:
-            # Для детального просмотра предзагружаем работы
-            queryset = queryset.prefetch_related('items', 'items__work_type')
+            queryset = annotate_estimate_totals(queryset, user)
         
         return queryset
 
+    def get_object(self):
+        """
+        Смета загружается один раз за запрос: доступ ограничен get_queryset
+        (прораб не видит чужие сметы), CanAccessEstimate проверяется при первой загрузке,
+        повторные вызовы (например, из super().update()) берут объект из кэша.
+        """
+        lookup = self.kwargs.get(self.lookup_url_kwarg or self.lookup_field)
+        cached = getattr(self, '_cached_object', None)
+        if cached is None or cached[0] != lookup:
+            self._cached_object = (lookup, super().get_object())
+        return self._cached_object[1]
+
     def retrieve(self, request, *args, **kwargs):
-        """Переопределяем retrieve для дополнительной проверки доступа и фильтрации работ"""
+        """Детальный просмотр: работы уже отфильтрованы по роли в estimate_detail_queryset"""
         instance = self.get_object()
         
-        # КРИТИЧЕСКИ ВАЖНО: Дублируем проверку доступа для надежности
-        if request.user.role.role_name != 'менеджер':
-            if instance.foreman != request.user:
-                security_logger.warning(
-                    f"БЛОКИРОВАН ДОСТУП: Пользователь {request.user.email} пытался получить доступ к смете {instance.estimate_id}, "
-                    f"но смета принадлежит {instance.foreman.email}"
-                )
-                from rest_framework.exceptions import PermissionDenied
-                raise PermissionDenied("Нет доступа к данной смете")
-        
-        audit_logger.info(f"ДОСТУП К СМЕТЕ: Пользователь {request.user.email} получил доступ к смете {instance.estimate_id}")
-        
-        # КРИТИЧЕСКОЕ ИСПРАВЛЕНИЕ: Фильтруем работы сметы по роли пользователя
-        import logging
-        logger = logging.getLogger('django')
-        logger.warning(f"🔍 DEBUG retrieve: Пользователь {request.user.email}, роль: {request.user.role.role_name}")
-        logger.warning(f"🔍 DEBUG retrieve: Смета {instance.estimate_id}, всего работ: {instance.items.count()}")
-        
-        if request.user.role.role_name != 'менеджер':
-            # СТРОГАЯ ФИЛЬТРАЦИЯ: Для прорабов - показываем только их работы
-            filtered_items = instance.items.filter(added_by=request.user)
-            # Заменяем items на отфильтрованные
-            instance._filtered_items = list(filtered_items)
-            logger.warning(f"🔍 DEBUG retrieve: Прораб - отфильтровано работ: {len(instance._filtered_items)}")
-            for item in instance._filtered_items:
-                logger.warning(f"  - Работа: {item.work_type.work_name}, added_by: {item.added_by_id}")
-        else:
-            # Для менеджеров - все работы
-            instance._filtered_items = list(instance.items.all())
-            logger.warning(f"🔍 DEBUG retrieve: Менеджер - показываем все работы: {len(instance._filtered_items)}")
+        # Аргументы подставляются в сообщение, только если запись проходит по уровню логгера
+        audit_logger.info(
+            "ДОСТУП К СМЕТЕ: Пользователь %s получил доступ к смете %s", request.user.email, instance.estimate_id
+        )
         
         serializer = self.get_serializer(instance)
         return Response(serializer.data)
 
     def update(self, request, *args, **kwargs):
-        """Переопределяем update для дополнительной проверки доступа"""
-        instance = self.get_object()
-        
-        # Дублируем проверку доступа для надежности
-        if request.user.role.role_name != 'менеджер':
-            if instance.foreman != request.user:
-                from rest_framework.exceptions import PermissionDenied
-                raise PermissionDenied("Нет доступа к данной смете")
-        
-        return super().update(request, *args, **kwargs)
-
-    def destroy(self, request, *args, **kwargs):
-        """Переопределяем destroy для дополнительной проверки доступа"""
+        """
+        Как UpdateModelMixin.update, но работы для ответа перечитываются одним
+        prefetch с учетом роли (как в retrieve), а не отдельными запросами на позицию.
+        """
+        partial = kwargs.pop('partial', False)
         instance = self.get_object()
-        
-        # Дублируем проверку доступа для надежности
-        if request.user.role.role_name != 'менеджер':
-            if instance.foreman != request.user:
-                from rest_framework.exceptions import PermissionDenied
-                raise PermissionDenied("Нет доступа к данной смете")
-        
-        return super().destroy(request, *args, **kwargs)
+        serializer = self.get_serializer(instance, data=request.data, partial=partial)
+        serializer.is_valid(raise_exception=True)
+        self.perform_update(serializer)
+        # Версия в ответе учитывает это изменение и внутри транзакции пакета
+        flush_pending_changes()
+
+        instance._prefetched_objects_cache = {}
+        prefetch_related_objects([instance], estimate_items_prefetch(request.user))
+        return Response(serializer.data)
 
 class UserViewSet(viewsets.ModelViewSet):
     queryset = User.objects.select_related('role').all()
     serializer_class = UserSerializer
     permission_classes = [IsAuthenticatedCustom, IsManager]
 
-class RoleViewSet(viewsets.ReadOnlyModelViewSet):
+class RoleViewSet(ReferenceDataCacheMixin, viewsets.ReadOnlyModelViewSet):
     queryset = Role.objects.all()
     serializer_class = RoleSerializer
     permission_classes = [IsAuthenticatedCustom, IsManager]
+    reference_sections = (SECTION_ROLES,)
 
 class ProjectAssignmentViewSet(viewsets.ModelViewSet):
     queryset = ProjectAssignment.objects.select_related('project', 'user').all()
@@ -466,29 +852,104 @@ class ProjectAssignmentViewSet(viewsets.ModelViewSet):
     permission_classes = [IsAuthenticatedCustom, IsManager]
 
 
+class EstimateRepriceView(APIView):
+    """
+    Пересчет цен в позициях смет выбранных статусов:
+    по текущему каталогу или на процент по категориям работ.
+    """
+    permission_classes = [IsAuthenticatedCustom, IsManager]
+
+    def post(self, request, *args, **kwargs):
+        serializer = EstimateRepriceSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        if not serializer.validated_data['dry_run']:
+            audit_logger.info(
+                "ПЕРЕСЧЕТ ЦЕН: Менеджер %s запустил пересчет смет со статусами %s",
+                request.user.email, serializer.validated_data['status_ids'],
+            )
+
+        report = reprice_estimates(
+            status_ids=serializer.validated_data['status_ids'],
+            category_percents=serializer.validated_data.get('category_percents'),
+            dry_run=serializer.validated_data['dry_run'],
+        )
+        return Response(report, status=status.HTTP_200_OK)
+
+
+class EstimatePricingRuleView(APIView):
+    """
+    Применение правила ценообразования (наценка, округление, маржа по категориям)
+    ко всем или отфильтрованным позициям сметы на стороне сервера.
+    """
+    permission_classes = [IsAuthenticatedCustom, IsManager]
+
+    def post(self, request, estimate_id, *args, **kwargs):
+        if not Estimate.objects.filter(estimate_id=estimate_id).exists():
+            from rest_framework.exceptions import NotFound
+            raise NotFound("Смета не найдена")
+
+        serializer = EstimatePricingRuleSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+
+        result = apply_pricing_rule(
+            estimate_id,
+            rule=data['rule'],
+            value=data.get('value'),
+            category_ids=data.get('category_ids'),
+            item_ids=data.get('item_ids'),
+            category_margins=data.get('category_margins'),
+        )
+        audit_logger.info(
+            "ПРАВИЛО ЦЕН: Менеджер %s применил %s=%s к смете %s (позиций: %s)",
+            request.user.email, data['rule'], data.get('category_margins') or data.get('value'),
+            estimate_id, result['items_updated'],
+        )
+        return Response(result, status=status.HTTP_200_OK)
+
+
+class EstimateCategoryBreakdownView(APIView):
+    """
+    Подытоги сметы по категориям работ (себестоимость, сумма клиента, прибыль, количество позиций).
+    Прораб видит только свои сметы и только добавленные им работы - как в retrieve.
+    """
+    permission_classes = [IsAuthenticatedCustom]
+
+    def get(self, request, estimate_id, *args, **kwargs):
+        user = request.user
+        estimates = Estimate.objects.filter(estimate_id=estimate_id)
+        items = EstimateItem.objects.filter(estimate_id=estimate_id)
+        if not user.is_manager:
+            estimates = estimates.filter(foreman=user)
+            items = items.filter(added_by=user)
+
+        if not estimates.exists():
+            from rest_framework.exceptions import NotFound
+            raise NotFound("Смета не найдена")
+
+        data = serialize_breakdown(category_breakdown(items))
+        data['estimate_id'] = estimate_id
+        return Response(data)
+
+
 class EstimateExportBaseView(APIView):
     """Базовый класс для экспорта смет в Excel"""
     permission_classes = [IsAuthenticatedCustom]
 
     def get_estimate(self, estimate_id):
-        """Получить смету с проверкой доступа"""
-        try:
-            estimate = Estimate.objects.select_related(
-                'project', 'creator', 'status', 'foreman'
-            ).prefetch_related('items', 'items__work_type').get(estimate_id=estimate_id)
-            
-            # Проверяем права доступа
-            user = self.request.user
-            if user.role.role_name != 'менеджер':
-                # Прораб может экспортировать только свои сметы
-                if estimate.foreman != user:
-                    from rest_framework.exceptions import PermissionDenied
-                    raise PermissionDenied("Нет доступа к данной смете")
-            
-            return estimate
-        except Estimate.DoesNotExist:
+        """
+        Получить смету с проверкой доступа: как и в EstimateViewSet, прорабу
+        доступны только сметы, где он назначен прорабом (estimates_for_user).
+        В экспорт попадают все работы сметы.
+        """
+        estimate = estimates_for_user(self.request.user).prefetch_related('items').filter(
+            estimate_id=estimate_id
+        ).first()
+        if estimate is None:
             from rest_framework.exceptions import NotFound
             raise NotFound("Смета не найдена")
+        return estimate
 
     def create_excel_file(self, estimate, include_cost_prices=True, is_client_export=False):
         """Создать Excel файл со сметой"""
@@ -569,17 +1030,23 @@ class EstimateExportBaseView(APIView):
         current_row += 1
 
         # Данные таблицы, сгруппированные по категориям
-        items = estimate.items.select_related('work_type__category').all()
+        # Позиции уже загружены prefetch; названия берутся из снимка работы в позиции
+        items = estimate.items.all()
         
         # Группируем по категориям
         categories_dict = defaultdict(list)
         for item in items:
-            category_name = item.work_type.category.category_name if item.work_type.category else 'Без категории'
+            category_name = item.category_name or 'Без категории'
             categories_dict[category_name].append(item)
         
-        total_cost = 0
-        total_client = 0
-        total_profit = 0
+        # Итоги по категориям считаются в БД одним GROUP BY
+        breakdown = {
+            row['category_name'] or 'Без категории': row
+            for row in category_breakdown(EstimateItem.objects.filter(estimate_id=estimate.estimate_id))
+        }
+        total_cost = float(sum(row['total_cost'] for row in breakdown.values()))
+        total_client = float(sum(row['total_client'] for row in breakdown.values()))
+        total_profit = total_client - total_cost
         item_counter = 1
         
         # Обработка каждой категории
@@ -589,29 +1056,21 @@ class EstimateExportBaseView(APIView):
             category_cell.font = Font(bold=True, size=12)
             current_row += 1
             
-            # Переменные для итогов по категории
-            category_cost = 0
-            category_client = 0
-            category_profit = 0
+            # Итоги по категории
+            category_cost = float(breakdown[category_name]['total_cost'])
+            category_client = float(breakdown[category_name]['total_client'])
+            category_profit = category_client - category_cost
             
             # Обработка работ в категории
             for item in category_items:
                 ws.cell(row=current_row, column=1, value=item_counter).border = border
-                ws.cell(row=current_row, column=2, value=item.work_type.work_name).border = border
-                ws.cell(row=current_row, column=3, value=item.work_type.unit_of_measurement).border = border
+                ws.cell(row=current_row, column=2, value=item.work_name).border = border
+                ws.cell(row=current_row, column=3, value=item.unit_of_measurement).border = border
                 ws.cell(row=current_row, column=4, value=float(item.quantity)).border = border
 
                 cost_total = float(item.quantity) * float(item.cost_price_per_unit)
                 client_total = float(item.quantity) * float(item.client_price_per_unit)
                 profit_total = client_total - cost_total
-                
-                category_cost += cost_total
-                category_client += client_total
-                category_profit += profit_total
-                
-                total_cost += cost_total
-                total_client += client_total
-                total_profit += profit_total
 
                 if include_cost_prices:
                     ws.cell(row=current_row, column=5, value=float(item.cost_price_per_unit)).border = border
@@ -668,6 +1127,7 @@ class EstimateExportBaseView(APIView):
 class EstimateClientExportView(EstimateExportBaseView):
     """Экспорт сметы для клиента (без себестоимости)"""
     
+    @metrics.timed('operation_duration_seconds', operation='estimate_client_export')
     def get(self, request, estimate_id):
         estimate = self.get_estimate(estimate_id)
         wb = self.create_excel_file(estimate, include_cost_prices=False, is_client_export=True)
@@ -686,6 +1146,7 @@ class EstimateClientExportView(EstimateExportBaseView):
 class EstimateInternalExportView(EstimateExportBaseView):
     """Внутренний экспорт сметы (с полными данными)"""
     
+    @metrics.timed('operation_duration_seconds', operation='estimate_internal_export')
     def get(self, request, estimate_id):
         estimate = self.get_estimate(estimate_id)
         wb = self.create_excel_file(estimate, include_cost_prices=True)
@@ -729,9 +1190,10 @@ class EstimateItemViewSet(viewsets.ModelViewSet):
         estimate_id = self.request.query_params.get('estimate')
         
         if estimate_id:
-            queryset = EstimateItem.objects.filter(estimate_id=estimate_id)
+            # Автор позиции нужен сериализатору (added_by_name, added_by_email)
+            queryset = EstimateItem.objects.filter(estimate_id=estimate_id).select_related('added_by')
             
-            if user.role.role_name != 'менеджер':
+            if not user.is_manager:
                 # Проверяем доступ к смете - прораб может работать только со своими сметами
                 queryset = queryset.filter(estimate__foreman=user)
                 
@@ -741,25 +1203,34 @@ class EstimateItemViewSet(viewsets.ModelViewSet):
             return queryset
         
         # Если не указана конкретная смета
-        if user.role.role_name == 'менеджер':
-            return EstimateItem.objects.all()
+        if user.is_manager:
+            return EstimateItem.objects.select_related('added_by')
         else:
             # СТРОГАЯ ФИЛЬТРАЦИЯ: Прораб видит только свои работы
             return EstimateItem.objects.filter(
                 estimate__foreman=user
             ).filter(
                 added_by=user
-            )
+            ).select_related('added_by')
     
     def perform_create(self, serializer):
         # Дополнительная проверка доступа при создании
         estimate = serializer.validated_data.get('estimate')
         user = self.request.user
         
-        if user.role.role_name != 'менеджер':
+        if not user.is_manager:
             # Прораб может добавлять элементы только в свои сметы
-            if estimate.foreman != user:
-                raise PermissionError("Нет доступа к данной смете")
+            if estimate is None or estimate.foreman_id != user.user_id:
+                from rest_framework.exceptions import PermissionDenied
+                raise PermissionDenied("Нет доступа к данной смете")
         
         # НОВАЯ ЛОГИКА: Автоматически устанавливаем added_by при создании
+        # Повторное добавление той же работы увеличивает количество существующей позиции
         serializer.save(added_by=user)
+        self.merged = getattr(serializer, 'merged', False)
+
+    def create(self, request, *args, **kwargs):
+        response = super().create(request, *args, **kwargs)
+        if getattr(self, 'merged', False):
+            response.status_code = status.HTTP_200_OK
+        return response
@@ -0,0 +1,150 @@
+"""
+Неблокирующее логирование в файлы.
+
+QueuedFileHandler кладет записи в очередь и сразу возвращает управление потоку
+запроса. В потоке запроса (prepare) в сообщение подставляются аргументы и
+исключение преобразуется в текст; сериализация в JSON, запись на диск и ротация
+выполняются потоком QueueListener. Записи ниже уровня логгера не форматируются
+вовсе. Файлы ротируются по размеру и по времени, старые части сжимаются gzip.
+"""
+
+import copy
+import datetime
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись - одна строка JSON"""
+
+    def format(self, record):
+        data = {
+            'time': datetime.datetime.fromtimestamp(record.created).astimezone().isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'module': record.module,
+            'process': record.process,
+            'thread': record.thread,
+        }
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            # Исключение уже преобразовано в текст при постановке в очередь
+            data['exception'] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class CompressingRotatingFileHandler(logging.handlers.TimedRotatingFileHandler):
+    """
+    Ротация по времени (when/interval) и по размеру (max_bytes).
+    Ротированные файлы сжимаются gzip; хранится backup_count последних.
+    """
+
+    def __init__(self, filename, when='midnight', interval=1, max_bytes=0, backup_count=7, encoding='utf-8'):
+        super().__init__(filename, when=when, interval=interval, backupCount=backup_count, encoding=encoding)
+        self.max_bytes = max_bytes
+        self.namer = self._unique_gzip_name
+        self.rotator = self._gzip_rotate
+
+    def shouldRollover(self, record):
+        if super().shouldRollover(record):
+            return True
+        if self.max_bytes <= 0:
+            return False
+        if self.stream is None:
+            self.stream = self._open()
+        return self.stream.tell() >= self.max_bytes
+
+    @staticmethod
+    def _unique_gzip_name(default_name):
+        # При ротации по размеру в пределах одного интервала имя по времени повторяется
+        name = f'{default_name}.gz'
+        index = 1
+        while os.path.exists(name):
+            name = f'{default_name}.{index}.gz'
+            index += 1
+        return name
+
+    @staticmethod
+    def _gzip_rotate(source, dest):
+        with open(source, 'rb') as source_file, gzip.open(dest, 'wb') as dest_file:
+            shutil.copyfileobj(source_file, dest_file)
+        os.remove(source)
+
+    def getFilesToDelete(self):
+        directory, base_name = os.path.split(self.baseFilename)
+        prefix = f'{base_name}.'
+        rotated = sorted(
+            (os.path.join(directory, name) for name in os.listdir(directory)
+             if name.startswith(prefix) and name.endswith('.gz')),
+            key=os.path.getmtime,
+        )
+        if len(rotated) <= self.backupCount:
+            return []
+        return rotated[:len(rotated) - self.backupCount]
+
+
+class QueuedFileHandler(logging.handlers.QueueHandler):
+    """
+    Обработчик для LOGGING: записи передаются через очередь в поток,
+    который пишет их в CompressingRotatingFileHandler. Форматтер, указанный
+    в настройках, применяется в этом потоке. Если очередь переполнена,
+    запись отбрасывается (а не блокирует запрос); число пропущенных записей
+    попадает в журнал, как только в очереди появляется место.
+    """
+
+    def __init__(self, filename, queue_size=10000, **file_options):
+        super().__init__(queue.Queue(maxsize=queue_size))
+        self.target = CompressingRotatingFileHandler(filename, **file_options)
+        self.listener = logging.handlers.QueueListener(self.queue, self.target)
+        self.listener.start()
+        self.dropped = 0
+        self.stopped = False
+
+    def setFormatter(self, fmt):
+        self.target.setFormatter(fmt)
+
+    def prepare(self, record):
+        """
+        Как QueueHandler.prepare: аргументы подставляются в сообщение, а исключение
+        преобразуется в текст в потоке запроса - к моменту записи аргументы могут
+        измениться, а traceback держит кадры стека. Форматтер (JSON) применяется
+        в потоке записи.
+        """
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = (self.target.formatter or logging.Formatter()).formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            if self.dropped:
+                self.queue.put_nowait(self._dropped_record(record))
+                self.dropped = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _dropped_record(self, record):
+        return logging.LogRecord(
+            record.name, logging.WARNING, __file__, 0,
+            'Очередь журнала переполнена, пропущено записей: %d', (self.dropped,), None,
+        )
+
+    def close(self):
+        # Вызывается logging.shutdown() при завершении процесса: дописываем очередь
+        if not self.stopped:
+            self.stopped = True
+            self.listener.stop()
+            self.target.close()
+        super().close()
@@ -14,6 +14,7 @@ from pathlib import Path
 import os
 import dj_database_url
 from dotenv import load_dotenv
+from corsheaders.defaults import default_headers
 
 # Load environment variables from .env file
 load_dotenv()
@@ -47,6 +48,15 @@ else:
     CORS_ALLOWED_ORIGINS = [
         "http://localhost:5173",
     ]
+# Заголовок для безопасных повторов запросов с мобильных клиентов
+CORS_ALLOW_HEADERS = (*default_headers, 'idempotency-key')
+CORS_EXPOSE_HEADERS = ['Idempotency-Replayed']
+
+# Замеры запросов (Server-Timing и сводка по view в журнале api.timing)
+REQUEST_TIMING_ENABLED = os.environ.get('REQUEST_TIMING_ENABLED', str(DEBUG)).lower() == 'true'
+# Статистика SQL-запросов по отпечаткам (manage.py query_report)
+QUERY_STATS_ENABLED = os.environ.get('QUERY_STATS_ENABLED', str(DEBUG)).lower() == 'true'
+QUERY_STATS_SLOW_MS = int(os.environ.get('QUERY_STATS_SLOW_MS', 100))
 
 
 # Application definition
@@ -71,14 +81,24 @@ INSTALLED_APPS = [
 MIDDLEWARE = [
     # CORS middleware ОБЯЗАТЕЛЬНО должен быть ПЕРВЫМ
     'corsheaders.middleware.CorsMiddleware',
+    # Замеры запроса и заголовок Server-Timing (REQUEST_TIMING_ENABLED)
+    'api.middleware.RequestTimingMiddleware',
+    # Метрики запросов для /api/v1/metrics/ (METRICS_ENABLED)
+    'api.middleware.MetricsMiddleware',
+    # Статистика SQL-запросов для команды query_report (QUERY_STATS_ENABLED)
+    'api.middleware.QueryStatsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'auditlog.middleware.AuditlogMiddleware',
+    # Журнал аудита запроса пишется одной пачкой (после AuditlogMiddleware)
+    'api.middleware.AuditBufferMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    # Повторы изменяющих запросов с заголовком Idempotency-Key
+    'api.middleware.IdempotencyKeyMiddleware',
 ]
 
 
@@ -193,18 +213,34 @@ LOGGING = {
             'format': '{levelname} {message}',
             'style': '{',
         },
+        'json': {
+            '()': 'core.logging_handlers.JsonFormatter',
+        },
     },
+    # Запись в файлы идет через очередь отдельным потоком (не блокирует запросы),
+    # ротация по размеру и раз в сутки, старые файлы сжимаются
     'handlers': {
         'security_file': {
             'level': 'WARNING',
-            'class': 'logging.FileHandler',
+            'class': 'core.logging_handlers.QueuedFileHandler',
             'filename': 'security.log',
-            'formatter': 'verbose',
+            'max_bytes': 10 * 1024 * 1024,
+            'when': 'midnight',
+            'backup_count': 14,
+            'formatter': 'json',
         },
         'audit_file': {
             'level': 'INFO',
-            'class': 'logging.FileHandler',
-            'filename': 'audit.log', 
+            'class': 'core.logging_handlers.QueuedFileHandler',
+            'filename': 'audit.log',
+            'max_bytes': 10 * 1024 * 1024,
+            'when': 'midnight',
+            'backup_count': 14,
+            'formatter': 'json',
+        },
+        'console': {
+            'level': 'INFO',
+            'class': 'logging.StreamHandler',
             'formatter': 'verbose',
         },
     },
@@ -224,5 +260,10 @@ LOGGING = {
             'level': 'INFO',
             'propagate': False,
         },
+        'api.timing': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
     },
 }
@@ -7,6 +7,7 @@ Production-like settings for local development
 from pathlib import Path
 import os
 from dotenv import load_dotenv
+from corsheaders.defaults import default_headers
 
 # Load environment variables
 load_dotenv()
@@ -41,14 +42,24 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'corsheaders.middleware.CorsMiddleware',
+    # Замеры запроса и заголовок Server-Timing (REQUEST_TIMING_ENABLED)
+    'api.middleware.RequestTimingMiddleware',
+    # Метрики запросов для /api/v1/metrics/ (METRICS_ENABLED)
+    'api.middleware.MetricsMiddleware',
+    # Статистика SQL-запросов для команды query_report (QUERY_STATS_ENABLED)
+    'api.middleware.QueryStatsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'auditlog.middleware.AuditlogMiddleware',
+    # Журнал аудита запроса пишется одной пачкой (после AuditlogMiddleware)
+    'api.middleware.AuditBufferMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    # Повторы изменяющих запросов с заголовком Idempotency-Key
+    'api.middleware.IdempotencyKeyMiddleware',
 ]
 
 ROOT_URLCONF = 'core.urls'
@@ -124,6 +135,13 @@ CORS_ALLOWED_ORIGINS = [
     'http://127.0.0.1:5173',
 ]
 CORS_ALLOW_ALL_ORIGINS = False
+CORS_ALLOW_HEADERS = (*default_headers, 'idempotency-key')
+CORS_EXPOSE_HEADERS = ['Idempotency-Replayed']
+
+# Замеры запросов (Server-Timing и сводка по view в журнале api.timing)
+REQUEST_TIMING_ENABLED = True
+# Статистика SQL-запросов по отпечаткам (manage.py query_report)
+QUERY_STATS_ENABLED = True
 
 # Logging для отладки
 LOGGING = {
@@ -6,6 +6,7 @@ import os
 from pathlib import Path
 import dj_database_url
 from dotenv import load_dotenv
+from corsheaders.defaults import default_headers
 
 # Load environment variables from .env file
 load_dotenv()
@@ -45,15 +46,25 @@ INSTALLED_APPS = DJANGO_APPS + THIRD_PARTY_APPS + LOCAL_APPS
 
 MIDDLEWARE = [
     'corsheaders.middleware.CorsMiddleware',
+    # Замеры запроса и заголовок Server-Timing (REQUEST_TIMING_ENABLED)
+    'api.middleware.RequestTimingMiddleware',
+    # Метрики запросов для /api/v1/metrics/ (METRICS_ENABLED)
+    'api.middleware.MetricsMiddleware',
+    # Статистика SQL-запросов для команды query_report (QUERY_STATS_ENABLED)
+    'api.middleware.QueryStatsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',  # For serving static files
     'auditlog.middleware.AuditlogMiddleware',
+    # Журнал аудита запроса пишется одной пачкой (после AuditlogMiddleware)
+    'api.middleware.AuditBufferMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    # Повторы изменяющих запросов с заголовком Idempotency-Key
+    'api.middleware.IdempotencyKeyMiddleware',
 ]
 
 ROOT_URLCONF = 'core.urls'
@@ -162,6 +173,20 @@ REST_FRAMEWORK = {
 CORS_ALLOWED_ORIGINS = [origin for origin in os.environ.get('CORS_ALLOWED_ORIGINS', '').split(',') if origin.strip()]
 CORS_ALLOW_CREDENTIALS = True
 CORS_ALLOW_ALL_ORIGINS = False  # Never allow all origins in production
+CORS_ALLOW_HEADERS = (*default_headers, 'idempotency-key')
+CORS_EXPOSE_HEADERS = ['Idempotency-Replayed']
+
+# Замеры запросов (Server-Timing и сводка по view в журнале api.timing)
+REQUEST_TIMING_ENABLED = os.environ.get('REQUEST_TIMING_ENABLED', 'False').lower() == 'true'
+REQUEST_TIMING_SLOW_MS = int(os.environ.get('REQUEST_TIMING_SLOW_MS', 1000))
+# Статистика SQL-запросов по отпечаткам (manage.py query_report)
+QUERY_STATS_ENABLED = os.environ.get('QUERY_STATS_ENABLED', 'False').lower() == 'true'
+QUERY_STATS_SLOW_MS = int(os.environ.get('QUERY_STATS_SLOW_MS', 100))
+
+# Метрики (/api/v1/metrics/): воркеры сохраняют свои значения в общий каталог
+METRICS_DIR = os.environ.get('METRICS_DIR', '/tmp/estimate-metrics')
+# Без токена /metrics/ доступен только менеджерам по обычному токену API
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
 
 # Security settings for production
 SECURE_BROWSER_XSS_FILTER = True
@@ -244,6 +269,9 @@ LOGGING = {
 # Audit log configuration
 AUDITLOG_INCLUDE_ALL_MODELS = False  # Only specific models
 AUDITLOG_DISABLE_ON_RAW_SAVE = True
+# Журнал аудита запросов пишется фоновым потоком (api.audit)
+AUDIT_BACKGROUND_WRITER = True
+AUDIT_QUEUE_SIZE = 1000
 
 # Email configuration for production
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
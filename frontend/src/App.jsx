@@ -249,6 +249,8 @@ function App() {
   const performSaveEstimate = async (estimateToSave, finalName) => {
     // 1. Подготавливаем массив работ. Теперь структура item едина.
     const itemsToSave = (estimateToSave.items || []).map(item => ({
+        // ID сохраненной позиции - чтобы сервер сохранил ее автора (у новых позиций ID временный)
+        ...(Number.isInteger(item.item_id) && { item_id: item.item_id }),
         work_type: item.work_type, // Просто передаем ID
         quantity: item.quantity,
         cost_price_per_unit: item.cost_price_per_unit,
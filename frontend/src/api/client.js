@@ -85,7 +85,29 @@ const request = async (endpoint, options = {}) => {
 export const api = {
     login: (email, password) => request('/auth/login/', { method: 'POST', body: JSON.stringify({ email, password }) }),
     getCurrentUser: () => request('/auth/me/'),
+    // Стартовые данные одним запросом; versions - { section: version } из прошлого ответа
+    getBootstrap: (versions = {}) => {
+        const known = Object.entries(versions).map(([section, version]) => `${section}:${version}`).join(',');
+        return request(`/bootstrap/${known ? `?versions=${encodeURIComponent(known)}` : ''}`);
+    },
     
+    // Офлайн-очередь: [{ client_id, type, estimate_id | estimate_client_id, item_id | item_client_id, base_version, data }]
+    sync: (mutations) => request('/sync/', { method: 'POST', body: JSON.stringify({ mutations }) }),
+
+    // Поток изменений (SSE): onEvent получает { type, estimate_id, version }.
+    // EventSource сам переподключается и передает Last-Event-ID. Возвращает функцию отписки.
+    subscribeToEvents: (onEvent) => {
+        const token = localStorage.getItem('authToken');
+        const source = new EventSource(`${API_BASE_URL}/events/?token=${encodeURIComponent(token || '')}`);
+        ['estimate_updated', 'estimate_deleted', 'items_changed', 'catalog_changed'].forEach((type) => {
+            source.addEventListener(type, (event) => onEvent(JSON.parse(event.data)));
+        });
+        return () => source.close();
+    },
+
+    // Пакет запросов: [{ method, path, body }], atomic - в одной транзакции
+    batch: (requests, atomic = false) => request('/batch/', { method: 'POST', body: JSON.stringify({ requests, atomic }) }),
+
     // Справочники
     getWorkCategories: () => request('/work-categories/'),
     createWorkCategory: (data) => request('/work-categories/', { method: 'POST', body: JSON.stringify(data) }),
@@ -110,6 +132,10 @@ export const api = {
         });
     },
 
+    // История цен: каталог на дату и ряд цен работы
+    getPriceSnapshot: (asOf) => request(`/work-types/prices/?as_of=${encodeURIComponent(asOf)}`),
+    getWorkTypePriceHistory: (id, from = '', to = '') => request(`/work-types/${id}/price-history/?from=${from}&to=${to}`),
+
     getStatuses: () => request('/statuses/'),
 
     // Проекты (Объекты)
@@ -124,9 +150,23 @@ export const api = {
         return request('/estimates/');
     },
     getEstimate: (id) => request(`/estimates/${id}/`), // Для получения одной сметы
-    createEstimate: (data) => request('/estimates/', { method: 'POST', body: JSON.stringify(data) }),
+    // Итоги по проектам и статусам, рассчитанные на сервере
+    getFinanceSummary: () => request('/finance/summary/'),
+    // Подытоги сметы по категориям работ
+    getEstimateCategories: (id) => request(`/estimates/${id}/categories/`),
+    // idempotencyKey - один ключ на действие пользователя: повторы с ним не создают дубликатов
+    createEstimate: (data, idempotencyKey) => request('/estimates/', {
+        method: 'POST',
+        body: JSON.stringify(data),
+        headers: idempotencyKey ? { 'Idempotency-Key': idempotencyKey } : {},
+    }),
     updateEstimate: (id, data) => request(`/estimates/${id}/`, { method: 'PUT', body: JSON.stringify(data) }),
     deleteEstimate: (id) => request(`/estimates/${id}/`, { method: 'DELETE' }),
+    // Пересчет цен в сметах: { status_ids, category_percents?, dry_run }
+    repriceEstimates: (data) => request('/estimates/reprice/', { method: 'POST', body: JSON.stringify(data) }),
+    // Правило цен для сметы: { rule: 'markup' | 'round' | 'category_margin', value, category_ids?, item_ids? };
+    // для category_margin вместо value и category_ids можно передать category_margins: { [category_id]: процент }
+    applyPricingRule: (id, data) => request(`/estimates/${id}/pricing-rules/`, { method: 'POST', body: JSON.stringify(data) }),
 
     // Пользователи
     getUsers: () => request('/users/'),
@@ -199,8 +239,12 @@ export const api = {
         return response.json();
     },
     
-    createEstimateItem: (data) => {
+    createEstimateItem: (data, idempotencyKey) => {
         console.log('🔗 Создание элемента сметы через новый ViewSet:', data);
-        return request('/estimate-items/', { method: 'POST', body: JSON.stringify(data) });
+        return request('/estimate-items/', {
+            method: 'POST',
+            body: JSON.stringify(data),
+            headers: idempotencyKey ? { 'Idempotency-Key': idempotencyKey } : {},
+        });
     },
 };
\ No newline at end of file